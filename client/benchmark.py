@@ -0,0 +1,141 @@
+"""Throughput and latency benchmark for API gateway deployments.
+
+Runs the same read workload against one or more gateway base URLs and
+reports requests/second, requests/second per server core, and the p50/p99
+latency of each, e.g. to compare two gateway builds side by side:
+
+    python benchmark.py http://0.0.0.0:80 http://0.0.0.0:8080
+
+With --hops, the last URL is taken as the baseline and the p50 latency each
+other deployment adds per downstream hop of the request is reported, e.g.
+to price the HTTP+JSON hops of the microservices against the in-process
+calls of the monolith (services/monolith) for an overview, which makes two
+downstream calls once the gateway cache is off (CACHE_TTL_*=0):
+
+    python benchmark.py http://0.0.0.0:80 http://0.0.0.0:8080 \
+        --path /users/%(userID)s/overview --hops 2
+
+All client processes share one address, so with the gateway rate limiter
+on (RATE_LIMIT=True) most requests would be turned away; run the gateway
+with it off, the default. Requests answered 429 are reported as rejected.
+"""
+import time
+import argparse
+from multiprocessing import Process, Queue
+
+import requests
+
+from client import BankClient
+
+
+NUM_PROCESSES = 8
+NUM_REQUESTS_PER_PROCESS = 500
+
+
+def percentile(sortedValues, pct):
+    if not sortedValues:
+        return 0.0
+    idx = int(round(pct / 100.0 * (len(sortedValues) - 1)))
+    return sortedValues[idx]
+
+
+def prepareCustomer(baseUrl):
+    """Create a user with one account to run the read workload on."""
+    client = BankClient()
+    client.BASE_URL = baseUrl
+    userID = client.createUser('benchmark', '1234')
+    if not userID:
+        return None, None
+    accNum = client.openAccount(userID, "notoken")
+    return userID, accNum
+
+
+def worker(url, numRequests, queue):
+    s = requests.Session()
+    latencies = []
+    errors = 0
+    rejected = 0
+    for i in range(numRequests):
+        start = time.time()
+        try:
+            resp = s.get(url, verify=False, allow_redirects=False)
+            if resp.status_code >= 500:
+                errors += 1
+            elif resp.status_code == 429:
+                rejected += 1
+        except requests.exceptions.ConnectionError:
+            errors += 1
+        latencies.append(time.time() - start)
+    queue.put((latencies, errors, rejected))
+
+
+def run(url, numProcesses, numRequests):
+    queue = Queue()
+    processList = [Process(target=worker, args=(url, numRequests, queue))
+                   for x in range(numProcesses)]
+    startTime = time.time()
+    for p in processList:
+        p.start()
+    latencies = []
+    errors = 0
+    rejected = 0
+    for p in processList:
+        l, e, r = queue.get()
+        latencies.extend(l)
+        errors += e
+        rejected += r
+    secondsPassed = time.time() - startTime
+    for p in processList:
+        p.join()
+    latencies.sort()
+    return len(latencies) / secondsPassed, latencies, errors, rejected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('urls', nargs='+', help='gateway base URLs')
+    parser.add_argument('-c', '--concurrency', type=int,
+                        default=NUM_PROCESSES)
+    parser.add_argument('-n', '--requests', type=int,
+                        default=NUM_REQUESTS_PER_PROCESS,
+                        help='requests per client process')
+    parser.add_argument('--cores', type=int, default=1,
+                        help='cores used by the server under test')
+    parser.add_argument('--path', default='/users/%(userID)s/accounts',
+                        help='path to request, %%(userID)s and %%(accNum)s '
+                             'are substituted')
+    parser.add_argument('--hops', type=int, default=0,
+                        help='downstream calls per request, to report the '
+                             'overhead per hop against the last URL')
+    args = parser.parse_args()
+
+    print("%-30s %10s %10s %10s %10s %8s %8s" \
+          % ("gateway", "req/s", "req/s/core", "p50 ms", "p99 ms", "errors",
+             "rejected"))
+    medians = {}
+    for baseUrl in args.urls:
+        baseUrl = baseUrl.rstrip('/')
+        userID, accNum = prepareCustomer(baseUrl)
+        if not userID:
+            print("%-30s setup failed" % baseUrl)
+            continue
+        url = baseUrl + args.path % {'userID': userID, 'accNum': accNum}
+        rps, latencies, errors, rejected = run(url, args.concurrency,
+                                               args.requests)
+        medians[baseUrl] = percentile(latencies, 50) * 1000
+        print("%-30s %10.1f %10.1f %10.2f %10.2f %8d %8d" \
+              % (baseUrl, rps, rps / args.cores, medians[baseUrl],
+                 percentile(latencies, 99) * 1000, errors, rejected))
+
+    baseline = args.urls[-1].rstrip('/')
+    if args.hops and baseline in medians:
+        for baseUrl in args.urls[:-1]:
+            baseUrl = baseUrl.rstrip('/')
+            if baseUrl in medians:
+                print("%-30s %.2f ms per hop over %s" \
+                      % (baseUrl, (medians[baseUrl] - medians[baseline]) \
+                                  / args.hops, baseline))
+
+
+if __name__ == "__main__":
+    main()
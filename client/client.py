@@ -1,6 +1,7 @@
 import json
 import time
 import datetime
+import argparse
 from multiprocessing import Process, Queue
 
 import urllib3
@@ -25,6 +26,8 @@ else:
 
 
 NUM_PAYMENTS_PER_CLIENT = 100
+# Number of payments sent in one request by runBatchPaymentTest
+BATCH_SIZE = 100
 
 class Simulation():
     def __init__(self, procNum):
@@ -87,6 +90,28 @@ class Simulation():
         self.queue.put(self.printPerformance())
         return
 
+    def runBatchPaymentTest(self, queue):
+        self.queue = queue
+        print ("Start batch payment.")
+        self.startTime = datetime.datetime.now()
+        x = 0
+        y = 1
+        payments = []
+        for i in xrange(0,NUM_PAYMENTS_PER_CLIENT+1):
+            payments.append({'fromAccNum': self.customers[x]['accNum'],
+                             'toAccNum': self.customers[y]['accNum'],
+                             'amount': 20})
+            x, y = y, x
+            if len(payments) == BATCH_SIZE or i == NUM_PAYMENTS_PER_CLIENT:
+                res = self.client.payBatch(payments,
+                                           self.customers[0]['userID'],
+                                           self.customers[0]['access_token'])
+                if not res:
+                    print ("Fail")
+                payments = []
+        self.queue.put(self.printPerformance())
+        return
+
 
 
 class BankClient:
@@ -180,17 +205,52 @@ class BankClient:
             print("Connection error payment: %s" % e)
         return res
 
+    def payBatch(self, payments, userID, token):
+        res = False
+        try:
+            url = self.BASE_URL + '/users/%s/pay/batch' % userID
+            payload = {'payments': payments,
+                       'access_token': token}
+            resp = self.s.post(url, json=payload, verify=False, allow_redirects=False, stream=False)
+
+            if int(resp.status_code) >= 400:
+                print("Fail to pay batch: %s; reason: %s; status: %s" \
+                      % (len(payments), resp.text, resp.status_code))
+            else:
+                failed = [r for r in resp.json()['results']
+                          if r['status'] >= 400]
+                if failed:
+                    print("Failed payments in batch: %s" % failed)
+                else:
+                    res = True
+
+        except requests.exceptions.ConnectionError as e:
+            print("Connection error batch payment: %s" % e)
+        return res
+
 
 
 
 def main():
+    parser = argparse.ArgumentParser(
+                 description='Payments between two customers per process.')
+    parser.add_argument('--batch', action='store_true',
+                        help='send the payments %s at a time to '
+                             '/users/<id>/pay/batch' % BATCH_SIZE)
+    args = parser.parse_args()
+
     numProcesses = 1
     queueList = []
     processList = []
     for x in xrange(0,numProcesses):
         q = Queue()
         queueList.append(q)
-        p = Process(target=Simulation(x*2).runPaymentTest, args=(q,))
+        simulation = Simulation(x*2)
+        if args.batch:
+            test = simulation.runBatchPaymentTest
+        else:
+            test = simulation.runPaymentTest
+        p = Process(target=test, args=(q,))
         processList.append(p)
 
     startTime = datetime.datetime.now()
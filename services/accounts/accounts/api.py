@@ -5,7 +5,8 @@ from functools import wraps
 from flask import Flask, request, abort
 
 from general import log, getEnvVar, isDocker, niceJson, allLinks
-from db_controller import db_create, db_migrate, dbCtrl
+from db_controller import db_create, db_migrate, dbCtrl, TransferError
+from db_controller import SHARDS
 
 
 # Use the name of the current directory as a service type
@@ -43,9 +44,35 @@ app = Flask(__name__)
 
 
 DEFAULT_BALANCE = 1000
+# Largest number of transfers accepted by one batch request
+MAX_BATCH_SIZE = int(getEnvVar('MAX_BATCH_SIZE', 1000))
+# Largest number of accounts listed by one GET /accounts, also its default
+MAX_PAGE_SIZE = int(getEnvVar('MAX_PAGE_SIZE', 1000))
+# Largest number of accounts opened by one POST /accounts/bulk
+MAX_BULK_SIZE = int(getEnvVar('MAX_BULK_SIZE', 1000))
+# Largest number of accounts read by one GET /accounts?accNum=; the request
+# line is also limited to 1024 bytes, see gunicorn_config
+MAX_MULTI_GET_SIZE = int(getEnvVar('MAX_MULTI_GET_SIZE', 100))
+
+# Accounts read by number are cached, see dbCtrl
+ACCOUNT_CACHE_SIZE = int(getEnvVar('ACCOUNT_CACHE_SIZE', 10000))
+ACCOUNT_CACHE_TTL = float(getEnvVar('ACCOUNT_CACHE_TTL', 60))
+
+# Group commit: writes arriving within GROUP_COMMIT_WINDOW seconds, up to
+# GROUP_COMMIT_SIZE of them, share one commit; 0 commits every write alone
+GROUP_COMMIT_WINDOW = float(getEnvVar('GROUP_COMMIT_WINDOW', 0))
+GROUP_COMMIT_SIZE = int(getEnvVar('GROUP_COMMIT_SIZE', 100))
+
+# Comma separated numbers of accounts whose balance is striped over
+# ACCOUNT_STRIPES rows, e.g. of merchants receiving most payments; see dbCtrl
+HOT_ACCOUNTS = [int(n) for n in getEnvVar('HOT_ACCOUNTS', '').split(',')
+                if n.strip()]
+ACCOUNT_STRIPES = int(getEnvVar('ACCOUNT_STRIPES', 8))
 
 # Load DB controller
-db = dbCtrl(logger)
+db = dbCtrl(logger, ACCOUNT_CACHE_SIZE, ACCOUNT_CACHE_TTL,
+            GROUP_COMMIT_WINDOW, GROUP_COMMIT_SIZE, HOT_ACCOUNTS,
+            ACCOUNT_STRIPES)
 
 def prepareDB():
     """Insure presence of the required DB files."""
@@ -54,6 +81,8 @@ def prepareDB():
         if not db_create.isDBfile():
             db_create.main()
             db_migrate.main()
+        db_create.createShards()
+        db_migrate.createIndexes()
         res = True
     return res
     
@@ -68,14 +97,23 @@ def hello():
     return niceJson({"subresource_uris": allLinks(app)}, 200)
 
 
+@app.route("/stats", methods=['GET'])
+def stats():
+    return niceJson({"cache": db.cache.stats(),
+                     "shards": SHARDS,
+                     "groupCommit": db.commitStats()},
+                    200)
+
+
 @app.route("/accounts", methods=['GET'])
 @jwt_conditional(requests)
 def accountsGet():
+    if 'accNum' in request.args:
+        return accountsMultiGet()
     userID = request.args.get('userID')
-    if userID:
-        res = db.getAccountsByUserId(userID, json=True)
-    else:
-        res = db.getAllAccounts()    
+    if not userID:
+        return accountsPage()
+    res = db.getAccountsByUserId(userID, json=True)
     if res:
         res_code = 200
     else:
@@ -84,6 +122,45 @@ def accountsGet():
     return niceJson(res, res_code)
 
 
+def accountsPage():
+    """All accounts, a page at a time: ?after=<accNum>&limit=<n> lists the
+    accounts numbered above after. A full page links to the next one."""
+    try:
+        after = int(request.args.get('after', 0))
+        limit = min(int(request.args.get('limit', MAX_PAGE_SIZE)),
+                    MAX_PAGE_SIZE)
+        if limit <= 0:
+            raise ValueError()
+    except ValueError:
+        return niceJson({'msg': 'Expected integers after and positive limit'},
+                        400)
+    res = db.getAccountsPage(after, limit)
+    if res is None:
+        return niceJson({}, 400)
+    response = niceJson(res, 200)
+    if len(res) == limit:
+        response.headers['Link'] = '<%s?after=%s&limit=%s>; rel="next"' \
+                                   % (request.path, res[-1]['accNum'], limit)
+    return response
+
+
+def accountsMultiGet():
+    """Many accounts at once: ?accNum=1,2,3 lists the accounts with these
+    numbers, in that order. Unknown numbers are left out."""
+    try:
+        accNums = [int(n) for n in request.args['accNum'].split(',')]
+    except ValueError:
+        return niceJson({'msg': 'Expected comma separated integers accNum'},
+                        400)
+    if len(accNums) > MAX_MULTI_GET_SIZE:
+        return niceJson({'msg': 'At most %s accounts' % MAX_MULTI_GET_SIZE},
+                        400)
+    res = db.getAccountsByNums(accNums)
+    if res is None:
+        return niceJson({}, 400)
+    return niceJson(res, 200)
+
+
 @app.route("/accounts", methods=['POST'])
 @jwt_conditional(requests)
 def accountsPost():
@@ -94,7 +171,7 @@ def accountsPost():
     try:
         userID = int(request.json['userID'])
         accNum = db.createAccountForUserId(userID, DEFAULT_BALANCE)
-        if accNum != 1:
+        if accNum is not None:
             res = {'accNum': accNum}
             res_code = 200
     except ValueError:
@@ -105,6 +182,93 @@ def accountsPost():
     return niceJson(res, res_code)
 
 
+@app.route("/accounts/bulk", methods=['POST'])
+@jwt_conditional(requests)
+def accountsBulkPost():
+    """Open an account for each of userIDs in one transaction. Returns
+    their numbers in the same order, or none of them is opened."""
+    if not request.json or not 'userIDs' in request.json:
+        abort(400)
+    userIDs = request.json['userIDs']
+    if not isinstance(userIDs, list) or \
+       not 0 < len(userIDs) <= MAX_BULK_SIZE:
+        abort(400)
+    res = {}
+    res_code = 400
+    try:
+        userIDs = [int(userID) for userID in userIDs]
+        accNums = db.createAccountsForUserIds(userIDs, DEFAULT_BALANCE)
+        if accNums is not None:
+            res = {'accNums': accNums}
+            res_code = 200
+    except (TypeError, ValueError):
+        msg = "Expected integers userIDs"
+        logger.warning(msg)
+        res = {'msg': msg}
+    return niceJson(res, res_code)
+
+
+@app.route("/accounts/batch", methods=['POST'])
+@jwt_conditional(requests)
+def accountsBatchPost():
+    if not request.json or not 'transfers' in request.json:
+        abort(400)
+    transfers = request.json['transfers']
+    if not isinstance(transfers, list) or \
+       not 0 < len(transfers) <= MAX_BATCH_SIZE:
+        abort(400)
+    res = {}
+    res_code = 400
+    try:
+        transfers = [(int(t['fromAccNum']), int(t['toAccNum']),
+                      int(t['amount'])) for t in transfers]
+        checkFunds = request.json.get('checkFunds', True) is not False
+        balances = db.applyTransfers(transfers, checkFunds)
+        if balances is not None:
+            res = {'results': [{'fromBalance': b[0], 'toBalance': b[1]}
+                               if isinstance(b, tuple) else {'msg': b}
+                               for b in balances]}
+            res_code = 200
+    except (KeyError, TypeError, ValueError):
+        msg = "Expected integers fromAccNum, toAccNum and amount"
+        logger.warning(msg)
+        res = {'msg': msg}
+    return niceJson(res, res_code)
+
+
+@app.route("/transfers", methods=['POST'])
+@jwt_conditional(requests)
+def transfersPost():
+    """Debit one account and credit another atomically.
+
+    The debit is refused unless the balance covers the amount; checkFunds
+    set to false skips that check, e.g. to reverse an earlier transfer."""
+    if (not request.json or not 'fromAccNum' in request.json
+                        or not 'toAccNum' in request.json
+                        or not 'amount' in request.json):
+        abort(400)
+    res = {}
+    res_code = 400
+    try:
+        fromAccNum = int(request.json['fromAccNum'])
+        toAccNum = int(request.json['toAccNum'])
+        amount = int(request.json['amount'])
+        if amount <= 0:
+            raise ValueError()
+        checkFunds = request.json.get('checkFunds', True) is not False
+        balances = db.transfer(fromAccNum, toAccNum, amount, checkFunds)
+        if balances is not None:
+            res = {'fromBalance': balances[0], 'toBalance': balances[1]}
+            res_code = 200
+    except TransferError as e:
+        res = {'msg': str(e)}
+    except (TypeError, ValueError):
+        msg = "Expected integers fromAccNum, toAccNum and positive amount"
+        logger.warning(msg)
+        res = {'msg': msg}
+    return niceJson(res, res_code)
+
+
 @app.route("/accounts/<accNum>", methods=['GET'])
 @jwt_conditional(requests)
 def accountsAccNumGet(accNum):
@@ -142,6 +306,8 @@ def accountsAccNumDel(accNum):
 @app.route("/accounts/<accNum>", methods=['POST'])
 @jwt_conditional(requests)
 def accountsAccNumPost(accNum):
+    """Add amount to the balance. With nonNegative set to true the update
+    is refused if it would make the balance negative."""
     if not request.json or not 'amount' in request.json:
         abort(400)
     res = {}
@@ -149,13 +315,16 @@ def accountsAccNumPost(accNum):
     try:
         accNum = int(accNum)
         amount = int(request.json['amount'])
-        new_balance = db.updateAccount(accNum, amount)
-        if new_balance:
-            res = {'balance':new_balance}
+        nonNegative = request.json.get('nonNegative', False) is True
+        account = db.updateAccount(accNum, amount, nonNegative)
+        if account is not None:
+            res = {'balance':account['balance']}
             res_code = 200
+    except TransferError as e:
+        res = {'msg': str(e)}
     except ValueError:
         msg = "Expected integers: accNum=%s, amount=%s" \
-              % (request.json['accNum'], request.json['amount'])
+              % (accNum, request.json['amount'])
         logger.warning(msg)
         res = {'msg': msg}
     return niceJson(res, res_code)
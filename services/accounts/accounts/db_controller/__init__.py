@@ -1,120 +1,672 @@
-from random import randint
+from random import randint, choice
+from itertools import count
 
 from flask import Flask
 from flask.ext.sqlalchemy import SQLAlchemy
 
-from sqlalchemy.engine import Engine
-from sqlalchemy import event
+from sqlalchemy import event, func, literal, select
+
+from general import sqlitePragmas
+from cache import TTLCache
+from batching import GroupCommit
+
+app = Flask(__name__)
+app.config.from_object('db_controller.db_config')
+db = SQLAlchemy(app)
+
+# The accounts are spread over SHARDS database files: shard i holds the
+# accounts whose number is i modulo SHARDS, and allocates new numbers
+# accordingly, so numbers stay unique without the shards agreeing on them.
+# Shard 0 is the default database, so one shard is the former layout.
+SHARDS = app.config['SHARDS']
+engines = [db.get_engine(app)] + [db.get_engine(app, 'shard%d' % i)
+                                  for i in range(1, SHARDS)]
+
+def shardOf(accNum):
+    return int(accNum) % SHARDS
+
+def shardOfStripe(accNum, stripe):
+    # Stripes of an account are spread over the shards, from its own on
+    return (int(accNum) + stripe) % SHARDS
+
+# The SQLite profile of the service, see general.sqlitePragmas; an unknown
+# profile fails here, at startup.
+sqlitePragmas('accounts')
 
 # SQLAlchemy allows for the PRAGMA statement to be emitted automatically
 # for new connections through the usage of events.
-@event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA synchronous = OFF")
-    cursor.execute("PRAGMA journal_mode = MEMORY")
+    for pragma in sqlitePragmas('accounts'):
+        cursor.execute(pragma)
     cursor.close()
 
-app = Flask(__name__)
-app.config.from_object('db_controller.db_config')
-db = SQLAlchemy(app)
+for engine in engines:
+    event.listen(engine, "connect", set_sqlite_pragma)
 
 import models
-from models import Account
+from models import Account, AccountStripe
+
+# The binds of a session take precedence over its bind, and by default map
+# the tables to the default engine
+sessions = [db.session] + [db.create_scoped_session(
+                               {'binds': dict((table, engine) for table in
+                                              db.metadata.sorted_tables)})
+                           for engine in engines[1:]]
 
 
 ACCOUNT_NUM_LENGTH = 10
 
 
+class TransferError(Exception):
+    """A transfer that cannot be made, e.g. for lack of funds."""
+
+
+class InsufficientFunds(TransferError):
+    def __init__(self):
+        TransferError.__init__(self, 'Insufficient funds')
+
+
 class dbCtrl():
-    """Wrapper over the accounts database."""
-    def __init__(self, logger):
+    """Wrapper over the accounts database.
+
+    Accounts read by number are kept in an LRU cache of up to cacheSize
+    entries for cacheTTL seconds. Every change made through this class is
+    written through to the cache once committed, so a worker always reads
+    its own writes; the TTL bounds how long other workers' writes may go
+    unseen. A cacheTTL of 0 disables the cache.
+
+    With a commitWindow, writes of concurrent requests arriving within
+    commitWindow seconds, up to commitMaxSize of them, are committed
+    together, see GroupCommit. Each request still returns only once its
+    write is committed.
+
+    Every write goes to the shard of its accounts. Transfers between
+    accounts of different shards are committed in each shard in turn,
+    which is not atomic should the service die in between.
+
+    The accounts of hotAccounts, e.g. of merchants paid by many, are
+    striped: a credit is added to one of stripes rows picked at random,
+    which live in different shards when there are several, rather than
+    to the account row every payment would otherwise wait for. A transfer
+    within a shard credits a stripe of that shard, in the same commit as
+    the debit. A debit the account row cannot cover first moves the
+    stripes back into it. Reads, and the balances writes return, add the
+    stripes to the balance. An account must not be taken out of
+    hotAccounts while its stripes hold money."""
+    def __init__(self, logger, cacheSize=10000, cacheTTL=0, commitWindow=0,
+                 commitMaxSize=100, hotAccounts=(), stripes=8):
         self.logger = logger
         self.to_json = lambda account: {
                               "user_id": account.user_id, 
                               "accNum": account.number, 
                               "balance": account.balance}
+        self.cache = TTLCache(cacheSize)
+        self.cacheTTL = cacheTTL
+        self.commits = None
+        if commitWindow > 0:
+            self.commits = [GroupCommit(session, commitWindow, commitMaxSize)
+                            for session in sessions]
+        # New accounts are spread over the shards in turn
+        self.nextShard = count()
+        self.hot = set(hotAccounts)
+        self.stripes = stripes
+
+    def commitStats(self):
+        """Group commit statistics per shard, {} without group commit."""
+        if self.commits is None:
+            return {}
+        return dict((i, c.stats()) for i, c in enumerate(self.commits))
+
+    def cacheAccounts(self, accounts):
+        """Write committed accounts, as JSON, through to the cache. Hot
+        accounts are only invalidated, as the account row does not hold
+        their whole balance."""
+        for account in accounts:
+            # Invalidating first discards any older value being cached by
+            # a concurrent read
+            self.cache.invalidate(account['accNum'])
+            if account['accNum'] not in self.hot:
+                self.cache.set(account['accNum'], account, self.cacheTTL)
+
+    def withStripes(self, accounts):
+        """Add their stripes to the balance of the hot ones of accounts,
+        given as JSON."""
+        for account in accounts:
+            if account['accNum'] in self.hot:
+                account['balance'] += self.stripesBalance(account['accNum'])
+        return accounts
+
+    def hotBalance(self, accNum):
+        """Balance of a hot account, its row and its stripes."""
+        try:
+            return self.rowBalance(sessions[shardOf(accNum)], accNum) + \
+                   self.stripesBalance(accNum)
+        finally:
+            # Ends the reads, which could otherwise hold up the commits of
+            # the shards
+            for session in sessions:
+                session.rollback()
+
+    def stripesBalance(self, accNum):
+        return sum(session.query(func.sum(AccountStripe.balance))
+                          .filter_by(number=accNum).scalar() or 0
+                   for session in sessions)
 
     def getAccountsByUserId(self, user_id, json=False):
         try:
             # A non existing user_id gives None
-            accounts = Account.query.filter_by(user_id=user_id)
+            accounts = sorted((a for session in sessions for a in
+                               session.query(Account).filter_by(
+                                                        user_id=user_id)),
+                              key=lambda a: a.number)
             self.logger.debug('Accounts for user_id (%s) are retrieved' \
                              % user_id)
             if json:
-                return [self.to_json(account) for account in accounts]
+                return self.withStripes([self.to_json(account)
+                                         for account in accounts])
             else:
                 return accounts
         except Exception as error:
-            db.session.rollback()
+            for session in sessions:
+                session.rollback()
             self.logger.error(error)
 
     def getAccountByNum(self, accNum, json=False):
+        if json:
+            res = self.cache.get(accNum)
+            if res is not None:
+                return dict(res)
+            generation = self.cache.generation
+        session = sessions[shardOf(accNum)]
         try:
             # A non existing accNum gives None
-            a = Account.query.filter_by(number=accNum).first()
+            a = session.query(Account).filter_by(number=accNum).first()
             self.logger.debug('Account with number (%s) is retrieved' % accNum)
             if json:
-                return self.to_json(a)
+                if a is None:
+                    return None
+                res = self.withStripes([self.to_json(a)])[0]
+                self.cache.set(accNum, res, self.cacheTTL,
+                               generation=generation)
+                return dict(res)
             else:
                 return a
         except Exception as error:
-            db.session.rollback()
+            session.rollback()
             self.logger.error(error)
 
+    def getAccountsByNums(self, accNums):
+        """The accounts of many numbers, as JSON and in the order of
+        accNums; unknown numbers are left out. Accounts missing from the
+        cache are read with one query per shard."""
+        res = {}
+        generation = self.cache.generation
+        missing = {}
+        for accNum in accNums:
+            account = self.cache.get(accNum)
+            if account is not None:
+                res[accNum] = dict(account)
+            else:
+                missing.setdefault(shardOf(accNum), set()).add(accNum)
+        for shard, nums in missing.items():
+            session = sessions[shard]
+            try:
+                for a in session.query(Account.number, Account.user_id,
+                                       Account.balance) \
+                                .filter(Account.number.in_(nums)):
+                    res[a.number] = self.withStripes([self.to_json(a)])[0]
+                    self.cache.set(a.number, res[a.number], self.cacheTTL,
+                                   generation=generation)
+            except Exception as error:
+                session.rollback()
+                self.logger.error(error)
+                return None
+        return [dict(res[n]) for n in accNums if n in res]
+
+    def commitWrite(self, shard, write, committed):
+        """Run write, a function changing the session of a shard it is
+        given, and commit it; with group commit together with the writes of
+        concurrent requests. committed is then called with the result of
+        write. Nothing of a write that raises is committed, see
+        GroupCommit."""
+        session = sessions[shard]
+        if self.commits is not None:
+            return self.commits[shard].run(lambda: write(session), committed)
+        try:
+            res = write(session)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        committed(res)
+        return res
+
     def createAccountForUserId(self, user_id, initial_balance):
-        res = 1
+        """Open an account in the next shard. Returns its number, None on
+        DB errors."""
+        res = self.createAccountsForUserIds([user_id], initial_balance)
+        return res[0] if res else None
+
+    def createAccountsForUserIds(self, user_ids, initial_balance):
+        """Open an account per user id, all in the next shard and in one
+        transaction. Returns their numbers in the order of user_ids, None
+        on DB errors, in which case no account is opened."""
+        shard = next(self.nextShard) % SHARDS
+        accounts = Account.__table__
+        # The number above the highest one of the shard, taken in the same
+        # statement as the insert, so under the same write lock
+        number = func.coalesce(func.max(accounts.c.number), shard) + SHARDS
+        def insert(user_id):
+            return accounts.insert().from_select(
+                       ['number', 'user_id', 'balance'],
+                       select([number, literal(user_id),
+                               literal(initial_balance)])
+                       .select_from(accounts))
+        def write(session):
+            return [{"user_id": user_id,
+                     "accNum": session.execute(insert(user_id)).lastrowid,
+                     "balance": initial_balance} for user_id in user_ids]
+        res = None
         try:
-            a = Account(user_id=user_id, balance=initial_balance)
-            db.session.add(a)
-            db.session.commit()
-            res = a.number
+            created = self.commitWrite(shard, write, self.cacheAccounts)
+            res = [account['accNum'] for account in created]
         except Exception as error:
-            db.session.rollback()
             self.logger.error(error)
         return res
 
-    def updateAccount(self, accNum, amount):
-        res = None
-        a = self.getAccountByNum(accNum)
-        if a:
+    def addToBalance(self, accNum, amount, nonNegative=False):
+        """Add amount to the balance of an account, to a stripe if it is a
+        credit to a hot account. Returns the account, only its number and
+        balance if it is hot, raises TransferError if the update is refused
+        and the error of the DB otherwise."""
+        if accNum not in self.hot:
+            return self.addToAccountRow(accNum, amount, nonNegative)
+        if amount > 0:
+            self.addToStripe(accNum, amount)
+        else:
             try:
-                a.balance += amount
-                #db.session.add(a)
-                db.session.commit()
-                res = a.balance
-            except Exception as error:
-                db.session.rollback()
-                self.logger.error(error)
+                self.addToAccountRow(accNum, amount, nonNegative)
+            except InsufficientFunds:
+                self.consolidate(accNum)
+                self.addToAccountRow(accNum, amount, nonNegative)
+        return {'accNum': accNum, 'balance': self.hotBalance(accNum)}
+
+    def addToStripe(self, accNum, amount):
+        """Add amount to a stripe of a known account picked at random."""
+        session = sessions[shardOf(accNum)]
+        try:
+            known = session.query(Account.number) \
+                           .filter_by(number=accNum).count()
+        finally:
+            # Ends the read, which could otherwise hold up the commits of
+            # the shard
+            session.rollback()
+        if not known:
+            raise TransferError('Unknown account')
+        stripe = randint(0, self.stripes - 1)
+        self.commitWrite(shardOfStripe(accNum, stripe),
+                         self.stripeWrite(accNum, stripe, amount),
+                         lambda r: self.cache.invalidate(accNum))
+
+    def stripeWrite(self, accNum, stripe, amount):
+        """A write adding amount to a stripe, created if missing."""
+        stripes = AccountStripe.__table__
+        where = (stripes.c.number == accNum) & (stripes.c.stripe == stripe)
+        create = stripes.insert().prefix_with('OR IGNORE') \
+                        .values(number=accNum, stripe=stripe, balance=0)
+        update = stripes.update().where(where) \
+                        .values(balance=stripes.c.balance + amount)
+        def write(session):
+            session.execute(create)
+            session.execute(update)
+        return write
+
+    def consolidate(self, accNum):
+        """Move the stripes of an account back into its row, a shard at a
+        time. Stripes in another shard than the account are emptied and
+        then added to the account in two commits, as in a transfer."""
+        accounts = Account.__table__
+        stripes = AccountStripe.__table__
+        ofAccount = stripes.c.number == accNum
+        def take(session):
+            # The first UPDATE takes the write lock, so the stripes cannot
+            # change between the SELECT and the last UPDATE
+            session.execute(stripes.update().where(ofAccount)
+                                   .values(balance=stripes.c.balance))
+            moved = session.query(func.sum(AccountStripe.balance)) \
+                           .filter_by(number=accNum).scalar() or 0
+            session.execute(stripes.update().where(ofAccount)
+                                   .values(balance=0))
+            return moved
+        def add(moved):
+            update = accounts.update() \
+                             .where(accounts.c.number == accNum) \
+                             .values(balance=accounts.c.balance + moved)
+            return lambda session: session.execute(update)
+        invalidate = lambda r: self.cache.invalidate(accNum)
+        for shard in range(SHARDS):
+            if shard == shardOf(accNum):
+                self.commitWrite(shard,
+                                 lambda session: add(take(session))(session),
+                                 invalidate)
+                continue
+            moved = self.commitWrite(shard, take, invalidate)
+            if moved:
+                try:
+                    self.commitWrite(shardOf(accNum), add(moved), invalidate)
+                except Exception:
+                    # Back into the first stripe of the shard
+                    stripe = (shard - int(accNum)) % SHARDS
+                    self.commitWrite(shard,
+                                     self.stripeWrite(accNum, stripe, moved),
+                                     invalidate)
+                    raise
+
+    def addToAccountRow(self, accNum, amount, nonNegative=False):
+        """Add amount to the balance of an account with a single UPDATE.
+        Returns the account, raises TransferError if the update is refused
+        and the error of the DB otherwise."""
+        accounts = Account.__table__
+        update = accounts.update() \
+                         .where(accounts.c.number == accNum) \
+                         .values(balance=accounts.c.balance + amount)
+        if nonNegative:
+            update = update.where(accounts.c.balance + amount >= 0)
+        def write(session):
+            if session.execute(update).rowcount != 1:
+                if session.query(Account).filter_by(number=accNum).count():
+                    raise InsufficientFunds()
+                raise TransferError('Unknown account')
+            # Read before the commit, while the UPDATE holds the write lock.
+            # UPDATE ... RETURNING needs SQLite 3.35, which images lack.
+            return self.to_json(session.query(Account.number,
+                                              Account.user_id,
+                                              Account.balance) \
+                                       .filter_by(number=accNum).one())
+        return self.commitWrite(shardOf(accNum), write,
+                                lambda a: self.cacheAccounts([a]))
+
+    def updateAccount(self, accNum, amount, nonNegative=False):
+        """Add amount to the balance of an account with a single UPDATE.
+
+        As in transfer, the balance is changed by the database rather than
+        read, modified and written back, so concurrent updates are not
+        lost. With nonNegative the update only happens if the balance stays
+        at 0 or above. Returns the account, see addToBalance, None on DB
+        errors, raises TransferError if the update is refused."""
+        res = None
+        try:
+            res = self.addToBalance(accNum, amount, nonNegative)
+        except TransferError:
+            raise
+        except Exception as error:
+            self.logger.error(error)
         return res
 
-    def closeAccount(self, accNum):
-        res = 1
-        a = self.getAccountByNum(accNum)
-        if a:
-            try:
-                db.session.delete(a)
-                db.session.commit()
-                res = 0
-                self.logger.debug('Account is removed user_id (%s)' % user_id)
-            except Exception as error:
-                db.session.rollback()
-                self.logger.error(error)
+    def transfer(self, fromAccNum, toAccNum, amount, checkFunds=True):
+        """Move amount from one account to another in one DB transaction.
+
+        The balances are changed by UPDATE statements rather than read,
+        modified and written back, so concurrent transfers cannot lose each
+        other's updates. With checkFunds the debit only happens if the
+        balance covers it. Returns the (fromBalance, toBalance) tuple, None
+        on DB errors, raises TransferError if the transfer is refused.
+        Accounts of different shards are debited and credited in turn, the
+        debit being refunded if the credit fails."""
+        res = None
+        try:
+            if shardOf(fromAccNum) == shardOf(toAccNum):
+                try:
+                    res = self.transferInShard(fromAccNum, toAccNum, amount,
+                                               checkFunds)
+                except InsufficientFunds:
+                    if fromAccNum not in self.hot:
+                        raise
+                    self.consolidate(fromAccNum)
+                    res = self.transferInShard(fromAccNum, toAccNum, amount,
+                                               checkFunds)
+            else:
+                src = self.addToBalance(fromAccNum, -amount, checkFunds)
+                try:
+                    dst = self.addToBalance(toAccNum, amount)
+                except Exception:
+                    self.addToBalance(fromAccNum, amount)
+                    raise
+                res = (src['balance'], dst['balance'])
+        except TransferError:
+            raise
+        except Exception as error:
+            self.logger.error(error)
         return res
 
-    def getAllAccounts(self):
+    def transferInShard(self, fromAccNum, toAccNum, amount, checkFunds):
+        """transfer for accounts of the same shard, in one commit."""
+        accounts = Account.__table__
+        debit = accounts.update() \
+                        .where(accounts.c.number == fromAccNum) \
+                        .values(balance=accounts.c.balance - amount)
+        if checkFunds:
+            debit = debit.where(accounts.c.balance >= amount)
+        credit = accounts.update() \
+                         .where(accounts.c.number == toAccNum) \
+                         .values(balance=accounts.c.balance + amount)
+        def creditRow(session):
+            return session.execute(credit).rowcount == 1
+        def creditStripe(session):
+            if not session.query(Account.number) \
+                          .filter_by(number=toAccNum).count():
+                return False
+            # A stripe of this shard, stripe j being in shard n + j
+            stripe = choice(range(0, self.stripes, SHARDS))
+            self.stripeWrite(toAccNum, stripe, amount)(session)
+            return True
+        creditTo = creditStripe if toAccNum in self.hot else creditRow
+        def write(session):
+            if session.execute(debit).rowcount != 1:
+                if session.query(Account).filter_by(number=fromAccNum) \
+                                         .count():
+                    raise InsufficientFunds()
+                raise TransferError('Unknown account')
+            if not creditTo(session):
+                # The debit is rolled back, see commitWrite
+                raise TransferError('Unknown account')
+            return dict((a.number, self.to_json(a)) for a in
+                        session.query(Account.number, Account.user_id,
+                                      Account.balance)
+                        .filter(Account.number.in_([fromAccNum, toAccNum])))
+        accounts = self.commitWrite(shardOf(fromAccNum), write,
+                                    lambda a: self.cacheAccounts(a.values()))
+        # The rows hold only part of the balance of hot accounts
+        return tuple(self.hotBalance(n) if n in self.hot else
+                     accounts[n]['balance'] for n in (fromAccNum, toAccNum))
+
+    def applyTransfers(self, transfers, checkFunds=True):
+        """Apply many (fromAccNum, toAccNum, amount) transfers in one commit.
+
+        As in transfer, each transfer is a conditional debit UPDATE and a
+        credit UPDATE, so concurrent writes to the accounts are not lost.
+        A transfer moves money only if both accounts exist and, with
+        checkFunds, the balance covers the amount at that point of the
+        batch. A batch whose accounts are in several shards is applied by
+        applyAcrossShards instead. Returns, in the order of transfers, a
+        (fromBalance, toBalance) tuple for every applied transfer and the
+        reason for the others; None on DB errors."""
+        accNums = set()
+        for fromAccNum, toAccNum, amount in transfers:
+            accNums.update((fromAccNum, toAccNum))
+        shards = set(shardOf(n) for n in accNums)
+        # Balances are checked against the account rows, so the batch sees
+        # the whole balance of hot accounts, except credits made meanwhile
+        for accNum in self.hot.intersection(
+                          fromAccNum for fromAccNum, t, a in transfers):
+            self.consolidate(accNum)
+        if len(shards) > 1:
+            return self.withHotBalances(
+                       transfers, self.applyAcrossShards(transfers, checkFunds))
+        change, balance = self.balanceUpdate, self.rowBalance
+
+        def apply(session, transfer):
+            fromAccNum, toAccNum, amount = transfer
+            if session.execute(change(fromAccNum, -amount, checkFunds)) \
+                      .rowcount != 1:
+                if balance(session, fromAccNum) is None or \
+                   balance(session, toAccNum) is None:
+                    return 'Unknown account'
+                return 'Insufficient funds'
+            if session.execute(change(toAccNum, amount)).rowcount != 1:
+                # Undone here, as with group commit the transaction also
+                # holds the writes of other requests
+                session.execute(change(fromAccNum, amount))
+                return 'Unknown account'
+            return (balance(session, fromAccNum), balance(session, toAccNum))
+
+        def write(session):
+            res = [apply(session, transfer) for transfer in transfers]
+            return res, [self.to_json(a) for a in
+                         session.query(Account.number, Account.user_id,
+                                       Account.balance)
+                                .filter(Account.number.in_(accNums))]
+
+        res = None
         try:
-            accounts = Account.query.all()
-            self.logger.debug('All accounts are retrieved')
-            return [self.to_json(account) for account in accounts]
+            res, changed = self.commitWrite(shards.pop(), write,
+                                            lambda r: self.cacheAccounts(r[1]))
+            res = self.withHotBalances(transfers, res)
         except Exception as error:
-            db.session.rollback()
             self.logger.error(error)
+        return res
+
+    def withHotBalances(self, transfers, results):
+        """Add their stripes, as of now, to the balances of hot accounts
+        in the results of applyTransfers, which are read from the rows."""
+        stripes = dict((n, self.stripesBalance(n)) for transfer in transfers
+                       for n in transfer[:2] if n in self.hot)
+        if not stripes:
+            return results
+        return [result if isinstance(result, basestring) else
+                (result[0] + stripes.get(fromAccNum, 0),
+                 result[1] + stripes.get(toAccNum, 0))
+                for (fromAccNum, toAccNum, amount), result
+                in zip(transfers, results)]
 
+    def balanceUpdate(self, accNum, amount, nonNegative=False):
+        """UPDATE adding amount to the balance of an account; with
+        nonNegative it only matches if the balance stays at 0 or above."""
+        accounts = Account.__table__
+        update = accounts.update() \
+                         .where(accounts.c.number == accNum) \
+                         .values(balance=accounts.c.balance + amount)
+        if nonNegative:
+            update = update.where(accounts.c.balance + amount >= 0)
+        return update
 
+    def rowBalance(self, session, accNum):
+        """Balance of the account row, None for an unknown account."""
+        return session.query(Account.balance) \
+                      .filter_by(number=accNum).scalar()
 
+    def applyAcrossShards(self, transfers, checkFunds=True):
+        """applyTransfers for a batch whose accounts are in several shards.
 
+        As in transfer, each transfer is a conditional debit UPDATE and a
+        credit UPDATE, refunded if the credit fails; here they are batched
+        per shard. All debits are made with one commit per shard, then all
+        credits, then the refunds. A debit is thus checked against the
+        balance before the credits of the batch. The transfers of a shard
+        whose commit fails are failed, and undone if debited already."""
+        change, balance = self.balanceUpdate, self.rowBalance
 
+        def debit(session, transfer):
+            fromAccNum, toAccNum, amount = transfer
+            if session.execute(change(fromAccNum, -amount, checkFunds)) \
+                      .rowcount != 1:
+                if balance(session, fromAccNum) is None:
+                    return 'Unknown account'
+                return 'Insufficient funds'
+            return balance(session, fromAccNum)
+        def credit(session, transfer):
+            fromAccNum, toAccNum, amount = transfer
+            if session.execute(change(toAccNum, amount)).rowcount != 1:
+                return 'Unknown account'
+            return balance(session, toAccNum)
+        def refund(session, transfer):
+            fromAccNum, toAccNum, amount = transfer
+            session.execute(change(fromAccNum, amount))
 
+        def perShard(indexes, side, write):
+            """write(session, transfer) for transfers[k] of indexes, with
+            one commit per shard of its side account. Returns {k: result},
+            a message for the transfers of a shard that failed."""
+            shards = {}
+            for k in indexes:
+                shards.setdefault(shardOf(transfers[k][side]), []).append(k)
+            res = {}
+            for shard, ks in sorted(shards.items()):
+                nums = set(transfers[k][side] for k in ks)
+                try:
+                    res.update(self.commitWrite(
+                        shard,
+                        lambda session: dict((k, write(session, transfers[k]))
+                                             for k in ks),
+                        lambda r: [self.cache.invalidate(n) for n in nums]))
+                except Exception as error:
+                    self.logger.error(error)
+                    res.update((k, 'Cannot apply the transfer') for k in ks)
+            return res
 
+        failed = lambda result: isinstance(result, basestring)
+        debits = perShard(range(len(transfers)), 0, debit)
+        debited = [k for k in range(len(transfers)) if not failed(debits[k])]
+        credits = perShard(debited, 1, credit)
+        refunds = [k for k in debited if failed(credits[k])]
+        for k, result in perShard(refunds, 0, refund).items():
+            if failed(result):
+                self.logger.error("Transfer %s %s->%s amount %s debited but " \
+                                  "neither credited nor refunded" \
+                                  % ((k,) + transfers[k]))
+        return [debits[k] if failed(debits[k]) else
+                credits[k] if failed(credits[k]) else
+                (debits[k], credits[k]) for k in range(len(transfers))]
 
+    def closeAccount(self, accNum):
+        def write(session):
+            return session.query(Account).filter_by(number=accNum).delete()
+        def removeStripes(session):
+            return session.query(AccountStripe).filter_by(number=accNum) \
+                                               .delete()
+        res = 1
+        try:
+            if self.commitWrite(shardOf(accNum), write,
+                                lambda n: self.cache.invalidate(accNum)):
+                res = 0
+                self.logger.debug('Account (%s) is removed' % accNum)
+                if accNum in self.hot:
+                    for shard in range(SHARDS):
+                        self.commitWrite(shard, removeStripes,
+                                         lambda n: None)
+        except Exception as error:
+            self.logger.error(error)
+        return res
+
+    def getAccountsPage(self, after, limit):
+        """Up to limit accounts with numbers above after, in number order.
+
+        Paging by the last number seen rather than by offset reads only
+        the rows of the page, whatever the size of the table. Each shard
+        gives its first limit accounts, of which the first limit are
+        kept."""
+        try:
+            accounts = sorted((a for session in sessions for a in
+                               session.query(Account)
+                                      .filter(Account.number > after)
+                                      .order_by(Account.number)
+                                      .limit(limit)),
+                              key=lambda a: a.number)[:limit]
+            self.logger.debug('Accounts after (%s) are retrieved' % after)
+            return self.withStripes([self.to_json(account)
+                                     for account in accounts])
+        except Exception as error:
+            for session in sessions:
+                session.rollback()
+            self.logger.error(error)
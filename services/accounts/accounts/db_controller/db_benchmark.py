@@ -0,0 +1,163 @@
+#!flask/bin/python
+"""Contention benchmark of the accounts database.
+
+Many worker processes change the balance of the same accounts at once.
+The final balances show whether updates were lost, the elapsed time the
+throughput. The update workload adds 1 to one account through
+dbCtrl.updateAccount; --naive runs the former read-modify-write instead,
+--stripes K makes it a hot account striped over K rows (see dbCtrl).
+The transfer workload moves 1 back and forth between two accounts through
+dbCtrl.transfer, the accounts side of a payment; with --pairs the workers
+share that many pairs of accounts, each pair in one shard (see
+ACCOUNTS_SHARDS). --profiles runs the workload once per SQLite profile
+(see general.sqlitePragmas).
+Run from the service directory on a scratch volume:
+
+    ACCOUNTS_DATAVOL=/tmp/accountsvol python -m db_controller.db_benchmark \\
+        --workload transfer --profiles fast,balanced,durable
+"""
+import os
+import time
+import logging
+import argparse
+from multiprocessing import Pool
+
+from db_controller import db, dbCtrl, db_create, db_migrate, engines, \
+                          sessions, shardOf, SHARDS
+from db_controller.models import Account
+
+
+logger = logging.getLogger()
+
+
+def naiveUpdate(accNum, amount):
+    """updateAccount as it was: SELECT, add in Python, write back."""
+    try:
+        a = Account.query.filter_by(number=accNum).first()
+        a.balance += amount
+        db.session.commit()
+        return a.balance
+    except Exception as error:
+        db.session.rollback()
+        logger.error(error)
+
+
+def dispose():
+    for session in sessions:
+        session.remove()
+    for engine in engines:
+        engine.dispose()
+
+
+def worker(args):
+    k, direction, accNums, updates, workload, stripes = args
+    # Connections must not be shared with the parent process
+    dispose()
+    ctrl = hotCtrl(accNums, stripes)
+    applied = 0
+    for i in range(updates):
+        if workload == 'naive':
+            res = naiveUpdate(accNums[0], 1)
+        elif workload == 'update':
+            res = ctrl.updateAccount(accNums[0], 1)
+        else:
+            fromAccNum, toAccNum = accNums if direction > 0 \
+                                   else reversed(accNums)
+            res = ctrl.transfer(fromAccNum, toAccNum, 1)
+        if res is not None:
+            applied += 1
+    dispose()
+    return applied
+
+
+def hotCtrl(accNums, stripes):
+    """A dbCtrl to which accNums are hot if stripes is set."""
+    if not stripes:
+        return dbCtrl(logger)
+    return dbCtrl(logger, hotAccounts=accNums, stripes=stripes)
+
+
+def run(workload, workers, updates, pairs, stripes):
+    """Run the workload on new accounts; returns the number of changes
+    applied, the elapsed time and the number of changes lost."""
+    ctrl = dbCtrl(logger)
+    balance = 0 if workload != 'transfer' else workers * updates
+    # New accounts go to the shards in turn; pair p is made of two accounts
+    # of shard p modulo SHARDS
+    byShard = [[] for i in range(SHARDS)]
+    for i in range(2 * pairs * SHARDS):
+        accNum = ctrl.createAccountForUserId(0, balance)
+        byShard[shardOf(accNum)].append(accNum)
+    accPairs = [tuple(byShard[p % SHARDS][2 * (p // SHARDS):][:2])
+                for p in range(pairs)]
+    dispose()
+
+    # Worker k uses pair k modulo pairs, in both directions
+    tasks = [(k, 1 if (k // pairs) % 2 else -1, accPairs[k % pairs], updates,
+              workload, stripes) for k in range(workers)]
+    pool = Pool(workers)
+    start = time.time()
+    applied = pool.map(worker, tasks)
+    elapsed = time.time() - start
+    pool.close()
+    pool.join()
+
+    lost = 0
+    for pair in accPairs:
+        ctrl = hotCtrl(pair, stripes)
+        balances = [ctrl.getAccountByNum(n, json=True)['balance']
+                    for n in pair]
+        if workload == 'transfer':
+            moved = sum(direction * n for (k, direction, p, u, w, s), n
+                        in zip(tasks, applied) if p == pair)
+            lost += abs(moved - (balances[1] - balance))
+        else:
+            lost += sum(n for (k, d, p, u, w, s), n in zip(tasks, applied)
+                        if p == pair) - balances[0]
+    dispose()
+    return sum(applied), elapsed, lost
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-w', '--workers', type=int, default=8)
+    parser.add_argument('-n', '--updates', type=int, default=500,
+                        help='updates per worker')
+    parser.add_argument('--workload', choices=['update', 'transfer'],
+                        default='update')
+    parser.add_argument('--pairs', type=int, default=1,
+                        help='pairs of accounts shared by the workers')
+    parser.add_argument('--stripes', type=int, default=0,
+                        help='stripe the accounts over that many rows')
+    parser.add_argument('--naive', action='store_true',
+                        help='read-modify-write instead of a single UPDATE')
+    parser.add_argument('--profiles',
+                        help='comma separated SQLite profiles to compare')
+    args = parser.parse_args()
+    workload = 'naive' if args.naive else args.workload
+
+    if not db_create.isDBVolume():
+        print("Missing volume %s" % db_create.DATAVOL)
+        return
+    if not db_create.isDBfile():
+        db_create.main()
+        db_migrate.main()
+    db_create.createShards()
+
+    profiles = args.profiles.split(',') if args.profiles else [None]
+    for profile in profiles:
+        if profile:
+            # Read by the workers' connections, see general.sqlitePragmas
+            os.environ['ACCOUNTS_SQLITE_PROFILE'] = profile
+        applied, elapsed, lost = run(workload, args.workers, args.updates,
+                                     args.pairs, args.stripes)
+        print("%-10s %s: %d shards, %d stripes, %d workers, %d updates " \
+              "applied in %.2fs = %.0f updates/s, %d lost" \
+              % (profile or '', workload, SHARDS, args.stripes, args.workers,
+                 applied, elapsed, applied / elapsed, lost))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -1,10 +1,18 @@
-import os.path
+import os
 
-DATAVOL = "/accountsvol"
+# The volume can be moved, e.g. to run db_benchmark outside of Docker
+DATAVOL = os.getenv('ACCOUNTS_DATAVOL', "/accountsvol")
 # Path to the DB file.
 SQLALCHEMY_DATABASE_URI_SHORT = os.path.join(DATAVOL, 'accounts.db')
 # SQLLite uri required by the Flask-SQLAlchemy extension.
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + SQLALCHEMY_DATABASE_URI_SHORT
+# Number of database files the accounts are spread over, see db_controller.
+# It cannot be changed once accounts exist.
+SHARDS = int(os.getenv('ACCOUNTS_SHARDS', 1))
+# The first shard is the database above, shard i is accounts_<i>.db
+SQLALCHEMY_BINDS = dict(('shard%d' % i, 'sqlite:///' + os.path.join(
+                                            DATAVOL, 'accounts_%d.db' % i))
+                        for i in range(1, SHARDS))
 # Path to the SQLAlchemy-migrate file
 SQLALCHEMY_MIGRATE_REPO = os.path.join(DATAVOL, 'db_repository')
 # To turn off the Flask-SQLAlchemy event system and disable the
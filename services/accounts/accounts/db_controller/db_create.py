@@ -7,7 +7,7 @@ from migrate.versioning import api
 from db_controller.db_config import SQLALCHEMY_DATABASE_URI
 from db_controller.db_config import SQLALCHEMY_DATABASE_URI_SHORT, DATAVOL
 from db_controller.db_config import SQLALCHEMY_MIGRATE_REPO
-from db_controller import db
+from db_controller import db, engines
 
 
 def isDBVolume():
@@ -42,5 +42,12 @@ def main():
 	    api.version_control(SQLALCHEMY_DATABASE_URI, SQLALCHEMY_MIGRATE_REPO, api.version(SQLALCHEMY_MIGRATE_REPO))
 
 
+def createShards():
+	# The tables of the other shards, and tables added to the models since
+	# the first one was created and migrated by main
+	for engine in engines:
+		db.metadata.create_all(bind=engine)
+
+
 if __name__ == '__main__':
 	main()
\ No newline at end of file
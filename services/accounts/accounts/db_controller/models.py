@@ -8,9 +8,19 @@ from db_controller import db
 
 class Account(db.Model):
     number = db.Column(db.Integer, primary_key = True)
-    user_id = db.Column(db.Integer) 
+    user_id = db.Column(db.Integer, index=True)
     balance = db.Column(db.Integer)
 
     def __repr__(self):
         return '<Account number %r>' % (self.number)
 
+
+class AccountStripe(db.Model):
+    """Part of the balance of a hot account, see dbCtrl. The balance of
+    an account is its own plus that of its stripes."""
+    number = db.Column(db.Integer, primary_key = True, autoincrement=False)
+    stripe = db.Column(db.Integer, primary_key = True, autoincrement=False)
+    balance = db.Column(db.Integer, default=0)
+
+    def __repr__(self):
+        return '<AccountStripe %r of account %r>' % (self.stripe, self.number)
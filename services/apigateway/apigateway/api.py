@@ -1,59 +1,24 @@
 import os
 
-from flask import Flask, request, abort
-from requests.exceptions import ConnectionError
+from flask import Flask, request, abort, make_response
 from werkzeug.exceptions import NotFound, ServiceUnavailable
 
-from general import log, getEnvVar, isDocker, niceJson, allLinks
+from general import log, getEnvVar, niceJson, allLinks
 
 
 # Use the name of the current directory as a service type
 serviceType = os.path.basename(os.getcwd())
 logger = log(serviceType).logger
 
-
-if getEnvVar('MTLS', False):
-    PROT = 'https'
-else:
-    PROT = 'http'
-
-# Setup Flask
-# FLASK_DEBUG = getEnvVar('FLASK_DEBUG', False)
-# FLASK_HOST = '0.0.0.0'
-if isDocker():
-    FLASK_PORT = 80
-    USERS_SERVICE_URL        = '%s://%s:%s/' % (PROT, "users", 80)
-    ACCOUNTS_SERVICE_URL     = '%s://%s:%s/' % (PROT, "accounts", 80)
-    TRANSACTIONS_SERVICE_URL = '%s://%s:%s/' % (PROT, "transactions", 80)
-    PAYMENT_SERVICE_URL      = '%s://%s:%s/' % (PROT, "payment", 80)
-else:
-    FLASK_PORT = 80
-    USERS_SERVICE_URL        = '%s://%s:%s/' % (PROT, '0.0.0.0', 9081)
-    ACCOUNTS_SERVICE_URL     = '%s://%s:%s/' % (PROT, '0.0.0.0', 9082)
-    TRANSACTIONS_SERVICE_URL = '%s://%s:%s/' % (PROT, '0.0.0.0', 9083)
-    PAYMENT_SERVICE_URL      = '%s://%s:%s/' % (PROT, '0.0.0.0', 9084)
+import gateway
+from gateway import FLASK_PORT, DownstreamError, requests
 
 
 # Setup MiSSFire
 try:
-    #PROT = 'http'
-    if getEnvVar('MTLS', False) or getEnvVar('TOKEN', False):
-        from MiSSFire import Requests
-        requests = Requests()
-
-        # if getEnvVar('MTLS', False):
-        #     PROT = 'https'
-
-        if getEnvVar('TOKEN', False):
-            from MiSSFire import jwt_conditional
-        else:
-            def jwt_conditional(reqs):
-                def real_decorator(f):
-                    return f
-                return real_decorator
+    if getEnvVar('TOKEN', False):
+        from MiSSFire import jwt_conditional
     else:
-        from general import Requests
-        requests = Requests()
         def jwt_conditional(reqs):
             def real_decorator(f):
                 return f
@@ -66,30 +31,46 @@ except ImportError:
 app = Flask(__name__)
 
 
+@app.before_request
+def admit():
+    """Rate limit the request before it reaches any downstream service."""
+    retryAfter = gateway.admit(request.method, request.path,
+                               gateway.clientAddr(
+                                   request.remote_addr,
+                                   request.headers.get('X-Forwarded-For')))
+    if retryAfter:
+        response = niceJson({"msg": "Too many requests"}, 429)
+        response.headers['Retry-After'] = str(retryAfter)
+        return response
+
+
+@app.errorhandler(DownstreamError)
+def downstreamError(e):
+    return ServiceUnavailable(str(e))
+
+
+def relay(res):
+    """Form the gateway response from a downstream response."""
+    body, contentType = gateway.responseBody(res)
+    response = make_response(body, res.status_code)
+    response.headers['Content-type'] = contentType
+    return response
+
+
 
 @app.route("/", methods=['GET'])
 def hello():
     return niceJson({"subresource_uris": allLinks(app)}, 200)
 
 
+@app.route("/stats", methods=['GET'])
+def stats():
+    return niceJson(gateway.stats(), 200)
+
+
 @app.route("/users", methods=['GET'])
 def userInfo():
-    username = request.args.get('username')
-    try:
-        url = USERS_SERVICE_URL + 'users'
-        if username:
-            url += '?username=%s' % username
-        res = requests.get(url)
-    except ConnectionError as e:
-        raise ServiceUnavailable("Users service connection error: %s."%e)
-
-    if int(res.status_code) >= 400:
-        logger.warning("Cannot get user information, status %s" \
-                       % (res.status_code))
-        resp = res.text
-    else:
-        resp = res.json()
-    return niceJson(resp, res.status_code)
+    return relay(gateway.getUser(request.args.get('username')))
 
 
 @app.route("/users", methods=['POST'])
@@ -97,78 +78,35 @@ def userEnroll():
     if not request.json or not 'username' in request.json or \
                            not 'pwd' in request.json:
         abort(400)
-    username = request.json['username']
-    pwd = request.json['pwd']
-    try:
-        url = USERS_SERVICE_URL + 'users'
-        payload = {'username':username, 'pwd':pwd}
-        res = requests.post(url, json=payload)
-    except ConnectionError as e:
-        raise ServiceUnavailable("Users service connection error: %s."%e)
-
-    if int(res.status_code) >= 400:
-        logger.warning("Cannot register user %s, resp %s, status code %s" \
-                       % (username, res.text, res.status_code))
-        resp = res.text
-    else:
-        resp = res.json()
-    return niceJson(resp, res.status_code)
+    return relay(gateway.enrollUser(request.json['username'],
+                                    request.json['pwd']))
 
 
 @app.route("/users/<userID>/accounts", methods=['GET'])
 @jwt_conditional(requests)
 def accountsInfo(userID):
-    try:
-        url = ACCOUNTS_SERVICE_URL + 'accounts' + '?userID=%s' % userID
-        res = requests.get(url)
-    except ConnectionError as e:
-        raise ServiceUnavailable("Accounts service connection error: %s."%e)
-
-    if int(res.status_code) >= 400:
-        logger.warning("No accounts found for userID %s, status %s" \
-                       % (userID, res.status_code))
-        resp = res.text
-    else:
-        resp = res.json()
-    return niceJson(resp, res.status_code)
+    return relay(gateway.getAccounts(userID))
 
 
 @app.route("/users/<userID>/accounts", methods=['POST'])
 @jwt_conditional(requests)
 def openAccount(userID):
-    try:
-        url = ACCOUNTS_SERVICE_URL + 'accounts'
-        payload = {'userID':userID}
-        res = requests.post(url, json=payload)
-    except ConnectionError as e:
-        raise ServiceUnavailable("Accounts service connection error: %s."%e)
-
-    if int(res.status_code) >= 400:
-        logger.warning("Cannot open account for userID %s, status code %s" \
-                       % (userID, res.status_code))
-        resp = res.text
-    else:
-        resp = res.json()
-    return niceJson(resp, res.status_code)
+    return relay(gateway.openAccount(userID))
 
 
 @app.route("/users/<userID>/accounts/<accNum>/transactions", methods=['GET'])
 @jwt_conditional(requests)
-def transactionsInfo(accNum):
-    try:
-        url = TRANSACTIONS_SERVICE_URL + 'transactions' + '?accNum=%s'%accNum
-        res = requests.get(url)
-    except ConnectionError as e:
-        raise ServiceUnavailable(
-              "Transactions service connection error: %s." % e)
-
-    if int(res.status_code) >= 400:
-        logger.warning("No transactions found for accNum %s, status %s" \
-                       % (accNum, res.status_code))
-        resp = res.text
-    else:
-        resp = res.json()
-    return niceJson(resp, res.status_code)
+def transactionsInfo(userID, accNum):
+    return relay(gateway.getTransactions(accNum))
+
+
+@app.route("/users/<userID>/overview", methods=['GET'])
+@jwt_conditional(requests)
+def userOverview(userID):
+    res, overview = gateway.getOverview(userID)
+    if overview is None:
+        return relay(res)
+    return niceJson(overview, 200)
 
 
 @app.route("/users/<userID>/pay", methods=['POST'])
@@ -178,26 +116,25 @@ def pay(userID):
                         or not 'toAccNum' in request.json
                         or not 'amount' in request.json):
         abort(400)
-    fromAccNum = request.json['fromAccNum']
-    toAccNum = request.json['toAccNum']
-    amount = request.json['amount']
-    try:
-        url = PAYMENT_SERVICE_URL + 'pay'
-        payload = {'fromAccNum':fromAccNum, 'toAccNum':toAccNum, 
-                   'amount':amount}
-        res = requests.post(url, json=payload)
-    except ConnectionError as e:
-        raise ServiceUnavailable("Payment service connection error: %s."%e)
-
-    if int(res.status_code) >= 400:
-        logger.warning("Cannot execute payment from " + \
-                       "%s to %s amount %s, resp %s, status code %s" \
-                       % (fromAccNum, toAccNum, amount, res.text, 
-                          res.status_code))
-        resp = res.text
-    else:
-        resp = res.json()
-    return niceJson(resp, res.status_code)
+    return relay(gateway.pay(request.json['fromAccNum'],
+                             request.json['toAccNum'],
+                             request.json['amount'],
+                             request.args.get('async') == 'true'))
+
+
+@app.route("/users/<userID>/payments/<paymentID>", methods=['GET'])
+@jwt_conditional(requests)
+def paymentInfo(userID, paymentID):
+    return relay(gateway.getPayment(paymentID))
+
+
+@app.route("/users/<userID>/pay/batch", methods=['POST'])
+@jwt_conditional(requests)
+def payBatch(userID):
+    if not request.json or not 'payments' in request.json or \
+       not gateway.isValidBatch(request.json['payments']):
+        abort(400)
+    return relay(gateway.payBatch(request.json['payments']))
 
 
 @app.route("/login", methods=['POST'])
@@ -205,22 +142,8 @@ def login():
     if not request.json or not 'username' in request.json or \
                            not 'pwd' in request.json:
         abort(400)
-    username = request.json['username']
-    pwd = request.json['pwd']
-    try:
-        url = USERS_SERVICE_URL + 'users/login'
-        payload = {'username':username, 'pwd':pwd}
-        res = requests.post(url, json=payload)
-    except ConnectionError as e:
-        raise ServiceUnavailable("Users service connection error: %s."%e)
-
-    if int(res.status_code) >= 400:
-        logger.warning("Cannot login user %s, resp %s, status code %s" \
-                       % (username, res.text, res.status_code))
-        resp = res.text
-    else:
-        resp = res.json()
-    return niceJson(resp, res.status_code)
+    return relay(gateway.login(request.json['username'],
+                               request.json['pwd']))
 
 
 @app.route("/logout", methods=['POST'])
@@ -232,11 +155,7 @@ def logout():
 # All APIs provided by this application, automatically generated
 LOCAL_APIS = allLinks(app)
 # All external APIs that this application relies on, manually created
-KNOWN_REMOTE_APIS = [USERS_SERVICE_URL + "users",
-                    ACCOUNTS_SERVICE_URL + "accounts",
-                    TRANSACTIONS_SERVICE_URL + "transactions",
-                    PAYMENT_SERVICE_URL + "pay",
-                    USERS_SERVICE_URL + "users/login"]
+KNOWN_REMOTE_APIS = gateway.KNOWN_REMOTE_APIS
 
 
 # def main():
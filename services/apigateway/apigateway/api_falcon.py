@@ -1,149 +1,167 @@
-import json
+import os
 
 import falcon
-from requests import codes
-from requests.exceptions import ConnectionError
 
-from general import log, getEnvVar, isDocker
+from general import log
 from falcon_app_template import app
 
 
-SERVICE_TYPE = "apigateway"
+# Use the name of the current directory as a service type
+serviceType = os.path.basename(os.getcwd())
+logger = log(serviceType).logger
 
-logger = log(SERVICE_TYPE).logger
+import gateway
+from gateway import FLASK_PORT, DownstreamError
 
-if getEnvVar('MTLS', False):
-    PROT = 'https'
-    from muServSec import ServiceCert, Requests
-    serviceCert = ServiceCert(logger, SERVICE_TYPE, True)
-    requests = Requests(serviceCert)
-else:
-    PROT = 'http'
-    import requests
 
+def relay(resp, res):
+    """Form the gateway response from a downstream response."""
+    body, contentType = gateway.responseBody(res)
+    resp.data = body
+    resp.content_type = contentType
+    resp.status = falcon.get_http_status(res.status_code)
 
-if isDocker():
-    USERS_SERVICE_URL        = '%s://%s:%s/' % (PROT, "users", 80)
-    ACCOUNTS_SERVICE_URL     = '%s://%s:%s/' % (PROT, "accounts", 80)
-    TRANSACTIONS_SERVICE_URL = '%s://%s:%s/' % (PROT, "transactions", 80)
-    PAYMENT_SERVICE_URL      = '%s://%s:%s/' % (PROT, "payment", 80)
-else:
-    USERS_SERVICE_URL        = '%s://%s:%s/' % (PROT, '0.0.0.0', 9081)
-    ACCOUNTS_SERVICE_URL     = '%s://%s:%s/' % (PROT, '0.0.0.0', 9082)
-    TRANSACTIONS_SERVICE_URL = '%s://%s:%s/' % (PROT, '0.0.0.0', 9083)
-    PAYMENT_SERVICE_URL      = '%s://%s:%s/' % (PROT, '0.0.0.0', 9084)
 
+def document(resp, doc):
+    resp.data = gateway.documentBody(doc)
+    resp.content_type = 'application/json'
+    resp.status = falcon.HTTP_200
 
 
-class LoginResource(object):
-    def on_post(self, req, resp):
-        try:
-            username = req.get_param('username')
-            pwd = req.get_param('pwd')
-        except KeyError:
-            raise falcon.HTTPMissingParam(
-                'Missing username or pwd',
-                'Both username and pwd must be submitted in the request body.')
-        try: 
-            url = USERS_SERVICE_URL + 'getUser'
-            payload = {'username':username, 'pwd':pwd}
-            res = requests.post(url, json=payload)
-
-            if res.status_code != codes.ok:
-                raise NotFound(
-                    "Cannot login user %s, resp %s, status code %s" \
-                    % (username, res.text, res.status_code))
-            else:
-                resp.context = res.json()
-                resp.status = falcon.HTTP_200
-        except ConnectionError as e:
-            raise HTTPBadRequest("Users service connection error: %s."%e)
+def requireFields(req, *fields):
+    """The JSON request body, provided it has all the fields."""
+    doc = req.context.get('doc')
+    if not isinstance(doc, dict) or any(f not in doc for f in fields):
+        raise falcon.HTTPBadRequest('Missing parameters',
+                                    '%s must be submitted in the request '
+                                    'body.' % ', '.join(fields))
+    return doc
 
 
-class UsersResource(object):
-    def on_post(self, req, resp):
-        try:
-            username = req.get_param('username')
-            pwd = req.get_param('pwd')
-        except KeyError:
-            raise falcon.HTTPMissingParam(
-                'Missing username or pwd',
-                'Both username and pwd must be submitted in the request body.')
-        try: 
-            url = USERS_SERVICE_URL + 'addUser'
-            payload = {'username':username, 'pwd':pwd}
-            res = requests.post(url, json=payload)
-
-            if res.status_code != codes.ok:
-                raise NotFound(
-                    "Cannot register user %s, resp %s, status code %s" \
-                    % (username, res.text, res.status_code))
-            else:
-                resp.context = res.json()
-                resp.status = falcon.HTTP_201
-        except ConnectionError as e:
-            raise HTTPBadRequest("Users service connection error: %s."%e)
+def admit(req, resp, resource, params):
+    """Rate limit the request before it reaches any downstream service."""
+    retryAfter = gateway.admit(req.method, req.path,
+                               gateway.clientAddr(
+                                   req.remote_addr,
+                                   req.get_header('X-Forwarded-For')))
+    if retryAfter:
+        raise falcon.HTTPTooManyRequests('Too many requests',
+                                         'Retry in %s seconds.' % retryAfter,
+                                         retryAfter)
 
 
-class AccountsResource(object):
-    def on_post(self, req, resp, userID):
-        try: 
-            url = ACCOUNTS_SERVICE_URL + 'createAccount'
-            payload = {'user_id':userID}
-            res = requests.post(url, json=payload)
-
-            if res.status_code != codes.ok:
-                raise NotFound(
-                    "Cannot open account for userID %s, status code %s" \
-                    % (userID, res.status_code))
-            else:
-                resp.context = res.json()
-                resp.status = falcon.HTTP_201
-        except ConnectionError as e:
-            raise HTTPBadRequest("Accounts service connection error: %s."%e)
+def downstreamError(ex, req, resp, params):
+    raise falcon.HTTPServiceUnavailable('Service unavailable', str(ex), 1)
 
 
-class PayResource(object):
+
+class IndexResource(object):
+    def on_get(self, req, resp):
+        document(resp, {"subresource_uris": [route for route, r in ROUTES]})
+
+
+class StatsResource(object):
+    def on_get(self, req, resp):
+        document(resp, gateway.stats())
+
+
+@falcon.before(admit)
+class UsersResource(object):
     def on_get(self, req, resp):
-        resp.data = "hello world"
-        resp.status = falcon.HTTP_200
+        relay(resp, gateway.getUser(req.get_param('username')))
 
     def on_post(self, req, resp):
-        try:
-            fromAccNum = req.get_param('fromAccNum')
-            toAccNum = req.get_param('toAccNum')
-            amount = req.get_param('amount')
-        except KeyError:
-            raise falcon.HTTPMissingParam(
-                'Missing fromAccNum, toAccNum or amount',
-                'fromAccNum, toAccNum and amount are required.')
-        try:
-            url = PAYMENT_SERVICE_URL + 'pay'
-            payload = {'fromAccNum':fromAccNum, 'toAccNum':toAccNum, 
-                       'amount':amount}
-            res = requests.post(url, json=payload)
+        doc = requireFields(req, 'username', 'pwd')
+        relay(resp, gateway.enrollUser(doc['username'], doc['pwd']))
 
-            if res.status_code != codes.ok:
-                raise NotFound("Cannot execute payment from " + \
-                           "%s to %s amount %s, resp %s, status code %s" \
-                           % (fromAccNum, toAccNum, amount, res.text, 
-                              res.status_code))
-            else:
-                resp.context = res.json()
-                resp.status = falcon.HTTP_200
-        except ConnectionError as e:
-            raise HTTPBadRequest("Payment service connection error: %s."%e)
 
+@falcon.before(admit)
+class LoginResource(object):
+    def on_post(self, req, resp):
+        doc = requireFields(req, 'username', 'pwd')
+        relay(resp, gateway.login(doc['username'], doc['pwd']))
+
+
+@falcon.before(admit)
+class LogoutResource(object):
+    def on_post(self, req, resp):
+        raise falcon.HTTPNotImplemented('Not implemented',
+                                        'Logout is not supported yet.')
+
+
+@falcon.before(admit)
+class AccountsResource(object):
+    def on_get(self, req, resp, userID):
+        relay(resp, gateway.getAccounts(userID))
 
+    def on_post(self, req, resp, userID):
+        relay(resp, gateway.openAccount(userID))
 
 
-app.add_route('/login', LoginResource())
-app.add_route('/users', UsersResource())
-app.add_route('/users/{userID}/accounts', AccountsResource())
-app.add_route('/pay', PayResource())
+@falcon.before(admit)
+class TransactionsResource(object):
+    def on_get(self, req, resp, userID, accNum):
+        relay(resp, gateway.getTransactions(accNum))
 
 
+@falcon.before(admit)
+class OverviewResource(object):
+    def on_get(self, req, resp, userID):
+        res, overview = gateway.getOverview(userID)
+        if overview is None:
+            relay(resp, res)
+        else:
+            document(resp, overview)
 
 
+@falcon.before(admit)
+class PayResource(object):
+    def on_post(self, req, resp, userID):
+        doc = requireFields(req, 'fromAccNum', 'toAccNum', 'amount')
+        relay(resp, gateway.pay(doc['fromAccNum'], doc['toAccNum'],
+                                doc['amount'],
+                                req.get_param('async') == 'true'))
 
 
+@falcon.before(admit)
+class PaymentResource(object):
+    def on_get(self, req, resp, userID, paymentID):
+        relay(resp, gateway.getPayment(paymentID))
+
+
+@falcon.before(admit)
+class PayBatchResource(object):
+    def on_post(self, req, resp, userID):
+        doc = requireFields(req, 'payments')
+        if not gateway.isValidBatch(doc['payments']):
+            raise falcon.HTTPBadRequest('Invalid batch',
+                                        'payments must be a list of 1 to '
+                                        '%s payments.' \
+                                        % gateway.MAX_BATCH_SIZE)
+        relay(resp, gateway.payBatch(doc['payments']))
+
+
+
+# Same routes as the Flask gateway in api.py
+ROUTES = [('/', IndexResource()),
+          ('/stats', StatsResource()),
+          ('/users', UsersResource()),
+          ('/login', LoginResource()),
+          ('/logout', LogoutResource()),
+          ('/users/{userID}/accounts', AccountsResource()),
+          ('/users/{userID}/accounts/{accNum}/transactions',
+           TransactionsResource()),
+          ('/users/{userID}/overview', OverviewResource()),
+          ('/users/{userID}/pay', PayResource()),
+          ('/users/{userID}/pay/batch', PayBatchResource()),
+          ('/users/{userID}/payments/{paymentID}', PaymentResource())]
+
+for route, resource in ROUTES:
+    app.add_route(route, resource)
+app.add_error_handler(DownstreamError, downstreamError)
+
+
+# All APIs provided by this application
+LOCAL_APIS = [route for route, resource in ROUTES]
+# All external APIs that this application relies on, manually created
+KNOWN_REMOTE_APIS = gateway.KNOWN_REMOTE_APIS
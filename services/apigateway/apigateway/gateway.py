@@ -0,0 +1,372 @@
+"""The framework independent part of the API gateway.
+
+Both gateway front ends, the Flask app in api.py and the Falcon app in
+api_falcon.py, serve their routes with the downstream operations below, so
+caching, request coalescing, fan-out, timeouts and circuit breakers behave
+the same whichever of them is deployed."""
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from requests.exceptions import ConnectionError
+
+from general import getEnvVar, isDocker, json_serial
+from general import serviceClient, serviceRequests
+from cache import TTLCache
+from singleflight import SingleFlight
+from ratelimit import RateLimiter
+
+
+# The service-wide logger set up by general.log
+logger = logging.getLogger()
+
+
+if getEnvVar('MTLS', False):
+    PROT = 'https'
+else:
+    PROT = 'http'
+
+if isDocker():
+    FLASK_PORT = 80
+    USERS_SERVICE_URL        = '%s://%s:%s/' % (PROT, "users", 80)
+    ACCOUNTS_SERVICE_URL     = '%s://%s:%s/' % (PROT, "accounts", 80)
+    TRANSACTIONS_SERVICE_URL = '%s://%s:%s/' % (PROT, "transactions", 80)
+    PAYMENT_SERVICE_URL      = '%s://%s:%s/' % (PROT, "payment", 80)
+else:
+    FLASK_PORT = 80
+    USERS_SERVICE_URL        = '%s://%s:%s/' % (PROT, '0.0.0.0', 9081)
+    ACCOUNTS_SERVICE_URL     = '%s://%s:%s/' % (PROT, '0.0.0.0', 9082)
+    TRANSACTIONS_SERVICE_URL = '%s://%s:%s/' % (PROT, '0.0.0.0', 9083)
+    PAYMENT_SERVICE_URL      = '%s://%s:%s/' % (PROT, '0.0.0.0', 9084)
+
+
+# Setup MiSSFire
+MISSFIRE = getEnvVar('MTLS', False) or getEnvVar('TOKEN', False)
+try:
+    if MISSFIRE:
+        from MiSSFire import Requests
+    else:
+        from general import Requests
+    requests = Requests()
+except ImportError:
+    logger.error("Module MiSSFire is required. Terminating.")
+    exit()
+
+
+# Every downstream service gets its own bounded keep-alive pool, so the
+# greenlets of the gevent worker reuse connections instead of opening one
+# socket per call, and a slow service cannot hog the connections of others.
+# Pools are sized by POOL_MAXSIZE, POOL_BLOCK, POOL_CONNECTIONS, MAX_RETRIES
+# and RETRY_BACKOFF, each of which can be set per service, e.g.
+# ACCOUNTS_POOL_MAXSIZE. MiSSFire manages its own session, which is then
+# shared by all services. On top of the pool each service gets its own
+# timeouts and circuit breaker.
+def downstreamPool(name):
+    if MISSFIRE:
+        return requests
+    return serviceRequests(name)
+
+usersRequests = serviceClient(downstreamPool('users'), 'users')
+accountsRequests = serviceClient(downstreamPool('accounts'), 'accounts')
+transactionsRequests = serviceClient(downstreamPool('transactions'),
+                                     'transactions')
+paymentRequests = serviceClient(downstreamPool('payment'), 'payment')
+downstreams = [usersRequests, accountsRequests, transactionsRequests,
+               paymentRequests]
+
+
+class DownstreamError(Exception):
+    """A downstream service could not be reached, answered to the gateway
+    with a 503 by both front ends."""
+
+
+def call(client, method, url, **kwargs):
+    try:
+        return getattr(client, method)(url, **kwargs)
+    except ConnectionError as e:
+        raise DownstreamError("%s service connection error: %s." \
+                              % (client.name.capitalize(), e))
+
+
+# Relay downstream bodies to the client as received instead of parsing and
+# re-serializing them; the services already answer with the same JSON.
+PASSTHROUGH = getEnvVar('PASSTHROUGH', True)
+
+def responseBody(res):
+    """Body and content type of the gateway response to a downstream
+    response."""
+    if PASSTHROUGH:
+        return res.content, res.headers.get('Content-Type',
+                                            'application/json')
+    if int(res.status_code) >= 400:
+        return documentBody(res.text), 'application/json'
+    return documentBody(res.json()), 'application/json'
+
+def documentBody(doc):
+    """Serialize a document built by the gateway itself."""
+    return json.dumps(doc, sort_keys=True, indent=4, default=json_serial)
+
+
+# Largest number of payments accepted by one batch request
+MAX_BATCH_SIZE = int(getEnvVar('MAX_BATCH_SIZE', 1000))
+
+def isValidBatch(payments):
+    return isinstance(payments, list) and \
+           0 < len(payments) <= MAX_BATCH_SIZE
+
+
+# Cache of downstream responses to read requests. The data only changes on
+# writes that pass through the gateway, which invalidate the affected
+# entries, so the TTLs only bound staleness against other gateway workers.
+# A TTL of 0 disables caching for that route.
+CACHE_SIZE = int(getEnvVar('CACHE_SIZE', 1024))
+CACHE_TTL_USERS = float(getEnvVar('CACHE_TTL_USERS', 30))
+CACHE_TTL_ACCOUNTS = float(getEnvVar('CACHE_TTL_ACCOUNTS', 5))
+CACHE_TTL_TRANSACTIONS = float(getEnvVar('CACHE_TTL_TRANSACTIONS', 5))
+cache = TTLCache(CACHE_SIZE)
+
+# Identical reads that miss the cache at the same time, e.g. many clients
+# polling one account's transactions, share a single downstream request.
+flights = SingleFlight()
+
+def cachedGet(reqs, url, ttl, tagsFn=None):
+    """GET the url from a downstream service through the response cache.
+
+    Only successful responses are cached; tagsFn maps the response to the
+    tags used for invalidation. Concurrent misses for the same url are
+    coalesced, but never across an invalidation, so a read that starts
+    after a write does not get a response fetched before it."""
+    res = cache.get(url)
+    if res is None:
+        generation = cache.generation
+        res = flights.do((url, generation), fetch, reqs, url, ttl, tagsFn,
+                         generation)
+    return res
+
+def fetch(reqs, url, ttl, tagsFn, generation):
+    res = call(reqs, 'get', url)
+    if int(res.status_code) < 400:
+        tags = tagsFn(res) if tagsFn else ()
+        cache.set(url, res, ttl, tags, generation)
+    return res
+
+def accountTag(accNum):
+    return 'accNum:%s' % accNum
+
+def accountsTags(res):
+    return [accountTag(a['accNum']) for a in res.json()]
+
+
+# Downstream calls of one request that do not depend on each other run
+# concurrently on this pool; under the gevent worker its threads are
+# greenlets, so the pool size only bounds the fan-out of a single worker.
+FANOUT_WORKERS = int(getEnvVar('FANOUT_WORKERS', 32))
+fanout = ThreadPoolExecutor(FANOUT_WORKERS)
+
+
+# Admission control in front of all downstream calls, on with
+# RATE_LIMIT=True: every client address gets a token bucket per route
+# class. Requests over the limit are answered with a 429 at once, so that
+# one busy client cannot take over the single worker. The userID in the
+# path is not used, as the client chooses it freely; the address is what
+# the gateway can tell about the client before any token is checked.
+# A rate of 0 lifts the limit of a class.
+# Behind a proxy or load balancer every request comes from its address:
+# RATE_LIMIT_TRUSTED_PROXIES, comma separated addresses, makes the
+# gateway take the client address of requests from these proxies from
+# X-Forwarded-For instead, see clientAddr.
+RATE_LIMIT = getEnvVar('RATE_LIMIT', False)
+RATE_LIMITS = {
+    'read':  (float(getEnvVar('RATE_LIMIT_READ', 100)),
+              float(getEnvVar('RATE_LIMIT_READ_BURST', 200))),
+    'write': (float(getEnvVar('RATE_LIMIT_WRITE', 10)),
+              float(getEnvVar('RATE_LIMIT_WRITE_BURST', 20))),
+    'pay':   (float(getEnvVar('RATE_LIMIT_PAY', 50)),
+              float(getEnvVar('RATE_LIMIT_PAY_BURST', 100)))}
+RATE_LIMIT_KEYS = int(getEnvVar('RATE_LIMIT_KEYS', 10000))
+RATE_LIMIT_TRUSTED_PROXIES = frozenset(
+    addr.strip() for addr in getEnvVar('RATE_LIMIT_TRUSTED_PROXIES',
+                                       '').split(',') if addr.strip())
+limiter = RateLimiter(RATE_LIMITS if RATE_LIMIT else {}, RATE_LIMIT_KEYS)
+
+# Routes that are never limited
+UNLIMITED_ROUTES = ['/', '/stats']
+
+def routeClass(method, path):
+    if path in UNLIMITED_ROUTES:
+        return None
+    if path.rstrip('/').endswith(('/pay', '/pay/batch')):
+        return 'pay'
+    if method in ('GET', 'HEAD'):
+        return 'read'
+    return 'write'
+
+def clientAddr(remoteAddr, forwardedFor=None):
+    """The address of the client of a request from remoteAddr, with the
+    X-Forwarded-For header forwardedFor.
+
+    Each proxy appends the address it got the request from to the header.
+    Of a request from a trusted proxy, the client is thus the last address
+    that is not a trusted proxy, the first one unless the client sent a
+    header of its own; the addresses before it are the client's to choose."""
+    if remoteAddr not in RATE_LIMIT_TRUSTED_PROXIES or not forwardedFor:
+        return remoteAddr
+    hops = [hop.strip() for hop in forwardedFor.split(',') if hop.strip()]
+    for hop in reversed(hops):
+        if hop not in RATE_LIMIT_TRUSTED_PROXIES:
+            return hop
+    return hops[0] if hops else remoteAddr
+
+def admit(method, path, clientAddr):
+    """Return 0 if the request may proceed, otherwise the number of seconds
+    after which the client may retry. Rejections are only counted, not
+    logged, as logging them would add work under overload."""
+    return limiter.admit(clientAddr, routeClass(method, path))
+
+
+
+def getUser(username=None):
+    url = USERS_SERVICE_URL + 'users'
+    if username:
+        url += '?username=%s' % username
+    res = cachedGet(usersRequests, url, CACHE_TTL_USERS)
+    if int(res.status_code) >= 400:
+        logger.warning("Cannot get user information, status %s" \
+                       % (res.status_code))
+    return res
+
+
+def enrollUser(username, pwd):
+    url = USERS_SERVICE_URL + 'users'
+    payload = {'username':username, 'pwd':pwd}
+    res = call(usersRequests, 'post', url, json=payload)
+    cache.invalidate(url)
+    cache.invalidate(url + '?username=%s' % username)
+    if int(res.status_code) >= 400:
+        logger.warning("Cannot register user %s, resp %s, status code %s" \
+                       % (username, res.text, res.status_code))
+    return res
+
+
+def login(username, pwd):
+    url = USERS_SERVICE_URL + 'users/login'
+    payload = {'username':username, 'pwd':pwd}
+    res = call(usersRequests, 'post', url, json=payload)
+    if int(res.status_code) >= 400:
+        logger.warning("Cannot login user %s, resp %s, status code %s" \
+                       % (username, res.text, res.status_code))
+    return res
+
+
+def getAccounts(userID):
+    url = ACCOUNTS_SERVICE_URL + 'accounts' + '?userID=%s' % userID
+    res = cachedGet(accountsRequests, url, CACHE_TTL_ACCOUNTS, accountsTags)
+    if int(res.status_code) >= 400:
+        logger.warning("No accounts found for userID %s, status %s" \
+                       % (userID, res.status_code))
+    return res
+
+
+def openAccount(userID):
+    url = ACCOUNTS_SERVICE_URL + 'accounts'
+    payload = {'userID':userID}
+    res = call(accountsRequests, 'post', url, json=payload)
+    cache.invalidate(url + '?userID=%s' % userID)
+    if int(res.status_code) >= 400:
+        logger.warning("Cannot open account for userID %s, status code %s" \
+                       % (userID, res.status_code))
+    return res
+
+
+def getTransactions(accNum):
+    url = TRANSACTIONS_SERVICE_URL + 'transactions' + '?accNum=%s' % accNum
+    res = cachedGet(transactionsRequests, url, CACHE_TTL_TRANSACTIONS,
+                    lambda res: [accountTag(accNum)])
+    if int(res.status_code) >= 400:
+        logger.warning("No transactions found for accNum %s, status %s" \
+                       % (accNum, res.status_code))
+    return res
+
+
+def getOverview(userID):
+    """All accounts of the user together with their transactions.
+
+    The transactions of all accounts are fetched in parallel, so the
+    latency is bounded by the slowest call rather than their sum. Returns
+    the failed downstream response, or None and the overview document."""
+    res = getAccounts(userID)
+    if int(res.status_code) >= 400:
+        return res, None
+
+    accounts = res.json()
+    results = fanout.map(getTransactions, [a['accNum'] for a in accounts])
+    for account, res in zip(accounts, results):
+        if int(res.status_code) >= 400:
+            account['transactions'] = None
+        else:
+            account['transactions'] = res.json()
+    return None, {'userID': userID, 'accounts': accounts}
+
+
+def pay(fromAccNum, toAccNum, amount, queued=False):
+    """Execute a payment, or with queued only have the payment service
+    accept it (202) and execute it later; see getPayment."""
+    url = PAYMENT_SERVICE_URL + 'pay'
+    if queued:
+        url += '?async=true'
+    payload = {'fromAccNum':fromAccNum, 'toAccNum':toAccNum,
+               'amount':amount}
+    res = call(paymentRequests, 'post', url, json=payload)
+    # Balances and transaction lists of both accounts are now stale; queued
+    # payments change them later, which the cache TTLs bound
+    cache.invalidateTag(accountTag(fromAccNum))
+    cache.invalidateTag(accountTag(toAccNum))
+    if int(res.status_code) >= 400:
+        logger.warning("Cannot execute payment from " + \
+                       "%s to %s amount %s, resp %s, status code %s" \
+                       % (fromAccNum, toAccNum, amount, res.text,
+                          res.status_code))
+    return res
+
+
+def getPayment(paymentID):
+    url = PAYMENT_SERVICE_URL + 'payments/%s' % paymentID
+    res = call(paymentRequests, 'get', url)
+    if int(res.status_code) >= 400:
+        logger.warning("Cannot get payment %s, status %s" \
+                       % (paymentID, res.status_code))
+    return res
+
+
+def payBatch(payments):
+    url = PAYMENT_SERVICE_URL + 'pay/batch'
+    payload = {'payments': payments}
+    res = call(paymentRequests, 'post', url, json=payload)
+    for payment in payments:
+        if isinstance(payment, dict):
+            cache.invalidateTag(accountTag(payment.get('fromAccNum')))
+            cache.invalidateTag(accountTag(payment.get('toAccNum')))
+    if int(res.status_code) >= 400:
+        logger.warning("Cannot execute batch of %s payments, " \
+                       "resp %s, status code %s" \
+                       % (len(payments), res.text, res.status_code))
+    return res
+
+
+def stats():
+    return {"cache": cache.stats(),
+            "singleflight": flights.stats(),
+            "ratelimit": limiter.stats(),
+            "breakers": dict((c.name, c.breaker.stats())
+                             for c in downstreams),
+            "pools": dict((c.name, c.poolStats()) for c in downstreams)}
+
+
+# All external APIs that the gateway relies on, manually created
+KNOWN_REMOTE_APIS = [USERS_SERVICE_URL + "users",
+                    ACCOUNTS_SERVICE_URL + "accounts",
+                    TRANSACTIONS_SERVICE_URL + "transactions",
+                    PAYMENT_SERVICE_URL + "pay",
+                    PAYMENT_SERVICE_URL + "pay/batch",
+                    PAYMENT_SERVICE_URL + "payments",
+                    USERS_SERVICE_URL + "users/login"]
@@ -0,0 +1,125 @@
+import threading
+
+
+class _Batch():
+    def __init__(self):
+        self.items = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class WindowBatcher():
+    """Collect the items of concurrent callers into batches.
+
+    The first caller opens a batch and waits up to window seconds, or until
+    maxSize items have joined, then hands all items to flush(items) in one
+    call, which returns one result per item. Every caller gets the result
+    of its own item, or the exception raised by flush. As with
+    SingleFlight, under the gevent worker the waiting callers are
+    greenlets."""
+    def __init__(self, flush, window=0.01, maxSize=100):
+        self.flush = flush
+        self.window = window
+        self.maxSize = maxSize
+        self.lock = threading.Lock()
+        self.pending = None
+        self.batches = 0
+        self.items = 0
+        self.largest = 0
+
+    def submit(self, item):
+        with self.lock:
+            batch = self.pending
+            isLeader = batch is None
+            if isLeader:
+                batch = self.pending = _Batch()
+            index = len(batch.items)
+            batch.items.append(item)
+            if len(batch.items) >= self.maxSize:
+                self.pending = None
+                batch.full.set()
+
+        if not isLeader:
+            batch.done.wait()
+        else:
+            batch.full.wait(self.window)
+            with self.lock:
+                if self.pending is batch:
+                    self.pending = None
+                self.batches += 1
+                self.items += len(batch.items)
+                self.largest = max(self.largest, len(batch.items))
+            try:
+                batch.results = self.flush(batch.items)
+            except Exception as error:
+                batch.error = error
+            finally:
+                batch.done.set()
+
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[index]
+
+    def stats(self):
+        with self.lock:
+            return {"window": self.window,
+                    "maxSize": self.maxSize,
+                    "batches": self.batches,
+                    "items": self.items,
+                    "largestBatch": self.largest}
+
+
+class GroupCommit():
+    """Commit the writes of concurrent callers in one transaction.
+
+    A write is a function that changes the session without committing and
+    returns a result, or raises. The writes gathered by a WindowBatcher are
+    run one after the other by the first caller, in its session, which then
+    commits once for all of them and calls committed(result) for each
+    write, in the same order, e.g. to update a cache. A write that raises
+    may have changed the session already, so the transaction is rolled
+    back and the writes run before it are run again, without it; writes
+    must thus be safe to run again. run returns the result of the caller's
+    write once it has been committed, or raises the error of the write or
+    of the commit. Writes must return plain values, not objects of the
+    session."""
+    def __init__(self, session, window=0.005, maxSize=100):
+        self.session = session
+        self.batcher = WindowBatcher(self.commit, window, maxSize)
+
+    def run(self, write, committed=None):
+        error, result = self.batcher.submit((write, committed))
+        if error is not None:
+            raise error
+        return result
+
+    def commit(self, writes):
+        results = [None] * len(writes)
+        pending = range(len(writes))
+        while pending:
+            applied = []
+            for k, i in enumerate(pending):
+                try:
+                    results[i] = (None, writes[i][0]())
+                    applied.append(i)
+                except Exception as error:
+                    results[i] = (error, None)
+                    self.session.rollback()
+                    pending = applied + pending[k + 1:]
+                    break
+            else:
+                pending = []
+        try:
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        for (write, committed), (error, result) in zip(writes, results):
+            if committed is not None and error is None:
+                committed(result)
+        return results
+
+    def stats(self):
+        return self.batcher.stats()
@@ -0,0 +1,88 @@
+import time
+import threading
+
+from requests.exceptions import ConnectionError
+
+
+class CircuitOpenError(ConnectionError):
+    """Raised instead of calling a service whose circuit is open."""
+
+
+class CircuitBreaker():
+    """Circuit breaker guarding the calls to one downstream service.
+
+    closed: calls pass, consecutive failures are counted.
+    open: after failureThreshold consecutive failures calls fail fast for
+          resetTimeout seconds.
+    half-open: then up to halfOpenProbes calls are let through; a success
+               closes the circuit again, a failure reopens it."""
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failureThreshold=5, resetTimeout=10.0,
+                 halfOpenProbes=1):
+        self.name = name
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.halfOpenProbes = halfOpenProbes
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.openedAt = 0
+        self.probes = 0
+        self.successCount = 0
+        self.failureCount = 0
+        self.rejectedCount = 0
+        self.openedCount = 0
+
+    def before(self):
+        """Admit a call or raise CircuitOpenError."""
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.time() - self.openedAt < self.resetTimeout:
+                    self.rejectedCount += 1
+                    raise CircuitOpenError("Circuit for %s is open" \
+                                           % self.name)
+                self.state = self.HALF_OPEN
+                self.probes = 0
+            if self.state == self.HALF_OPEN:
+                if self.probes >= self.halfOpenProbes:
+                    self.rejectedCount += 1
+                    raise CircuitOpenError("Circuit for %s is half-open" \
+                                           % self.name)
+                self.probes += 1
+
+    def success(self):
+        with self.lock:
+            self.successCount += 1
+            self.failures = 0
+            if self.state == self.HALF_OPEN:
+                self.state = self.CLOSED
+
+    def failure(self):
+        with self.lock:
+            self.failureCount += 1
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+               (self.state == self.CLOSED and
+                self.failures >= self.failureThreshold):
+                self.state = self.OPEN
+                self.openedAt = time.time()
+                self.openedCount += 1
+
+    def release(self):
+        """Forget an admitted call whose outcome says nothing about the
+        service."""
+        with self.lock:
+            if self.state == self.HALF_OPEN and self.probes > 0:
+                self.probes -= 1
+
+    def stats(self):
+        with self.lock:
+            return {"state": self.state,
+                    "consecutiveFailures": self.failures,
+                    "successes": self.successCount,
+                    "failures": self.failureCount,
+                    "rejected": self.rejectedCount,
+                    "opened": self.openedCount}
@@ -41,7 +41,7 @@ fi
 
 if [[ -f $GUNICORN_CONFIG_FILE ]]; then
 	echo Starting Gunicorn.
-	gunicorn -c $GUNICORN_CONFIG_FILE api:app
+	gunicorn -c $GUNICORN_CONFIG_FILE ${APP_MODULE:-api}:app
 else
 	echo $GUNICORN_CONFIG_FILE not found. Terminating.
 	exit
@@ -0,0 +1,99 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache():
+    """Bounded in-process cache with LRU eviction and per-entry TTL.
+
+    Entries can be labelled with tags, so that a write touching e.g. one
+    account can drop every cached entry that mentions it. Every
+    invalidation bumps the generation; a value fetched before an
+    invalidation is not stored if set() is given the older generation."""
+    def __init__(self, maxSize=1024):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.generation = 0
+
+    def get(self, key):
+        """Return the cached value or None if missing or expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires, tags = entry
+            if expires < time.time():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            # Mark as most recently used
+            del self.entries[key]
+            self.entries[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl, tags=(), generation=None):
+        if ttl <= 0:
+            return
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, time.time() + ttl, tuple(tags))
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.maxSize:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            self.generation += 1
+            if key in self.entries:
+                self._remove(key)
+                self.invalidations += 1
+
+    def invalidateTag(self, tag):
+        with self.lock:
+            self.generation += 1
+            for key in list(self.tags.get(tag, ())):
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.tags.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self.entries),
+                    "maxSize": self.maxSize,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hitRatio": float(self.hits) / lookups if lookups else 0.0,
+                    "evictions": self.evictions,
+                    "expirations": self.expirations,
+                    "invalidations": self.invalidations}
+
+    def _remove(self, key):
+        """Drop an entry and its tag references. Caller holds the lock."""
+        value, expires, tags = self.entries.pop(key)
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
@@ -1,13 +1,18 @@
 import json
+import logging
 
 import falcon
 
 from general import getEnvVar
-from MiSSFire import CorrelationToken
 
 
+# The service-wide logger set up by general.log
+logger = logging.getLogger()
+DEBUG = getEnvVar('DEBUG', False)
+
 TOKEN = getEnvVar('TOKEN', False)
 if TOKEN:
+    from MiSSFire import CorrelationToken
     correlationToken = CorrelationToken(logger, DEBUG)
 
 
@@ -46,8 +51,9 @@ class RequireJSON(object):
                 'This API only supports responses encoded as JSON.',
                 href='http://docs.examples.com/api/json')
 
-        if req.method in ('POST', 'PUT'):
-            if 'application/json' not in req.content_type:
+        # A POST without a body, e.g. to open an account, has no type
+        if req.method in ('POST', 'PUT') and req.content_length:
+            if 'application/json' not in (req.content_type or ''):
                 raise falcon.HTTPUnsupportedMediaType(
                     'This API only supports requests encoded as JSON.',
                     href='http://docs.examples.com/api/json')
@@ -2,25 +2,40 @@ import os
 import sys
 import json
 import logging
+import urllib
+import urlparse
+from datetime import datetime
 
 import requests
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests.exceptions import ConnectionError, Timeout
+from requests.adapters import HTTPAdapter, DEFAULT_POOLSIZE, DEFAULT_POOLBLOCK
+from requests.packages.urllib3.util.retry import Retry
 from flask import make_response
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+from breaker import CircuitBreaker
 
 # Disable console messages from Flask server
 logging.getLogger('werkzeug').setLevel(logging.ERROR)
 
 class log:
+    # The console handler, shared by all services of one process
+    handler = None
+
     def __init__(self, service_name,):
         self.service_name = service_name
         self.logger = logging.getLogger()
         self.logger.setLevel(logging.INFO)
 
         # Create console handler
-        handler = logging.StreamHandler()
-        handler.setLevel(logging.DEBUG)
-        formatter = logging.Formatter("%(asctime)s - %(filename)s - %(funcName)s - %(lineno)s - %(levelname)s - %(message)s")
-        handler.setFormatter(formatter)
-        self.logger.addHandler(handler)
+        if log.handler is None:
+            log.handler = logging.StreamHandler()
+            log.handler.setLevel(logging.DEBUG)
+            formatter = logging.Formatter("%(asctime)s - %(filename)s - %(funcName)s - %(lineno)s - %(levelname)s - %(message)s")
+            log.handler.setFormatter(formatter)
+            self.logger.addHandler(log.handler)
 
         # Install service-wide exception handler
         #sys.excepthook = self.my_handler
@@ -78,13 +93,248 @@ def json_serial(obj):
         return serial
     raise TypeError ("Type not serializable")
 
+class ReadSafeRetry(Retry):
+    """Retry that sends a request again after a read error only if reading
+    it has no effect.
+
+    A read error, e.g. a timeout while waiting for the answer or a
+    connection dropped mid-request, means the service may have received
+    and applied the request. The urllib3 bundled with requests 2.5.1
+    retries read errors whatever the method, and so would apply a POST
+    twice. A refused connection is reported as a read error as well, so a
+    POST is not retried then either."""
+    READ_RETRY_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+    def increment(self, method=None, url=None, response=None, error=None,
+                  _pool=None, _stacktrace=None):
+        if error is not None and self._is_read_error(error) and \
+           (method or '').upper() not in self.READ_RETRY_METHODS:
+            raise error
+        return super(ReadSafeRetry, self).increment(method, url, response,
+                                                    error, _pool, _stacktrace)
+
+
 class Requests():
-    """Requests+session."""
-    def __init__(self):
+    """Requests+session.
+
+    poolMaxSize bounds the number of keep-alive connections kept per host,
+    poolConnections the number of hosts a pool is kept for. With poolBlock
+    set, callers wait for a free pooled connection instead of opening (and
+    later discarding) an extra one. Connection attempts that time out are
+    retried maxRetries times, waiting retryBackoff * 2^n seconds in
+    between; other failures only for GET, HEAD and OPTIONS requests, see
+    ReadSafeRetry."""
+    def __init__(self, poolMaxSize=DEFAULT_POOLSIZE, poolBlock=DEFAULT_POOLBLOCK,
+                 poolConnections=DEFAULT_POOLSIZE, maxRetries=0,
+                 retryBackoff=0):
         self.s = requests.Session()
+        if maxRetries:
+            retries = ReadSafeRetry(total=maxRetries,
+                                    backoff_factor=retryBackoff)
+        else:
+            retries = 0
+        self.adapter = HTTPAdapter(pool_connections=poolConnections,
+                                   pool_maxsize=poolMaxSize,
+                                   pool_block=poolBlock,
+                                   max_retries=retries)
+        self.s.mount('http://', self.adapter)
+        self.s.mount('https://', self.adapter)
+
+    def stats(self):
+        """Connections opened by the pools so far versus requests sent over
+        an already open connection."""
+        pools = self.adapter.poolmanager.pools
+        opened = sent = 0
+        for key in pools.keys():
+            pool = pools[key]
+            opened += pool.num_connections
+            sent += pool.num_requests
+        return {"hosts": len(pools),
+                "requests": sent,
+                "newConnections": opened,
+                "reusedConnections": max(0, sent - opened)}
 
     def get(self, *args, **kwargs):
         return self.s.get(*args, **kwargs)
 
     def post(self, *args,**kwargs):
         return self.s.post(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self.s.delete(*args, **kwargs)
+
+
+# WSGI apps of the services running in this process, by the host:port
+# their service URL names; see LocalRequests.
+localApps = {}
+
+def registerLocalApp(url, app):
+    localApps[urlparse.urlsplit(url).netloc] = app
+
+
+class LocalRequests():
+    """Drop-in for Requests that calls a service running in the same
+    process (the monolith) instead of sending the request over HTTP.
+
+    The request is handed to the service's WSGI app as is and the answer is
+    returned as a requests Response, so the callers cannot tell the
+    difference. Timeouts do not apply."""
+    def get(self, *args, **kwargs):
+        return self.request('GET', *args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        return self.request('POST', *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self.request('DELETE', *args, **kwargs)
+
+    def request(self, method, url, params=None, **kwargs):
+        parts = urlparse.urlsplit(url)
+        app = localApps.get(parts.netloc)
+        if app is None:
+            raise ConnectionError("No service in this process at %s" \
+                                  % parts.netloc)
+        query = parts.query
+        if params:
+            query = '&'.join(q for q in [query, urllib.urlencode(params)] if q)
+        body = {}
+        if kwargs.get('json') is not None:
+            body = {'data': json.dumps(kwargs['json']),
+                    'content_type': 'application/json'}
+        environ = EnvironBuilder(path=parts.path, method=method,
+                                 query_string=query, **body).get_environ()
+        appIter, status, headers = run_wsgi_app(app, environ, buffered=True)
+
+        res = Response()
+        res.url = url
+        res.status_code = int(status.split(None, 1)[0])
+        res.reason = status.split(None, 1)[-1]
+        res.headers = CaseInsensitiveDict(headers)
+        res.encoding = 'utf-8'
+        res._content = ''.join(appIter)
+        return res
+
+
+class ServiceTimeoutError(ConnectionError, Timeout):
+    """A downstream service did not answer in time."""
+
+
+class ServiceClient():
+    """Calls to one downstream service with timeouts and a circuit breaker.
+
+    Wraps general.Requests or the MiSSFire Requests. Connection errors,
+    timeouts and 5xx responses count as failures of the service. Timeouts
+    and calls refused by an open circuit are raised as ConnectionError
+    subclasses, which the handlers already turn into 503 responses."""
+    def __init__(self, reqs, name, timeout=None, breaker=None):
+        self.reqs = reqs
+        self.name = name
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker(name)
+
+    def get(self, *args, **kwargs):
+        return self.request('get', *args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        return self.request('post', *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self.request('delete', *args, **kwargs)
+
+    def request(self, method, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        self.breaker.before()
+        try:
+            res = getattr(self.reqs, method)(*args, **kwargs)
+        except Timeout as e:
+            self.breaker.failure()
+            raise ServiceTimeoutError("%s service timed out: %s" \
+                                      % (self.name, e))
+        except ConnectionError:
+            self.breaker.failure()
+            raise
+        except Exception:
+            # Not the service's fault (e.g. a bad URL)
+            self.breaker.release()
+            raise
+        if int(res.status_code) >= 500:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        return res
+
+    def poolStats(self):
+        """Connection reuse of the service's pool, None if unknown (e.g. the
+        MiSSFire Requests)."""
+        if hasattr(self.reqs, 'stats'):
+            return self.reqs.stats()
+        return None
+
+
+def serviceConf(name, var, default):
+    """Service specific variables (e.g. ACCOUNTS_READ_TIMEOUT) take
+    precedence over the global ones (READ_TIMEOUT)."""
+    return getEnvVar(name.upper() + '_' + var, getEnvVar(var, default))
+
+
+def serviceRequests(name):
+    """Requests with a connection pool of its own for the downstream service
+    name, configured from the environment. With MONOLITH set the services
+    run in one process and are called through LocalRequests instead."""
+    if getEnvVar('MONOLITH', False):
+        return LocalRequests()
+    def conf(var, default):
+        return float(serviceConf(name, var, default))
+    return Requests(int(conf('POOL_MAXSIZE', DEFAULT_POOLSIZE)),
+                    serviceConf(name, 'POOL_BLOCK', True) is True,
+                    int(conf('POOL_CONNECTIONS', DEFAULT_POOLSIZE)),
+                    int(conf('MAX_RETRIES', 0)),
+                    conf('RETRY_BACKOFF', 0))
+
+
+def serviceClient(reqs, name):
+    """ServiceClient for the downstream service name, configured from the
+    environment."""
+    def conf(var, default):
+        return float(serviceConf(name, var, default))
+    timeout = (conf('CONNECT_TIMEOUT', 3.05), conf('READ_TIMEOUT', 30))
+    breaker = CircuitBreaker(name,
+                             int(conf('BREAKER_FAILURES', 5)),
+                             conf('BREAKER_RESET_TIMEOUT', 10))
+    return ServiceClient(reqs, name, timeout, breaker)
+
+
+# SQLite settings of the service databases, see sqlitePragmas.
+# fast: no journal on disk and no syncing, a crash of the host can lose
+#   or corrupt the database.
+# balanced: committed writes survive a crash of the service, a power loss
+#   may lose the last ones.
+# durable: every commit is synced to disk before it returns.
+SQLITE_PROFILES = {
+    'fast': {'journal_mode': 'MEMORY', 'synchronous': 'OFF'},
+    'balanced': {'journal_mode': 'WAL', 'synchronous': 'NORMAL'},
+    'durable': {'journal_mode': 'WAL', 'synchronous': 'FULL'}}
+SQLITE_PRAGMAS = ['journal_mode', 'synchronous', 'cache_size', 'mmap_size',
+                  'temp_store', 'busy_timeout']
+
+
+def sqlitePragmas(name, profile='fast'):
+    """PRAGMA statements for a new connection to the database of the
+    service name.
+
+    The profile is taken from SQLITE_PROFILE, or the profile given. Each
+    pragma of SQLITE_PRAGMAS can be set as well, e.g. SQLITE_CACHE_SIZE,
+    overriding the profile. As in serviceConf, a variable prefixed with the
+    service name (ACCOUNTS_SQLITE_PROFILE) takes precedence. The settings
+    are read for every connection; for a file database SQLAlchemy opens one
+    per session, so cache_size only lasts for a session."""
+    profile = serviceConf(name, 'SQLITE_PROFILE', profile)
+    if profile not in SQLITE_PROFILES:
+        raise ValueError("Unknown SQLite profile %s" % profile)
+    res = []
+    for pragma in SQLITE_PRAGMAS:
+        value = serviceConf(name, 'SQLITE_' + pragma.upper(),
+                            SQLITE_PROFILES[profile].get(pragma))
+        if value is not None:
+            res.append("PRAGMA %s = %s" % (pragma, value))
+    return res
@@ -6,12 +6,24 @@ import sys
 curDir = os.path.dirname(os.path.realpath(__file__))
 # Add the path to the current directory to sys.path
 sys.path.append(curDir)
+# The gevent worker monkey patches the standard library only when it starts,
+# but the app is imported below, in the master process. Patch before that,
+# so that locks, queues and thread pools the app creates at import time
+# cooperate with the greenlets of the worker instead of blocking all of them.
+if os.getenv('ISGAME', False) != 'True':
+	from gevent import monkey
+	monkey.patch_all()
+
+# The WSGI application is served from APP_MODULE:app, by default api:app.
+# The API gateway also ships a Falcon version of its API in api_falcon.
+APP_MODULE = os.getenv('APP_MODULE', 'api')
 # Import a module from the newly added path
-from api import FLASK_PORT
+FLASK_PORT = __import__(APP_MODULE).FLASK_PORT
 
 
 # Server Socket
-bind = "0.0.0.0:%s" % FLASK_PORT
+# PORT overrides the port, e.g. to run the monolith next to the services.
+bind = "0.0.0.0:%s" % os.getenv('PORT', FLASK_PORT)
 
 
 # Worker Processes
@@ -29,7 +41,9 @@ timeout = 90
 worker_class = 'gevent'
 # The maximum number of simultaneous clients.
 # Affects the Eventlet and Gevent worker types.
-#worker_connections = 30
+# Keep it in line with the downstream pool sizes (POOL_MAXSIZE) so that
+# greenlets queue in the worker rather than in the downstream services.
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', 1000))
 
 
 if os.getenv('ISGAME', False) == 'True':
@@ -61,6 +75,17 @@ limit_request_fields = 10
 limit_request_field_size = 2048
 
 
+# Server Hooks
+def post_worker_init(worker):
+    """Start the background work of the app, if it has any, in the worker
+    process. Threads started while importing the app would stay behind in
+    the master process, which imports it above."""
+    startBackground = getattr(sys.modules.get(APP_MODULE), 'startBackground',
+                              None)
+    if startBackground:
+        startBackground()
+
+
 # Debugging
 # Restart workers when code changes.
 reload = False
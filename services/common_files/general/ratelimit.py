@@ -0,0 +1,74 @@
+import math
+import time
+import threading
+from collections import OrderedDict
+
+
+class TokenBucket():
+    """Token bucket holding up to burst tokens, refilled at rate per second."""
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def take(self, now, cost=1):
+        """Take cost tokens. Return 0 if they were available, otherwise the
+        number of seconds until they will be."""
+        # now may precede the creation of the bucket, or another thread's
+        # call, by a little
+        if now > self.updated:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        if self.rate <= 0:
+            return float('inf')
+        return (cost - self.tokens) / self.rate
+
+
+class RateLimiter():
+    """Token buckets per client and route class.
+
+    limits maps a route class to its (rate, burst); classes with a rate of
+    0 or without limits are not limited. At most maxKeys buckets are kept,
+    the least recently used ones are dropped, which only forgives a little
+    debt of clients that have been quiet for a while."""
+    def __init__(self, limits, maxKeys=10000):
+        self.limits = dict((c, l) for c, l in limits.items() if l[0] > 0)
+        self.maxKeys = maxKeys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+        self.admitted = dict((c, 0) for c in self.limits)
+        self.rejected = dict((c, 0) for c in self.limits)
+
+    def admit(self, key, routeClass):
+        """Admit a request of the client key. Return 0 if admitted,
+        otherwise the whole number of seconds to wait before a retry."""
+        if routeClass not in self.limits:
+            return 0
+        now = time.time()
+        with self.lock:
+            bucket = self.buckets.pop((key, routeClass), None)
+            if bucket is None:
+                bucket = TokenBucket(*self.limits[routeClass])
+            # Mark as most recently used
+            self.buckets[(key, routeClass)] = bucket
+            while len(self.buckets) > self.maxKeys:
+                self.buckets.popitem(last=False)
+            wait = bucket.take(now)
+            if wait:
+                self.rejected[routeClass] += 1
+                return max(1, int(math.ceil(min(wait, 3600))))
+            self.admitted[routeClass] += 1
+            return 0
+
+    def stats(self):
+        with self.lock:
+            return {"limits": dict((c, {"rate": r, "burst": b})
+                                   for c, (r, b) in self.limits.items()),
+                    "admitted": dict(self.admitted),
+                    "rejected": dict(self.rejected),
+                    "buckets": len(self.buckets)}
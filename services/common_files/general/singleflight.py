@@ -0,0 +1,56 @@
+import threading
+
+
+class _Call():
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight():
+    """Collapse concurrent identical calls into a single in-flight call.
+
+    The first caller for a key runs the call, later callers for the same
+    key wait for it and share its result (or its exception). The gevent
+    worker monkey patches threading, so the waiters are greenlets parked on
+    the leader's event rather than OS threads."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            isLeader = call is None
+            if isLeader:
+                call = _Call()
+                self.calls[key] = call
+                self.leaders += 1
+            else:
+                self.followers += 1
+
+        if not isLeader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.result
+
+    def stats(self):
+        with self.lock:
+            return {"inFlight": len(self.calls),
+                    "calls": self.leaders,
+                    "coalesced": self.followers}
@@ -0,0 +1,91 @@
+"""All services in one process.
+
+The API gateway and the users, accounts, transactions and payment services
+are loaded from their own directories into this process. The services call
+each other through general.LocalRequests, which hands the request to the
+WSGI app of the called service instead of sending it over HTTP, so none of
+their handlers change. The gateway app is served; the services are only
+reachable through it.
+
+Served by gunicorn like any service (api:app), or run directly:
+    MONOLITH=True python api.py
+"""
+import os
+import sys
+import imp
+
+# Must be set before the services create their clients
+os.environ['MONOLITH'] = 'True'
+
+from general import log, getEnvVar, registerLocalApp
+
+
+# Use the name of the current directory as a service type
+serviceType = os.path.basename(os.getcwd())
+logger = log(serviceType).logger
+
+# Directory holding a <service>/<service> directory per service
+SERVICES_DIR = getEnvVar('SERVICES_DIR',
+                         os.path.join(os.path.dirname(os.path.realpath(
+                                      __file__)), '..', '..'))
+# Gateway front end to serve, api (Flask) or api_falcon
+GATEWAY_APP_MODULE = getEnvVar('GATEWAY_APP_MODULE', 'api')
+
+# Services in the order they are loaded, callees first
+SERVICES = ['users', 'accounts', 'transactions', 'payment']
+
+
+# Modules of the services by (service, module name)
+serviceModules = {}
+
+def loadService(name, module='api'):
+    """Import the module of a service from its directory.
+
+    The services share module names (api, db_controller, ...), so modules
+    imported from the service's directory are taken out of sys.modules
+    again once it is loaded. They are kept in serviceModules instead, as
+    Python 2 clears the globals of a module that is garbage collected.
+    Modules common to all services (general, ...) are loaded only once."""
+    serviceDir = os.path.realpath(os.path.join(SERVICES_DIR, name, name))
+    before = set(sys.modules)
+    sys.path.insert(0, serviceDir)
+    try:
+        mod = imp.load_source('%s_%s' % (name, module),
+                              os.path.join(serviceDir, module + '.py'))
+    finally:
+        sys.path.remove(serviceDir)
+    for modName in set(sys.modules) - before:
+        modFile = getattr(sys.modules[modName], '__file__', None) or ''
+        if os.path.realpath(modFile).startswith(serviceDir + os.sep):
+            serviceModules[name, modName] = sys.modules.pop(modName)
+    return mod
+
+
+services = dict((name, loadService(name)) for name in SERVICES)
+gateway = loadService('apigateway', GATEWAY_APP_MODULE)
+
+# Route the calls to each service URL to the service in this process
+for url, name in [(gateway.gateway.USERS_SERVICE_URL, 'users'),
+                  (gateway.gateway.ACCOUNTS_SERVICE_URL, 'accounts'),
+                  (gateway.gateway.TRANSACTIONS_SERVICE_URL, 'transactions'),
+                  (gateway.gateway.PAYMENT_SERVICE_URL, 'payment'),
+                  (services['payment'].ACCOUNTS_SERVICE_URL, 'accounts'),
+                  (services['payment'].TRANSACTIONS_SERVICE_URL,
+                   'transactions')]:
+    registerLocalApp(url, services[name].app)
+
+app = gateway.app
+FLASK_PORT = gateway.FLASK_PORT
+
+
+def startBackground():
+    """Start the background work of the services; see gunicorn_config."""
+    for mod in services.values():
+        if hasattr(mod, 'startBackground'):
+            mod.startBackground()
+
+
+if __name__ == "__main__":
+    from wsgiref.simple_server import make_server
+    startBackground()
+    make_server('0.0.0.0', FLASK_PORT, app).serve_forever()
@@ -1,11 +1,17 @@
 import os
+import time
+import threading
 
 from flask import Flask, request, abort
 from requests import codes
-from requests.exceptions import ConnectionError
-from werkzeug.exceptions import NotFound, ServiceUnavailable
+from requests.exceptions import ConnectionError, Timeout
+from werkzeug.exceptions import NotFound, ServiceUnavailable, GatewayTimeout
 
 from general import log, getEnvVar, isDocker, niceJson, allLinks
+from general import serviceClient, serviceRequests
+from batching import WindowBatcher
+from saga import Step, SagaExecutor, SagaError, SagaUnknownError
+from db_controller import db_create, db_migrate, dbCtrl
 
 
 # Use the name of the current directory as a service type
@@ -54,15 +60,106 @@ else:
     ACCOUNTS_SERVICE_URL     = '%s://%s:%s/' % (PROT, '0.0.0.0', 9082)
     TRANSACTIONS_SERVICE_URL = '%s://%s:%s/' % (PROT, '0.0.0.0', 9083)
 
+# A connection pool, timeouts and a circuit breaker for each downstream
+# service, see general.serviceRequests and general.serviceClient.
+# MiSSFire manages its own session, which is then shared by both services.
+def downstreamPool(name):
+    if getEnvVar('MTLS', False) or getEnvVar('TOKEN', False):
+        return requests
+    return serviceRequests(name)
+
+accountsRequests = serviceClient(downstreamPool('accounts'), 'accounts')
+transactionsRequests = serviceClient(downstreamPool('transactions'),
+                                     'transactions')
+downstreams = [accountsRequests, transactionsRequests]
+
+# Runs the steps of a payment concurrently and compensates them on failure
+SAGA_WORKERS = int(getEnvVar('SAGA_WORKERS', 32))
+sagas = SagaExecutor(SAGA_WORKERS)
+
 app = Flask(__name__)
 
 
+# Largest number of payments accepted by one batch request
+MAX_BATCH_SIZE = int(getEnvVar('MAX_BATCH_SIZE', 1000))
+
+
+# Asynchronous payments: POST /pay?async=true stores the payment in a queue
+# on the payments volume and answers 202 at once. Background workers drain
+# the queue in batches through executeBatch; GET /payments/<id> tells the
+# outcome. Without the volume only synchronous payments are served.
+QUEUE_WORKERS = int(getEnvVar('QUEUE_WORKERS', 2))
+QUEUE_BATCH_SIZE = min(int(getEnvVar('QUEUE_BATCH_SIZE', 100)),
+                       MAX_BATCH_SIZE)
+# Seconds an idle worker waits for new payments before polling again
+QUEUE_POLL_INTERVAL = float(getEnvVar('QUEUE_POLL_INTERVAL', 1))
+# Seconds to wait before retrying a batch a service could not take
+QUEUE_RETRY_DELAY = float(getEnvVar('QUEUE_RETRY_DELAY', 1))
+# Seconds after which a payment still processing is considered abandoned
+QUEUE_RECOVERY_AGE = float(getEnvVar('QUEUE_RECOVERY_AGE', 300))
+
+# Netting: payments are gathered for NETTING_WINDOW seconds and executed
+# as one batch. Every payment still gets its own transaction, but the
+# accounts only receive the net amount moved between each pair of accounts
+# (see netTransfers). This applies to /pay, /pay/batch and the queue.
+NETTING = getEnvVar('NETTING', False)
+NETTING_WINDOW = float(getEnvVar('NETTING_WINDOW', 0.01))
+netting = WindowBatcher(lambda payments: executeBatch(payments),
+                        NETTING_WINDOW, MAX_BATCH_SIZE)
+
+db = dbCtrl(logger)
+
+def prepareDB():
+    """Insure presence of the required DB files."""
+    res = False
+    if db_create.isDBVolume():
+        if not db_create.isDBfile():
+            db_create.main()
+            db_migrate.main()
+        res = True
+    return res
+
+ASYNC_PAYMENTS = prepareDB()
+if not ASYNC_PAYMENTS:
+    logger.warning("Missing volume. Asynchronous payments are disabled.")
+
+# Set by startBackground once the worker process runs
+newPayments = None
+
+
 
 @app.route("/", methods=['GET'])
 def hello():
     return niceJson({"subresource_uris": allLinks(app)}, 200)
 
 
+@app.route("/stats", methods=['GET'])
+def stats():
+    return niceJson({"breakers": dict((c.name, c.breaker.stats())
+                                      for c in downstreams),
+                     "pools": dict((c.name, c.poolStats())
+                                   for c in downstreams),
+                     "sagas": sagas.stats(),
+                     "netting": netting.stats() if NETTING else {},
+                     "queue": db.countByStatus() if ASYNC_PAYMENTS else {}},
+                    200)
+
+
+def parseAmount(value):
+    """The amount of a payment, which accounts and transactions store as an
+    integer. Raises ValueError unless value is a positive integer, or a
+    string of one; a fraction is refused rather than truncated."""
+    if isinstance(value, (bool, float)):
+        raise ValueError("Expected an integer amount, received: %s" % value)
+    try:
+        amount = int(value)
+    except TypeError:
+        raise ValueError("Expected an integer amount, received: %s" % value)
+    if amount <= 0:
+        raise ValueError("Expected a positive amount, received: %s" % value)
+    return amount
+
+
 @app.route("/pay", methods=['POST'])
 @jwt_conditional(requests)
 def pay():
@@ -72,29 +169,223 @@ def pay():
         abort(400)
     fromAccNum = request.json['fromAccNum']
     toAccNum = request.json['toAccNum']
-    amount = float(request.json['amount'])
+    try:
+        amount = parseAmount(request.json['amount'])
+    except ValueError as e:
+        return niceJson({'msg': str(e)}, 400)
+    if request.args.get('async') == 'true':
+        return enqueuePayment(fromAccNum, toAccNum, amount)
+    if NETTING:
+        return payNetted(fromAccNum, toAccNum, amount)
 
     res = ""
     res_code = 400
-    transNum = postTransaction(fromAccNum, toAccNum, amount)
-
+    # The transaction record and the transfer between the accounts do not
+    # depend on each other, so they are issued at once; each is undone if
+    # the other one fails. If either one timed out neither is undone, see
+    # paymentInDoubt.
+    steps = [Step('transaction', postTransaction,
+                  (fromAccNum, toAccNum, amount),
+                  cancelTransaction),
+             Step('transfer', transfer, (fromAccNum, toAccNum, amount),
+                  lambda balances: transfer(toAccNum, fromAccNum, amount,
+                                            checkFunds=False))]
     try:
-        if transNum:
-            if (not updateAccount(fromAccNum, -amount) or not updateAccount(toAccNum, amount)):
-                cancelTransaction(transNum)
-            else:
-                res_code = 200
-    except Exception as e:
+        sagas.run('pay %s->%s %s' % (fromAccNum, toAccNum, amount), steps)
+        res_code = 200
+    except SagaUnknownError as e:
+        logger.error("Payment: %s" % e)
+        return paymentInDoubt(fromAccNum, toAccNum, amount, e)
+    except SagaError as e:
         logger.error("Payment: %s" % e)
+        if isinstance(e.error, (ServiceUnavailable, ConnectionError)):
+            raise ServiceUnavailable(str(e.error))
     return niceJson(res, res_code)
 
 
+def paymentInDoubt(fromAccNum, toAccNum, amount, e):
+    """Answer a payment of which a step timed out.
+
+    The step may have been applied, so the payment is neither undone nor
+    retried here: it is recorded as unknown in the payment queue, with its
+    transaction if that was recorded, and answered 202 like an asynchronous
+    payment. Without the queue volume it is answered 504."""
+    msg = "Timed out: %s" % e.error
+    paymentID = None
+    if ASYNC_PAYMENTS:
+        paymentID = db.recordUnknownPayment(fromAccNum, toAccNum, amount,
+                                            e.saga.result('transaction'), msg)
+    if paymentID is None:
+        raise GatewayTimeout("Payment outcome unknown: %s" % msg)
+    response = niceJson({'id': paymentID, 'status': 'unknown'}, 202)
+    response.headers['Location'] = '/payments/%s' % paymentID
+    return response
+
+
+def payNetted(fromAccNum, toAccNum, amount):
+    """Execute the payment with the others of the netting window."""
+    try:
+        result = netting.submit({'fromAccNum': fromAccNum,
+                                 'toAccNum': toAccNum, 'amount': amount})
+    except Timeout as e:
+        raise ServiceUnavailable("Payment timed out: %s." % e)
+    except NotFound as e:
+        logger.error("Payment: %s" % e)
+        return niceJson("", 400)
+    if result['status'] != 200:
+        logger.error("Payment from %s to %s amount %s: %s" \
+                     % (fromAccNum, toAccNum, amount, result.get('msg')))
+        return niceJson("", 400)
+    return niceJson("", 200)
+
+
+def enqueuePayment(fromAccNum, toAccNum, amount):
+    if not ASYNC_PAYMENTS:
+        raise ServiceUnavailable("Asynchronous payments are disabled.")
+    try:
+        # Checked now, as a malformed payment would fail its whole batch
+        paymentID = db.enqueuePayment(int(fromAccNum), int(toAccNum),
+                                      amount)
+    except ValueError:
+        return niceJson({'msg': 'Expected integer account numbers'}, 400)
+    if paymentID is None:
+        raise ServiceUnavailable("Cannot queue the payment.")
+    if newPayments is not None:
+        newPayments.set()
+    response = niceJson({'id': paymentID}, 202)
+    response.headers['Location'] = '/payments/%s' % paymentID
+    return response
+
+
+@app.route("/payments/<paymentID>", methods=['GET'])
+@jwt_conditional(requests)
+def paymentGet(paymentID):
+    if not ASYNC_PAYMENTS:
+        raise ServiceUnavailable("Asynchronous payments are disabled.")
+    try:
+        res = db.getPaymentById(int(paymentID), json=True)
+    except ValueError:
+        return niceJson({'msg': 'Expected integer payment id'}, 400)
+    if not res:
+        raise NotFound("Unknown payment %s" % paymentID)
+    return niceJson(res, 200)
+
+
+@app.route("/pay/batch", methods=['POST'])
+@jwt_conditional(requests)
+def payBatch():
+    if not request.json or not 'payments' in request.json:
+        abort(400)
+    payments = request.json['payments']
+    if not isinstance(payments, list) or \
+       not 0 < len(payments) <= MAX_BATCH_SIZE:
+        abort(400)
+    try:
+        return niceJson({'results': executeBatch(payments)}, 200)
+    except Timeout as e:
+        raise ServiceUnavailable("Payment batch timed out: %s." % e)
+
+
+def executeBatch(payments, posted=None):
+    """Execute many payments as one unit.
+
+    All transactions are recorded with one call and all account updates
+    are applied with another, instead of three calls per payment. The
+    transactions of payments whose accounts could not be updated are
+    canceled with a third call. Returns one result per payment.
+
+    posted, if given, is called with the transaction number of each payment
+    (None for a malformed one) as soon as they are recorded.
+
+    With NETTING the account updates are netted per pair of accounts. A
+    pair whose net transfer fails fails all of its payments."""
+    results = [None] * len(payments)
+    transfers = []
+    for i, p in enumerate(payments):
+        try:
+            transfers.append((i, p['fromAccNum'], p['toAccNum'],
+                              parseAmount(p['amount'])))
+        except (KeyError, TypeError):
+            results[i] = {'status': 400,
+                          'msg': 'fromAccNum, toAccNum and amount required'}
+        except ValueError as e:
+            results[i] = {'status': 400, 'msg': str(e)}
+    if not transfers:
+        return results
+
+    transNums = postTransactions([t[1:] for t in transfers])
+    if posted is not None:
+        numbers = [None] * len(payments)
+        for t, transNum in zip(transfers, transNums):
+            numbers[t[0]] = transNum
+        posted(numbers)
+    try:
+        if NETTING:
+            nets, netIndex = netTransfers([t[1:] for t in transfers])
+            netBalances = updateAccounts(nets)
+            balances = [netBalances[n] for n in netIndex]
+        else:
+            balances = updateAccounts([t[1:] for t in transfers])
+    except Timeout:
+        # The accounts may have been updated, the transactions stay
+        raise
+    except Exception as e:
+        # The error of the accounts is the one to report, whether or not
+        # the transactions could be canceled; the queue cancels them again
+        # before a retry, see processPayments.
+        tryCancelTransactions(transNums)
+        raise e
+
+    failed = []
+    for (i, fromAccNum, toAccNum, amount), transNum, balance \
+            in zip(transfers, transNums, balances):
+        if 'msg' in balance:
+            failed.append(transNum)
+            results[i] = {'status': 400, 'msg': balance['msg']}
+        else:
+            results[i] = {'status': 200, 'number': transNum}
+    if failed:
+        # The other payments are applied, so the batch has to succeed
+        tryCancelTransactions(failed)
+    return results
+
+
+def netTransfers(transfers):
+    """Net (fromAccNum, toAccNum, amount) transfers per pair of accounts.
+
+    Returns the net transfers, at most one per pair and in the order the
+    pairs first appear, and for each transfer the index of its net. A pair
+    whose transfers cancel out still gets a net of 0, so that its accounts
+    are checked."""
+    nets = []
+    netIndex = []
+    pairs = {}
+    for fromAccNum, toAccNum, amount in transfers:
+        pair = (min(fromAccNum, toAccNum), max(fromAccNum, toAccNum))
+        if pair not in pairs:
+            pairs[pair] = len(nets)
+            nets.append(0)
+        # Positive amounts move money from the lower to the higher number
+        sign = 1 if fromAccNum == pair[0] else -1
+        nets[pairs[pair]] += sign * amount
+        netIndex.append(pairs[pair])
+    for pair, i in pairs.items():
+        if nets[i] >= 0:
+            nets[i] = (pair[0], pair[1], nets[i])
+        else:
+            nets[i] = (pair[1], pair[0], -nets[i])
+    return nets, netIndex
+
+
 def postTransaction(fromAccNum, toAccNum, amount):
     try:
         url = TRANSACTIONS_SERVICE_URL + 'transactions'
         payload = {'fromAccNum':fromAccNum, 'toAccNum':toAccNum, 
                    'amount':amount}
-        res = requests.post(url, json=payload)
+        res = transactionsRequests.post(url, json=payload)
+    except Timeout:
+        # The outcome is unknown, which the payment saga has to tell apart
+        raise
     except ConnectionError as e:
         raise ServiceUnavailable(
               "Transactions service connection error: %s." % e)
@@ -107,25 +398,99 @@ def postTransaction(fromAccNum, toAccNum, amount):
         return res.json()['number']
 
 
-def updateAccount(accNum, amount):
+def transfer(fromAccNum, toAccNum, amount, checkFunds=True):
+    try:
+        url = ACCOUNTS_SERVICE_URL + 'transfers'
+        payload = {'fromAccNum':fromAccNum, 'toAccNum':toAccNum,
+                   'amount':amount, 'checkFunds':checkFunds}
+        res = accountsRequests.post(url, json=payload)
+    except Timeout:
+        # The outcome is unknown, which the payment saga has to tell apart
+        raise
+    except ConnectionError as e:
+        raise ServiceUnavailable("Accounts service connection error: %s."%e)
+
+    if res.status_code != codes.ok:
+        raise NotFound("Cannot transfer from %s to %s amount %s, " \
+                       "resp %s, status code %s" \
+                       % (fromAccNum, toAccNum, amount, res.text,
+                          res.status_code))
+    else:
+        return res.json()
+
+
+def postTransactions(transfers):
+    try:
+        url = TRANSACTIONS_SERVICE_URL + 'transactions/batch'
+        payload = {'transactions': [{'fromAccNum':fromAccNum,
+                                     'toAccNum':toAccNum,
+                                     'amount':amount}
+                                    for fromAccNum, toAccNum, amount
+                                    in transfers]}
+        res = transactionsRequests.post(url, json=payload)
+    except Timeout:
+        # The outcome is unknown, which the payment queue has to tell apart
+        raise
+    except ConnectionError as e:
+        raise ServiceUnavailable(
+              "Transactions service connection error: %s." % e)
+
+    if res.status_code != codes.ok:
+        raise NotFound("Cannot post %s transactions, resp %s, status code %s" \
+                       % (len(transfers), res.text, res.status_code))
+    else:
+        return res.json()['numbers']
+
+
+def updateAccounts(transfers):
     try:
-        url = ACCOUNTS_SERVICE_URL + 'accounts/%s' % accNum
-        payload = {'amount':amount}
-        res = requests.post(url, json=payload)
+        url = ACCOUNTS_SERVICE_URL + 'accounts/batch'
+        payload = {'transfers': [{'fromAccNum':fromAccNum,
+                                  'toAccNum':toAccNum,
+                                  'amount':amount}
+                                 for fromAccNum, toAccNum, amount
+                                 in transfers]}
+        res = accountsRequests.post(url, json=payload)
+    except Timeout:
+        # The outcome is unknown, which the payment queue has to tell apart
+        raise
     except ConnectionError as e:
         raise ServiceUnavailable("Accounts service connection error: %s."%e)
 
     if res.status_code != codes.ok:
-        raise NotFound("Cannot update account %s, resp %s, status code %s" \
-                       % (accNum, res.text, res.status_code))
+        raise NotFound("Cannot apply %s transfers, resp %s, status code %s" \
+                       % (len(transfers), res.text, res.status_code))
     else:
-        return res.json()['balance']
+        return res.json()['results']
+
+
+def cancelTransactions(transNums):
+    try:
+        url = TRANSACTIONS_SERVICE_URL + 'transactions/batch/cancel'
+        res = transactionsRequests.post(url, json={'numbers': transNums})
+    except ConnectionError as e:
+        raise ServiceUnavailable(
+              "Transactions service connection error: %s." % e)
+
+    if res.status_code != codes.ok:
+        raise NotFound("Cannot cancel transactions %s, resp %s, status code %s" \
+                       % (transNums, res.text, res.status_code))
+    else:
+        return res.json()['numbers']
+
+
+def tryCancelTransactions(transNums):
+    """cancelTransactions that only logs a failure."""
+    try:
+        cancelTransactions(transNums)
+    except Exception as e:
+        logger.error("Cannot cancel transactions %s: %s" % (transNums, e))
 
 
 def cancelTransaction(transNum):
     try:
         url = TRANSACTIONS_SERVICE_URL + 'transactions/%s' % transNum
-        res = requests.delete(url)
+        res = transactionsRequests.delete(url)
     except ConnectionError as e:
         raise ServiceUnavailable(
               "Transactions service connection error: %s." % e)
@@ -137,11 +502,89 @@ def cancelTransaction(transNum):
         return res.json()['number']
 
 
+def startBackground():
+    """Start the queue workers; called in the gunicorn worker process."""
+    global newPayments
+    if not ASYNC_PAYMENTS or newPayments is not None:
+        return
+    newPayments = threading.Event()
+    for i in range(QUEUE_WORKERS):
+        worker = threading.Thread(target=drainQueue, name='queue-%s' % i)
+        worker.daemon = True
+        worker.start()
+    logger.info("Started %s payment queue workers" % QUEUE_WORKERS)
+
+
+def drainQueue():
+    lastRecovery = 0
+    while True:
+        try:
+            newPayments.clear()
+            payments = db.claimPayments(QUEUE_BATCH_SIZE)
+            if payments:
+                processPayments(payments)
+                continue
+            if time.time() - lastRecovery > QUEUE_RECOVERY_AGE / 2:
+                lastRecovery = time.time()
+                recovered = db.recoverPayments(QUEUE_RECOVERY_AGE)
+                if recovered:
+                    logger.warning("%s abandoned payments marked unknown" \
+                                   % recovered)
+            newPayments.wait(QUEUE_POLL_INTERVAL)
+        except Exception as e:
+            logger.error("Payment queue: %s" % e)
+            time.sleep(QUEUE_RETRY_DELAY)
+        finally:
+            db.removeSession()
+
+
+def processPayments(payments):
+    """Execute claimed payments as one batch and record the outcome.
+
+    The transactions of the batch are recorded on its payments once they
+    are posted. A payment put back in the queue may then still have an
+    active transaction from its previous attempt, e.g. when the accounts
+    service was unreachable and canceling failed as well. Such transactions
+    are canceled, which is idempotent, before the payments run again;
+    until that succeeds the payments stay queued."""
+    stale = [p.transactionNum for p in payments
+             if p.transactionNum is not None]
+    if stale:
+        try:
+            cancelTransactions(stale)
+        except Exception as e:
+            logger.warning("Payment queue: cannot cancel transactions %s " \
+                           "of a previous attempt: %s, retrying" % (stale, e))
+            db.requeuePayments(payments)
+            time.sleep(QUEUE_RETRY_DELAY)
+            return
+    batch = [{'fromAccNum': int(p.fromAccNum), 'toAccNum': int(p.toAccNum),
+              'amount': p.amount} for p in payments]
+    try:
+        results = executeBatch(
+                      batch, lambda nums: db.recordTransactions(payments, nums))
+    except Timeout as e:
+        logger.error("Payment queue: batch timed out: %s" % e)
+        db.abandonPayments(payments, "Timed out: %s" % e)
+    except ServiceUnavailable as e:
+        logger.warning("Payment queue: %s, retrying" % e)
+        db.requeuePayments(payments)
+        time.sleep(QUEUE_RETRY_DELAY)
+    except NotFound as e:
+        db.finishPayments(payments, [{'status': 400, 'msg': str(e)}] \
+                                    * len(payments))
+    else:
+        db.finishPayments(payments, results)
+
+
 # All APIs provided by this application, automatically generated
 LOCAL_APIS = allLinks(app)
 # All external APIs that this application relies on, manually created
-KNOWN_REMOTE_APIS = [ACCOUNTS_SERVICE_URL + "accounts",
-                    TRANSACTIONS_SERVICE_URL + "transactions"]
+KNOWN_REMOTE_APIS = [ACCOUNTS_SERVICE_URL + "transfers",
+                    ACCOUNTS_SERVICE_URL + "accounts/batch",
+                    TRANSACTIONS_SERVICE_URL + "transactions",
+                    TRANSACTIONS_SERVICE_URL + "transactions/batch",
+                    TRANSACTIONS_SERVICE_URL + "transactions/batch/cancel"]
 
 
 # def main():
@@ -0,0 +1,210 @@
+import uuid
+from datetime import datetime, timedelta
+
+from flask import Flask
+from flask.ext.sqlalchemy import SQLAlchemy
+
+from sqlalchemy import event
+
+from general import sqlitePragmas
+
+app = Flask(__name__)
+app.config.from_object('db_controller.db_config')
+db = SQLAlchemy(app)
+
+# The SQLite profile of the service, see general.sqlitePragmas; an unknown
+# profile fails here, at startup.
+sqlitePragmas('payment', 'durable')
+
+# SQLAlchemy allows for the PRAGMA statement to be emitted automatically
+# for new connections through the usage of events.
+# Unlike the other services' databases the payment queue is the only
+# record of an accepted payment until it is executed, so its profile is
+# durable unless PAYMENT_SQLITE_PROFILE says otherwise. The listener is
+# bound to this engine only, so that these settings hold even when the
+# other services' databases are opened in the same process (monolith).
+@event.listens_for(db.get_engine(app), "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in sqlitePragmas('payment', 'durable'):
+        cursor.execute(pragma)
+    cursor.close()
+
+import models
+from models import Payment
+
+
+QUEUED = 0
+PROCESSING = 1
+EXECUTED = 2
+FAILED = 3
+UNKNOWN = 4
+
+STATUS_NAMES = {QUEUED: 'queued',
+                PROCESSING: 'processing',
+                EXECUTED: 'executed',
+                FAILED: 'failed',
+                UNKNOWN: 'unknown'}
+
+
+class dbCtrl():
+    """Wrapper over the payment queue database."""
+    def __init__(self, logger):
+        self.logger = logger
+        self.to_json = lambda payment: {
+                              "id": payment.id,
+                              "whenCreated": payment.whenCreated,
+                              "whenProcessed": payment.whenProcessed,
+                              "fromAccNum": payment.fromAccNum,
+                              "toAccNum": payment.toAccNum,
+                              "amount": payment.amount,
+                              "status": STATUS_NAMES[payment.status],
+                              "number": payment.transactionNum,
+                              "msg": payment.msg}
+
+    def enqueuePayment(self, fromAccNum, toAccNum, amount):
+        """Persist a payment for the batch workers. Returns its id or None."""
+        res = None
+        try:
+            p = Payment(whenCreated=datetime.now(), fromAccNum=fromAccNum,
+                        toAccNum=toAccNum, amount=amount, status=QUEUED)
+            db.session.add(p)
+            db.session.commit()
+            res = p.id
+        except Exception as error:
+            db.session.rollback()
+            self.logger.error(error)
+        return res
+
+    def recordUnknownPayment(self, fromAccNum, toAccNum, amount,
+                             transactionNum, msg):
+        """Persist a synchronous payment whose outcome is unknown, with its
+        transaction if it was recorded, so that it can be recovered. Returns
+        its id or None."""
+        res = None
+        try:
+            now = datetime.now()
+            p = Payment(whenCreated=now, whenProcessed=now,
+                        fromAccNum=fromAccNum, toAccNum=toAccNum,
+                        amount=amount, status=UNKNOWN,
+                        transactionNum=transactionNum, msg=msg[:256])
+            db.session.add(p)
+            db.session.commit()
+            res = p.id
+        except Exception as error:
+            db.session.rollback()
+            self.logger.error(error)
+        return res
+
+    def getPaymentById(self, paymentID, json=False):
+        try:
+            # A non existing id gives None
+            p = Payment.query.filter_by(id=paymentID).first()
+            if json:
+                return self.to_json(p) if p else None
+            else:
+                return p
+        except Exception as error:
+            db.session.rollback()
+            self.logger.error(error)
+
+    def claimPayments(self, limit):
+        """Mark up to limit queued payments, oldest first, as processing
+        and return them. A single UPDATE claims them, so two workers never
+        get the same payment."""
+        res = []
+        claim = uuid.uuid4().hex
+        queued = db.session.query(Payment.id) \
+                           .filter(Payment.status == QUEUED) \
+                           .order_by(Payment.id).limit(limit)
+        try:
+            Payment.query.filter(Payment.id.in_(queued.subquery())) \
+                         .update({'status': PROCESSING, 'claim': claim,
+                                  'whenClaimed': datetime.now()},
+                                 synchronize_session=False)
+            db.session.commit()
+            res = Payment.query.filter_by(claim=claim) \
+                               .order_by(Payment.id).all()
+        except Exception as error:
+            db.session.rollback()
+            self.logger.error(error)
+        return res
+
+    def finishPayments(self, payments, results):
+        """Record the outcome of claimed payments, one result per payment:
+        {'status': 200, 'number': transNum} or {'status': 4xx, 'msg': msg}."""
+        try:
+            now = datetime.now()
+            for p, result in zip(payments, results):
+                p.whenProcessed = now
+                if result.get('status') == 200:
+                    p.status = EXECUTED
+                    p.transactionNum = result.get('number')
+                else:
+                    p.status = FAILED
+                    p.msg = result.get('msg')
+            db.session.commit()
+        except Exception as error:
+            db.session.rollback()
+            self.logger.error(error)
+
+    def recordTransactions(self, payments, transNums):
+        """Record the transaction posted for each claimed payment."""
+        try:
+            for p, transNum in zip(payments, transNums):
+                p.transactionNum = transNum
+            db.session.commit()
+        except Exception as error:
+            db.session.rollback()
+            self.logger.error(error)
+
+    def requeuePayments(self, payments):
+        """Put claimed payments back, e.g. when a service was unreachable."""
+        self.setStatus(payments, QUEUED)
+
+    def abandonPayments(self, payments, msg):
+        """Payments whose outcome cannot be told, e.g. after a timeout."""
+        self.setStatus(payments, UNKNOWN, msg)
+
+    def setStatus(self, payments, status, msg=None):
+        try:
+            for p in payments:
+                p.status = status
+                p.msg = msg
+            db.session.commit()
+        except Exception as error:
+            db.session.rollback()
+            self.logger.error(error)
+
+    def recoverPayments(self, olderThan):
+        """Payments claimed more than olderThan seconds ago and still
+        processing were left behind by a worker that died. They may or may
+        not have been executed, so they are marked unknown rather than
+        executed twice. Returns their number."""
+        res = 0
+        try:
+            since = datetime.now() - timedelta(seconds=olderThan)
+            res = Payment.query.filter(Payment.status == PROCESSING,
+                                       Payment.whenClaimed < since) \
+                         .update({'status': UNKNOWN,
+                                  'msg': 'Interrupted while processing'},
+                                 synchronize_session=False)
+            db.session.commit()
+        except Exception as error:
+            db.session.rollback()
+            self.logger.error(error)
+        return res
+
+    def countByStatus(self):
+        try:
+            counts = db.session.query(Payment.status, db.func.count()) \
+                               .group_by(Payment.status).all()
+            return dict((STATUS_NAMES[s], n) for s, n in counts)
+        except Exception as error:
+            db.session.rollback()
+            self.logger.error(error)
+            return {}
+
+    def removeSession(self):
+        """Release the session of a background worker."""
+        db.session.remove()
@@ -0,0 +1,13 @@
+import os
+
+# The volume can be moved, e.g. to run the payment tests outside of Docker
+DATAVOL = os.getenv('PAYMENT_DATAVOL', "/paymentsvol")
+# Path to the DB file.
+SQLALCHEMY_DATABASE_URI_SHORT = os.path.join(DATAVOL, 'payments.db')
+# SQLLite uri required by the Flask-SQLAlchemy extension.
+SQLALCHEMY_DATABASE_URI = 'sqlite:///' + SQLALCHEMY_DATABASE_URI_SHORT
+# Path to the SQLAlchemy-migrate file
+SQLALCHEMY_MIGRATE_REPO = os.path.join(DATAVOL, 'db_repository')
+# To turn off the Flask-SQLAlchemy event system and disable the
+# annoying warning (likely to be fixed in Flask-SQLAlchemy v3).
+SQLALCHEMY_TRACK_MODIFICATIONS = False
\ No newline at end of file
@@ -0,0 +1,25 @@
+from db_controller import db
+
+# Payment status codes:
+# 0 - queued
+# 1 - processing (claimed by a batch worker)
+# 2 - executed
+# 3 - failed
+# 4 - unknown (interrupted while processing or timed out, check the
+#     transactions)
+
+class Payment(db.Model):
+    id = db.Column(db.Integer, primary_key = True)
+    whenCreated = db.Column(db.DateTime)
+    whenClaimed = db.Column(db.DateTime)
+    whenProcessed = db.Column(db.DateTime)
+    fromAccNum = db.Column(db.String(64))
+    toAccNum = db.Column(db.String(64))
+    amount = db.Column(db.Integer)
+    status = db.Column(db.Integer, index = True)
+    claim = db.Column(db.String(64))
+    transactionNum = db.Column(db.Integer)
+    msg = db.Column(db.String(256))
+
+    def __repr__(self):
+        return '<Payment id %r>' % (self.id)
@@ -0,0 +1,153 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from requests.exceptions import Timeout
+
+
+# The service-wide logger set up by general.log
+logger = logging.getLogger()
+
+
+class Step():
+    """One step of a saga: action(*args) and the compensation that undoes
+    it, called with the result of the action."""
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+    UNKNOWN = 'unknown'
+    COMPENSATED = 'compensated'
+    COMPENSATION_FAILED = 'compensation failed'
+
+    def __init__(self, name, action, args=(), compensation=None):
+        self.name = name
+        self.action = action
+        self.args = args
+        self.compensation = compensation
+        self.state = self.PENDING
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.action(*self.args)
+            self.state = self.DONE
+        except Timeout as e:
+            # The service may still have applied the step, compensating
+            # it could then undo something that never happened
+            self.error = e
+            self.state = self.UNKNOWN
+        except Exception as e:
+            self.error = e
+            self.state = self.FAILED
+
+    def compensate(self):
+        if self.compensation is None:
+            return
+        try:
+            self.compensation(self.result)
+            self.state = self.COMPENSATED
+        except Exception as e:
+            logger.error("Saga step %s: compensation failed: %s" \
+                         % (self.name, e))
+            self.state = self.COMPENSATION_FAILED
+
+
+class SagaError(Exception):
+    """A saga failed; the completed steps have been compensated.
+
+    error is the error of the first failed step."""
+    def __init__(self, saga, error):
+        Exception.__init__(self, "Saga %s failed: %s" % (saga.name, error))
+        self.saga = saga
+        self.error = error
+
+
+class SagaUnknownError(SagaError):
+    """The outcome of a step of a saga is unknown, e.g. it timed out.
+
+    Nothing has been compensated: the saga may well have completed, and
+    undoing its other steps would leave it half applied. It is up to the
+    caller to record the saga for recovery."""
+
+
+class Saga():
+    def __init__(self, name, steps):
+        self.name = name
+        self.steps = steps
+
+    def failedSteps(self):
+        return [s for s in self.steps if s.state in (Step.FAILED,
+                                                      Step.UNKNOWN)]
+
+    def unknownSteps(self):
+        return [s for s in self.steps if s.state == Step.UNKNOWN]
+
+    def result(self, name):
+        """The result of the step name if it is done, otherwise None."""
+        for s in self.steps:
+            if s.name == name and s.state == Step.DONE:
+                return s.result
+        return None
+
+    def states(self):
+        return dict((s.name, s.state) for s in self.steps)
+
+
+class SagaExecutor():
+    """Runs sagas whose steps do not depend on each other.
+
+    All steps of a saga are issued concurrently, so a saga takes about as
+    long as its slowest step. If any step fails, the steps that succeeded
+    are compensated, again concurrently, and SagaError is raised. If the
+    outcome of any step is unknown nothing is compensated and
+    SagaUnknownError is raised instead. Under the gevent worker the threads
+    of the pool are greenlets."""
+    def __init__(self, maxWorkers=32):
+        self.pool = ThreadPoolExecutor(maxWorkers)
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.compensated = 0
+        self.inDoubt = 0
+        self.unknown = 0
+        self.compensationFailures = 0
+
+    def run(self, name, steps):
+        saga = Saga(name, steps)
+        wait([self.pool.submit(s.run) for s in steps])
+        failed = saga.failedSteps()
+        if not failed:
+            self.count(completed=1)
+            return saga
+
+        unknown = saga.unknownSteps()
+        if unknown:
+            logger.warning("Saga %s in doubt: %s" % (name, saga.states()))
+            self.count(inDoubt=1, unknown=len(unknown))
+            raise SagaUnknownError(saga, unknown[0].error)
+
+        done = [s for s in steps if s.state == Step.DONE]
+        wait([self.pool.submit(s.compensate) for s in done])
+        logger.warning("Saga %s compensated: %s" % (name, saga.states()))
+        self.count(
+            compensated=1,
+            compensationFailures=len([s for s in done if s.state == \
+                                      Step.COMPENSATION_FAILED]))
+        raise SagaError(saga, failed[0].error)
+
+    def count(self, completed=0, compensated=0, inDoubt=0, unknown=0,
+              compensationFailures=0):
+        with self.lock:
+            self.completed += completed
+            self.compensated += compensated
+            self.inDoubt += inDoubt
+            self.unknown += unknown
+            self.compensationFailures += compensationFailures
+
+    def stats(self):
+        with self.lock:
+            return {"completed": self.completed,
+                    "compensated": self.compensated,
+                    "inDoubt": self.inDoubt,
+                    "unknownSteps": self.unknown,
+                    "compensationFailures": self.compensationFailures}
@@ -1,10 +1,11 @@
 import os
 import sys
+import json
 import datetime
 
-from flask import Flask, request, abort
+from flask import Flask, Response, request, abort
 
-from general import log, getEnvVar, isDocker, niceJson, allLinks
+from general import log, getEnvVar, isDocker, niceJson, allLinks, json_serial
 from db_controller import db_create, db_migrate, dbCtrl
 
 
@@ -40,8 +41,22 @@ else:
 app = Flask(__name__)
 
 
+# Largest number of transactions accepted by one batch request
+MAX_BATCH_SIZE = int(getEnvVar('MAX_BATCH_SIZE', 1000))
+# Largest number of transactions listed by one GET /transactions, also its
+# default; a streamed listing has no limit
+MAX_PAGE_SIZE = int(getEnvVar('MAX_PAGE_SIZE', 1000))
+# Transactions read by each query of a streamed listing
+STREAM_CHUNK_SIZE = int(getEnvVar('STREAM_CHUNK_SIZE', 1000))
+
+
+# Group commit: writes arriving within GROUP_COMMIT_WINDOW seconds, up to
+# GROUP_COMMIT_SIZE of them, share one commit; 0 commits every write alone
+GROUP_COMMIT_WINDOW = float(getEnvVar('GROUP_COMMIT_WINDOW', 0))
+GROUP_COMMIT_SIZE = int(getEnvVar('GROUP_COMMIT_SIZE', 100))
+
 # Load DB controller
-db = dbCtrl(logger)
+db = dbCtrl(logger, GROUP_COMMIT_WINDOW, GROUP_COMMIT_SIZE)
 
 def prepareDB():
     """Insure presence of the required DB files."""
@@ -50,6 +65,7 @@ def prepareDB():
         if not db_create.isDBfile():
             db_create.main()
             db_migrate.main()
+        db_migrate.createIndexes()
         res = True
     return res
 
@@ -64,6 +80,12 @@ def hello():
     return niceJson({"subresource_uris": allLinks(app)}, 200)
 
 
+@app.route("/stats", methods=['GET'])
+def stats():
+    return niceJson({"groupCommit": db.commits.stats() if db.commits else {}},
+                    200)
+
+
 @app.route("/transactions", methods=['GET'])
 @jwt_conditional(requests)
 def transactionsIndex():
@@ -71,10 +93,39 @@ def transactionsIndex():
     if accNum:
         res = db.getAllTransactionsForAcc(accNum, json=True)
     else:
-        res = db.getAllTransactions()
+        return transactionsPage()
     return niceJson(res, 200)
 
 
+def transactionsPage():
+    """All transactions, a page at a time: ?after=<number>&limit=<n> lists
+    the transactions numbered above after. A full page links to the next
+    one. Asked for application/x-ndjson, all transactions above after are
+    streamed instead, one JSON object per line."""
+    try:
+        after = int(request.args.get('after', 0))
+        limit = min(int(request.args.get('limit', MAX_PAGE_SIZE)),
+                    MAX_PAGE_SIZE)
+        if limit <= 0:
+            raise ValueError()
+    except ValueError:
+        return niceJson({'msg': 'Expected integers after and positive limit'},
+                        400)
+    if request.accept_mimetypes.best_match(['application/json',
+                             'application/x-ndjson']) == 'application/x-ndjson':
+        lines = (json.dumps(t, sort_keys=True, default=json_serial) + '\n'
+                 for t in db.iterTransactions(after, STREAM_CHUNK_SIZE))
+        return Response(lines, mimetype='application/x-ndjson')
+    res = db.getTransactionsPage(after, limit)
+    if res is None:
+        return niceJson({}, 400)
+    response = niceJson(res, 200)
+    if len(res) == limit:
+        response.headers['Link'] = '<%s?after=%s&limit=%s>; rel="next"' \
+                                   % (request.path, res[-1]['number'], limit)
+    return response
+
+
 @app.route("/transactions", methods=['POST'])
 @jwt_conditional(requests)
 def postTransaction():
@@ -94,6 +145,45 @@ def postTransaction():
     return niceJson(res, res_code)
 
 
+@app.route("/transactions/batch", methods=['POST'])
+@jwt_conditional(requests)
+def postTransactions():
+    if not request.json or not 'transactions' in request.json:
+        abort(400)
+    transactions = request.json['transactions']
+    if not isinstance(transactions, list) or \
+       not 0 < len(transactions) <= MAX_BATCH_SIZE:
+        abort(400)
+    try:
+        transfers = [(t['fromAccNum'], t['toAccNum'], int(t['amount']))
+                     for t in transactions]
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+    res = ""
+    res_code = 400
+    transNums = db.addTransactionsBetweenAccs(transfers)
+    if transNums:
+        res = {'numbers': transNums}
+        res_code = 200
+    return niceJson(res, res_code)
+
+
+@app.route("/transactions/batch/cancel", methods=['POST'])
+@jwt_conditional(requests)
+def cancelTransactions():
+    if not request.json or not 'numbers' in request.json:
+        abort(400)
+    numbers = request.json['numbers']
+    if not isinstance(numbers, list) or len(numbers) > MAX_BATCH_SIZE:
+        abort(400)
+    res = ""
+    res_code = 400
+    if db.cancelTransactions(numbers) == 0:
+        res = {'numbers': numbers}
+        res_code = 200
+    return niceJson(res, res_code)
+
+
 @app.route("/transactions/<number>", methods=['GET'])
 @jwt_conditional(requests)
 def getTransaction(number):
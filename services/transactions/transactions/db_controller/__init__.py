@@ -3,24 +3,29 @@ from datetime import datetime
 
 from flask import Flask
 from flask.ext.sqlalchemy import SQLAlchemy
-from sqlalchemy import or_
 
-from sqlalchemy.engine import Engine
 from sqlalchemy import event
 
+from general import sqlitePragmas
+from batching import GroupCommit
+
+app = Flask(__name__)
+app.config.from_object('db_controller.db_config')
+db = SQLAlchemy(app)
+
+# The SQLite profile of the service, see general.sqlitePragmas; an unknown
+# profile fails here, at startup.
+sqlitePragmas('transactions')
+
 # SQLAlchemy allows for the PRAGMA statement to be emitted automatically
 # for new connections through the usage of events.
-@event.listens_for(Engine, "connect")
+@event.listens_for(db.get_engine(app), "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA synchronous = OFF")
-    cursor.execute("PRAGMA journal_mode = MEMORY")
+    for pragma in sqlitePragmas('transactions'):
+        cursor.execute(pragma)
     cursor.close()
 
-app = Flask(__name__)
-app.config.from_object('db_controller.db_config')
-db = SQLAlchemy(app)
-
 import models
 from models import Transaction
 
@@ -29,9 +34,16 @@ TRANSACTION_NUM_LENGTH = 5
 
 
 class dbCtrl():
-    """Wrapper over the transactions database."""
-    def __init__(self, logger):
+    """Wrapper over the transactions database.
+
+    With a commitWindow, writes of concurrent requests are committed
+    together, see GroupCommit."""
+    def __init__(self, logger, commitWindow=0, commitMaxSize=100):
         self.accumulator = 1
+        self.commits = None
+        if commitWindow > 0:
+            self.commits = GroupCommit(db.session, commitWindow,
+                                       commitMaxSize)
         self.logger = logger
         self.to_json = lambda transaction: {
                               "whenCreated": transaction.whenCreated,
@@ -44,12 +56,19 @@ class dbCtrl():
                               "status": transaction.status}
 
     def getAllTransactionsForAcc(self, accNum, json=False):
+        """Transactions from or to an account, oldest first.
+
+        Each side is an equality lookup in the index of its column, the
+        two merged by a UNION, so the cost follows the number of
+        transactions of the account rather than the size of the ledger.
+        Numbers are given in the order transactions are created."""
         try:
-            # A non existing user_id gives None
-            transactions = Transaction.query.filter(or_(
-                                       Transaction.fromAccNum.like(accNum),
-                                       Transaction.toAccNum.like(accNum)
-                                       ))
+            accNum = str(accNum)
+            transactions = Transaction.query \
+                               .filter(Transaction.fromAccNum == accNum) \
+                               .union(Transaction.query.filter(
+                                          Transaction.toAccNum == accNum)) \
+                               .order_by(Transaction.number)
             self.logger.info('Transactions for accNum (%s) are retrieved' \
                              % accNum)
             if json:
@@ -74,42 +93,124 @@ class dbCtrl():
             db.session.rollback()
             self.logger.error(error)
 
-    def getAllTransactions(self):
+    def getTransactionsPage(self, after, limit):
+        """Up to limit transactions with numbers above after, in number
+        order. As for accounts, paging by the last number seen reads only
+        the rows of the page."""
         try:
-            transactions = Transaction.query.all()
-            self.logger.info('All accounts are retrieved')
+            transactions = Transaction.query \
+                               .filter(Transaction.number > after) \
+                               .order_by(Transaction.number).limit(limit)
+            self.logger.info('Transactions after (%s) are retrieved' % after)
             return [self.to_json(t) for t in transactions]
         except Exception as error:
             db.session.rollback()
             self.logger.error(error)
 
+    def iterTransactions(self, after=0, chunkSize=1000):
+        """Yield the transactions with numbers above after, in number order,
+        as JSON, without holding them all in memory.
+
+        Rows are read from the cursor one at a time, chunkSize rows per
+        query, each query starting after the last number of the previous
+        one. A single query over the whole ledger would keep the database
+        locked, and writers waiting, for as long as the reader takes. The
+        rows are read on a connection of their own, as the generator
+        outlives the request's session."""
+        transactions = Transaction.__table__
+        conn = db.engine.connect()
+        try:
+            while True:
+                rows = conn.execute(transactions.select()
+                                    .where(transactions.c.number > after)
+                                    .order_by(transactions.c.number)
+                                    .limit(chunkSize))
+                count = 0
+                for row in rows:
+                    count += 1
+                    after = row.number
+                    yield self.to_json(row)
+                if count < chunkSize:
+                    break
+        finally:
+            conn.close()
+
+    def commitWrite(self, write):
+        """Run write, a function changing db.session, and commit it; with
+        group commit together with the writes of concurrent requests."""
+        if self.commits is not None:
+            return self.commits.run(write)
+        res = write()
+        db.session.commit()
+        return res
+
     def addTransactionBetweenAccs(self, fromAccNum, toAccNum, amount):
+        def write():
+            t = Transaction(whenCreated=datetime.utcnow(), 
+                            amount=amount, 
+                            fromAccNum=fromAccNum, 
+                            toAccNum=toAccNum, status=0)
+            db.session.add(t)
+            db.session.flush()
+            return t.number
         res = None
         if fromAccNum and toAccNum:
             try:
-                t = Transaction(whenCreated=datetime.utcnow(), 
-                                amount=amount, 
-                                fromAccNum=fromAccNum, 
-                                toAccNum=toAccNum, status=0)
-                db.session.add(t)
-                db.session.commit()
-                res = t.number
+                res = self.commitWrite(write)
             except Exception as error:
                 db.session.rollback()
                 self.logger.error(error)
             return res
 
-    def cancelTransaction(self, transNum):
+    def addTransactionsBetweenAccs(self, transfers):
+        """Record many (fromAccNum, toAccNum, amount) transfers in one commit.
+
+        Returns the transaction numbers in the order of transfers."""
+        def write():
+            now = datetime.utcnow()
+            transactions = [Transaction(whenCreated=now,
+                                        amount=amount,
+                                        fromAccNum=fromAccNum,
+                                        toAccNum=toAccNum, status=0)
+                            for fromAccNum, toAccNum, amount in transfers]
+            db.session.add_all(transactions)
+            db.session.flush()
+            return [t.number for t in transactions]
+        res = None
+        try:
+            res = self.commitWrite(write)
+            self.logger.info('%s transactions are added' % len(res))
+        except Exception as error:
+            db.session.rollback()
+            self.logger.error(error)
+        return res
+
+    def cancelTransactions(self, transNums):
+        def write():
+            Transaction.query.filter(Transaction.number.in_(transNums)) \
+                       .update({'status': 2,
+                                'whenCanceled': datetime.utcnow()},
+                               synchronize_session=False)
         res = 1
         try:
-            t = self.getTransactionByNum(transNum)
-            t.status = 2
-            t.whenCanceled = datetime.utcnow()
-            db.session.add(t)
-            db.session.commit()
+            self.commitWrite(write)
             res = 0
         except Exception as error:
             db.session.rollback()
             self.logger.error(error)
         return res
 
+    def cancelTransaction(self, transNum):
+        def write():
+            return Transaction.query.filter_by(number=transNum) \
+                              .update({'status': 2,
+                                       'whenCanceled': datetime.utcnow()},
+                                      synchronize_session=False)
+        res = 1
+        try:
+            if self.commitWrite(write):
+                res = 0
+        except Exception as error:
+            db.session.rollback()
+            self.logger.error(error)
+        return res
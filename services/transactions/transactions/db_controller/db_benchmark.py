@@ -0,0 +1,114 @@
+#!flask/bin/python
+"""Latency of the transaction history of an account as the ledger grows.
+
+The ledger is filled with random transfers between --accounts accounts up
+to each size of --sizes in turn. At each size the history of random
+accounts is read through dbCtrl.getAllTransactionsForAcc, and, with
+--like, through the former LIKE filter, which scans the whole ledger.
+The rows are kept, so a later run only adds what is missing. Run from the
+service directory on a scratch volume:
+
+    TRANSACTIONS_DATAVOL=/tmp/transactionsvol \\
+        python -m db_controller.db_benchmark --sizes 250000,1000000,2000000
+"""
+import time
+import random
+import logging
+import argparse
+from datetime import datetime
+
+from sqlalchemy import or_
+
+from db_controller import db, dbCtrl, db_create, db_migrate
+from db_controller.models import Transaction
+
+
+logger = logging.getLogger()
+
+CHUNK = 50000
+
+
+def fill(size, accounts):
+    """Add random transfers until the ledger holds size of them."""
+    count = db.session.query(db.func.count(Transaction.number)).scalar()
+    db.session.remove()
+    now = datetime.utcnow()
+    while count < size:
+        rows = []
+        for i in range(min(CHUNK, size - count)):
+            fromAccNum, toAccNum = random.sample(xrange(1, accounts + 1), 2)
+            rows.append({'whenCreated': now, 'amount': 1,
+                         'fromAccNum': str(fromAccNum),
+                         'toAccNum': str(toAccNum), 'status': 1})
+        db.engine.execute(Transaction.__table__.insert(), rows)
+        count += len(rows)
+    return count
+
+
+def likeQuery(accNum):
+    """getAllTransactionsForAcc as it was."""
+    return Transaction.query.filter(or_(Transaction.fromAccNum.like(accNum),
+                                        Transaction.toAccNum.like(accNum)))
+
+
+def timeQueries(query, accNums):
+    """Mean milliseconds of query(accNum).all() and the mean row count."""
+    rows = 0
+    start = time.time()
+    for accNum in accNums:
+        rows += len(query(accNum))
+    elapsed = time.time() - start
+    db.session.remove()
+    return 1000 * elapsed / len(accNums), float(rows) / len(accNums)
+
+
+def queryPlan(query):
+    sql = str(query.statement.compile(dialect=db.engine.dialect,
+                                      compile_kwargs={'literal_binds': True}))
+    return [row[-1] for row in db.engine.execute('EXPLAIN QUERY PLAN ' + sql)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='250000,1000000,2000000',
+                        help='comma separated ledger sizes to measure at')
+    parser.add_argument('--accounts', type=int, default=100000)
+    parser.add_argument('-q', '--queries', type=int, default=200,
+                        help='accounts read at each size')
+    parser.add_argument('--like', type=int, default=0, metavar='N',
+                        help='also read N accounts with the LIKE filter')
+    args = parser.parse_args()
+
+    if not db_create.isDBVolume():
+        print("Missing volume %s" % db_create.DATAVOL)
+        return
+    if not db_create.isDBfile():
+        db_create.main()
+        db_migrate.main()
+    db_migrate.createIndexes()
+
+    ctrl = dbCtrl(logger)
+    for size in [int(s) for s in args.sizes.split(',')]:
+        start = time.time()
+        count = fill(size, args.accounts)
+        filled = time.time() - start
+        accNums = [str(random.randint(1, args.accounts))
+                   for i in range(args.queries)]
+        ms, rows = timeQueries(
+                       lambda n: ctrl.getAllTransactionsForAcc(n, json=True),
+                       accNums)
+        print("%d transactions (filled in %.0fs): indexed %.2f ms per " \
+              "account, %.1f transactions each" % (count, filled, ms, rows))
+        if args.like:
+            ms, rows = timeQueries(lambda n: likeQuery(n).all(),
+                                   accNums[:args.like])
+            print("%d transactions: LIKE %.2f ms per account, %.1f " \
+                  "transactions each" % (count, ms, rows))
+    print("Query plan: %s" % '; '.join(
+              queryPlan(ctrl.getAllTransactionsForAcc('1'))))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -1,6 +1,7 @@
-import os.path
+import os
 
-DATAVOL = "/transactionsvol"
+# The volume can be moved, e.g. to run db_benchmark outside of Docker
+DATAVOL = os.getenv('TRANSACTIONS_DATAVOL', "/transactionsvol")
 # Path to the DB file.
 SQLALCHEMY_DATABASE_URI_SHORT = os.path.join(DATAVOL, 'transactions.db')
 # SQLLite uri required by the Flask-SQLAlchemy extension.
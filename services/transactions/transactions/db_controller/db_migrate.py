@@ -8,6 +8,7 @@
 
 import imp
 from migrate.versioning import api
+from sqlalchemy import inspect
 
 from db_controller import db
 from db_controller.db_config import SQLALCHEMY_DATABASE_URI
@@ -30,6 +31,16 @@ def main():
 	print('New migration saved as ' + migration)
 	print('Current database version: ' + str(v))
 
+def createIndexes():
+	# SQLAlchemy-migrate does not compare indexes, so indexes added to the
+	# models after the database was created are created here instead.
+	inspector = inspect(db.engine)
+	for table in db.metadata.sorted_tables:
+		existing = set(i['name'] for i in inspector.get_indexes(table.name))
+		for index in table.indexes:
+			if index.name not in existing:
+				index.create(bind=db.engine)
+				print('Created index ' + index.name)
 
 
 if __name__ == '__main__':
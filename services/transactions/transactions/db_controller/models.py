@@ -11,8 +11,8 @@ class Transaction(db.Model):
     whenExecuted = db.Column(db.DateTime) 
     whenCanceled = db.Column(db.DateTime)  
     amount = db.Column(db.Integer)
-    fromAccNum = db.Column(db.String(64))
-    toAccNum = db.Column(db.String(64))
+    fromAccNum = db.Column(db.String(64), index=True)
+    toAccNum = db.Column(db.String(64), index=True)
     status = db.Column(db.Integer)
 
     def __repr__(self):
@@ -1,22 +1,27 @@
 from flask import Flask
 from flask.ext.sqlalchemy import SQLAlchemy
 
-from sqlalchemy.engine import Engine
 from sqlalchemy import event
 
+from general import sqlitePragmas
+
+app = Flask(__name__)
+app.config.from_object('db_controller.db_config')
+db = SQLAlchemy(app)
+
+# The SQLite profile of the service, see general.sqlitePragmas; an unknown
+# profile fails here, at startup.
+sqlitePragmas('users')
+
 # SQLAlchemy allows for the PRAGMA statement to be emitted automatically
 # for new connections through the usage of events.
-@event.listens_for(Engine, "connect")
+@event.listens_for(db.get_engine(app), "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA synchronous = OFF")
-    cursor.execute("PRAGMA journal_mode = MEMORY")
+    for pragma in sqlitePragmas('users'):
+        cursor.execute(pragma)
     cursor.close()
 
-app = Flask(__name__)
-app.config.from_object('db_controller.db_config')
-db = SQLAlchemy(app)
-
 import models
 from models import User
 
@@ -1,6 +1,7 @@
-import os.path
+import os
 
-DATAVOL = "/usersvol"
+# The volume can be moved, e.g. to run the service outside of Docker
+DATAVOL = os.getenv('USERS_DATAVOL', "/usersvol")
 # Path to the DB file.
 SQLALCHEMY_DATABASE_URI_SHORT = os.path.join(DATAVOL, 'users.db')
 # SQLLite uri required by the Flask-SQLAlchemy extension.
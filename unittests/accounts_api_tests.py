@@ -0,0 +1,167 @@
+import os
+import sys
+import json
+import shutil
+import logging
+import tempfile
+import unittest
+
+# The accounts service runs in this process, spread over SHARDS shards in
+# a scratch volume. Its modules and the ones shared by the services (see
+# services/common_files) are imported from the tree.
+SERVICES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        '..', 'services')
+sys.path.insert(0, os.path.join(SERVICES, 'common_files', 'general'))
+sys.path.insert(0, os.path.join(SERVICES, 'accounts', 'accounts'))
+# Each service has db_controller and api modules of its own;
+# those of a service imported before are set aside, as Python 2 clears
+# the globals of a module once it is garbage collected.
+otherModules = [sys.modules.pop(m) for m in list(sys.modules)
+                if m.split('.')[0] in ('db_controller', 'api')]
+
+SHARDS = 3
+DATAVOL = tempfile.mkdtemp()
+os.environ['ACCOUNTS_DATAVOL'] = DATAVOL
+os.environ['ACCOUNTS_SHARDS'] = str(SHARDS)
+os.environ['MAX_PAGE_SIZE'] = '5'
+os.environ['MAX_MULTI_GET_SIZE'] = '3'
+# The first account of shard 0
+HOT_ACCOUNT = SHARDS
+os.environ['HOT_ACCOUNTS'] = str(HOT_ACCOUNT)
+
+import api
+
+# The service logs at INFO, the errors provoked here need not be shown
+logging.getLogger().setLevel(logging.CRITICAL)
+
+
+def tearDownModule():
+    shutil.rmtree(DATAVOL, ignore_errors=True)
+
+
+class AccountsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = api.app.test_client()
+
+    def post(self, path, doc):
+        res = self.client.post(path, data=json.dumps(doc),
+                               content_type='application/json')
+        return res.status_code, json.loads(res.data)
+
+    def get(self, path):
+        res = self.client.get(path)
+        return res.status_code, json.loads(res.data)
+
+
+class TestAccountsPage(AccountsTestCase):
+    def setUp(self):
+        super(TestAccountsPage, self).setUp()
+        # Opened one at a time, so spread over the shards
+        for userID in range(2 * SHARDS + 1):
+            self.assertEqual(self.post('/accounts',
+                                       {'userID': userID})[0], 200)
+
+    def test_pages_follow_links(self):
+        accNums = []
+        path = '/accounts?limit=3'
+        pages = 0
+        while path:
+            res = self.client.get(path)
+            self.assertEqual(res.status_code, 200)
+            page = json.loads(res.data)
+            self.assertLessEqual(len(page), 3)
+            accNums += [a['accNum'] for a in page]
+            pages += 1
+            link = res.headers.get('Link')
+            path = link and link[1:link.index('>')]
+        # In number order, with neither duplicates nor gaps
+        every = [a['accNum'] for a in api.db.getAccountsPage(0, 1000)]
+        self.assertEqual(accNums, every)
+        self.assertEqual(sorted(set(accNums)), accNums)
+        self.assertEqual(len(set(n % SHARDS for n in accNums)), SHARDS)
+        # Only a page short of the limit, empty if need be, ends the listing
+        self.assertEqual(pages, len(every) // 3 + 1)
+
+    def test_page_boundary(self):
+        status, first = self.get('/accounts?limit=2')
+        status, second = self.get('/accounts?after=%s&limit=2'
+                                  % first[-1]['accNum'])
+        self.assertEqual(second, api.db.getAccountsPage(0, 4)[2:])
+
+    def test_page_size_bounded(self):
+        res = self.client.get('/accounts?limit=100')
+        self.assertEqual(len(json.loads(res.data)), api.MAX_PAGE_SIZE)
+        self.assertIn('limit=%s>' % api.MAX_PAGE_SIZE, res.headers['Link'])
+
+    def test_bad_page(self):
+        for query in ['limit=0', 'after=x']:
+            self.assertEqual(self.get('/accounts?' + query)[0], 400)
+
+
+
+class TestBulkAccounts(AccountsTestCase):
+    def test_bulk_then_multi_get(self):
+        status, res = self.post('/accounts/bulk', {'userIDs': [7, 5, 6]})
+        self.assertEqual(status, 200)
+        accNums = res['accNums']
+        status, accounts = self.get('/accounts?accNum=%s,%s,%s'
+                                    % (accNums[2], accNums[0] + 3000,
+                                       accNums[0]))
+        self.assertEqual(status, 200)
+        self.assertEqual([(a['accNum'], a['user_id'], a['balance'])
+                          for a in accounts],
+                         [(accNums[2], 6, api.DEFAULT_BALANCE),
+                          (accNums[0], 7, api.DEFAULT_BALANCE)])
+
+    def test_bad_bulk(self):
+        for userIDs in [[], [1, 'x'], 1]:
+            res = self.client.post('/accounts/bulk',
+                                   data=json.dumps({'userIDs': userIDs}),
+                                   content_type='application/json')
+            self.assertEqual(res.status_code, 400)
+
+    def test_bad_multi_get(self):
+        for accNums in ['1,x', '1,2,3,4']:
+            self.assertEqual(self.get('/accounts?accNum=' + accNums)[0], 400)
+
+
+
+class TestHotAccount(AccountsTestCase):
+    def setUp(self):
+        super(TestHotAccount, self).setUp()
+        # New accounts go to the shards in turn
+        accNums = [self.post('/accounts', {'userID': 1})[1]['accNum']
+                   for i in range(2 * SHARDS)]
+        self.assertIn(HOT_ACCOUNT, api.db.hot)
+        self.assertIsNotNone(api.db.getAccountByNum(HOT_ACCOUNT))
+        self.sameShard = [n for n in accNums if n % SHARDS == 0][0]
+        self.otherShard = [n for n in accNums if n % SHARDS == 1][0]
+
+    def balance(self):
+        return self.get('/accounts/%s' % HOT_ACCOUNT)[1]['balance']
+
+    def transfer(self, fromAccNum, toAccNum, amount):
+        status, res = self.post('/transfers', {'fromAccNum': fromAccNum,
+                                               'toAccNum': toAccNum,
+                                               'amount': amount})
+        self.assertEqual(status, 200)
+        return res
+
+    def test_balances_are_numbers(self):
+        before = self.balance()
+        status, res = self.post('/accounts/%s' % HOT_ACCOUNT, {'amount': 5})
+        self.assertEqual((status, res), (200, {'balance': before + 5}))
+        for payer in (self.sameShard, self.otherShard):
+            res = self.transfer(payer, HOT_ACCOUNT, 10)
+            self.assertEqual(res['toBalance'], self.balance())
+        self.assertEqual(self.balance(), before + 25)
+        res = self.transfer(HOT_ACCOUNT, self.otherShard, before + 25)
+        self.assertEqual(res['fromBalance'], 0)
+        status, res = self.post('/accounts/batch', {'transfers': [
+                                    {'fromAccNum': self.sameShard,
+                                     'toAccNum': HOT_ACCOUNT, 'amount': 1}]})
+        self.assertEqual(res['results'][0]['toBalance'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,365 @@
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import unittest
+
+# The accounts database is opened in this process, spread over SHARDS
+# shards in a scratch volume. The service modules and the ones shared by
+# the services (see services/common_files) are imported from the tree.
+SERVICES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        '..', 'services')
+sys.path.insert(0, os.path.join(SERVICES, 'common_files', 'general'))
+sys.path.insert(0, os.path.join(SERVICES, 'accounts', 'accounts'))
+# Each service has a db_controller package of its own;
+# those of a service imported before are set aside, as Python 2 clears
+# the globals of a module once it is garbage collected.
+otherModules = [sys.modules.pop(m) for m in list(sys.modules)
+                if m.split('.')[0] == 'db_controller']
+
+SHARDS = 4
+DATAVOL = tempfile.mkdtemp()
+os.environ['ACCOUNTS_DATAVOL'] = DATAVOL
+os.environ['ACCOUNTS_SHARDS'] = str(SHARDS)
+
+from db_controller import dbCtrl, db_create, shardOf, TransferError, \
+                          InsufficientFunds, engines
+
+logger = logging.getLogger('accounts_db_tests')
+logger.setLevel(logging.CRITICAL)
+
+
+def setUpModule():
+    db_create.main()
+    db_create.createShards()
+
+
+def tearDownModule():
+    shutil.rmtree(DATAVOL, ignore_errors=True)
+
+
+class TestShards(unittest.TestCase):
+    def test_pragmas_set_on_every_shard(self):
+        # The default profile, fast
+        for engine in engines:
+            conn = engine.connect()
+            try:
+                self.assertEqual(conn.execute('PRAGMA journal_mode')
+                                     .scalar(), 'memory')
+                self.assertEqual(conn.execute('PRAGMA synchronous')
+                                     .scalar(), 0)
+            finally:
+                conn.close()
+
+
+
+class TestUpdateAccount(unittest.TestCase):
+    ctrl = dbCtrl(logger)
+
+    def setUp(self):
+        self.accNum = self.ctrl.createAccountForUserId('user', 100)
+
+    def balance(self):
+        return self.ctrl.getAccountByNum(self.accNum).balance
+
+    def test_concurrent_credits_lose_no_update(self):
+        threads, credits = 4, 25
+        def run():
+            for i in range(credits):
+                self.ctrl.updateAccount(self.accNum, 1)
+        workers = [threading.Thread(target=run) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(self.balance(), 100 + threads * credits)
+
+    def test_update_returns_account(self):
+        self.assertEqual(self.ctrl.updateAccount(self.accNum, -30),
+                         {'user_id': 'user', 'accNum': self.accNum,
+                          'balance': 70})
+
+    def test_non_negative_update_refused(self):
+        with self.assertRaises(InsufficientFunds):
+            self.ctrl.updateAccount(self.accNum, -101, nonNegative=True)
+        self.assertEqual(self.balance(), 100)
+        self.assertEqual(self.ctrl.updateAccount(self.accNum, -100,
+                                                 nonNegative=True)['balance'],
+                         0)
+        # Without nonNegative the balance may go below 0
+        self.assertEqual(self.ctrl.updateAccount(self.accNum, -1)['balance'],
+                         -1)
+
+    def test_unknown_account_refused(self):
+        with self.assertRaises(TransferError) as raised:
+            self.ctrl.updateAccount(self.accNum + SHARDS * 1000, 1)
+        self.assertNotIsInstance(raised.exception, InsufficientFunds)
+
+
+class TestUpdateAccountGroupCommit(TestUpdateAccount):
+    ctrl = dbCtrl(logger, commitWindow=0.005)
+
+    def test_concurrent_credits_share_commits(self):
+        before = self.ctrl.commitStats()[shardOf(self.accNum)]
+        self.test_concurrent_credits_lose_no_update()
+        after = self.ctrl.commitStats()[shardOf(self.accNum)]
+        self.assertEqual(after['items'] - before['items'], 100)
+        self.assertLess(after['batches'] - before['batches'], 100)
+
+    def test_nothing_of_failed_write_committed(self):
+        debit = self.ctrl.balanceUpdate(self.accNum, -50)
+        def write(session):
+            session.execute(debit)
+            raise TransferError('Refused after the debit')
+        def fail():
+            with self.assertRaises(TransferError):
+                self.ctrl.commitWrite(shardOf(self.accNum), write,
+                                      lambda r: None)
+        workers = [threading.Thread(target=run) for run in
+                   [lambda: self.ctrl.updateAccount(self.accNum, 1), fail,
+                    lambda: self.ctrl.updateAccount(self.accNum, 2)] * 3]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(self.balance(), 109)
+
+
+
+class TestAccountCache(unittest.TestCase):
+    def setUp(self):
+        self.ctrl = dbCtrl(logger, cacheTTL=60)
+        self.accNum = self.ctrl.createAccountForUserId('user', 100)
+        self.payee = self.ctrl.createAccountForUserId('user', 100)
+
+    def read(self, ctrl=None, accNum=None):
+        return (ctrl or self.ctrl).getAccountByNum(accNum or self.accNum,
+                                                   json=True)['balance']
+
+    def test_reads_own_writes_from_cache(self):
+        self.assertEqual(self.read(), 100)
+        self.ctrl.updateAccount(self.accNum, 5)
+        self.ctrl.transfer(self.accNum, self.payee, 10)
+        self.assertEqual(self.read(), 95)
+        self.assertEqual(self.read(accNum=self.payee), 110)
+        # Opening the accounts and each write put them in the cache
+        self.assertEqual(self.ctrl.cache.stats()['misses'], 0)
+
+    def test_other_writes_seen_after_ttl(self):
+        # As two workers of the service, each with a cache of its own
+        ctrl, other = dbCtrl(logger, cacheTTL=0.1), dbCtrl(logger, cacheTTL=60)
+        self.assertEqual(self.read(ctrl), 100)
+        other.updateAccount(self.accNum, 5)
+        self.assertEqual(self.read(ctrl), 100)
+        self.assertEqual(self.read(other), 105)
+        time.sleep(0.15)
+        self.assertEqual(self.read(ctrl), 105)
+
+    def test_closed_account_not_read_from_cache(self):
+        self.assertEqual(self.read(), 100)
+        self.assertEqual(self.ctrl.closeAccount(self.accNum), 0)
+        self.assertIsNone(self.ctrl.getAccountByNum(self.accNum, json=True))
+        self.assertEqual(self.ctrl.getAccountsByNums([self.accNum]), [])
+
+    def test_cache_disabled_without_ttl(self):
+        ctrl = dbCtrl(logger)
+        self.ctrl.updateAccount(self.accNum, 5)
+        self.assertEqual(self.read(ctrl), 105)
+        self.ctrl.updateAccount(self.accNum, 5)
+        self.assertEqual(self.read(ctrl), 110)
+        self.assertEqual(ctrl.cache.stats()['size'], 0)
+
+
+
+class TestBulkAccounts(unittest.TestCase):
+    ctrl = dbCtrl(logger, cacheTTL=60)
+
+    def test_accounts_opened_in_order(self):
+        accNums = self.ctrl.createAccountsForUserIds([3, 1, 2], 50)
+        self.assertEqual(len(set(shardOf(n) for n in accNums)), 1)
+        self.assertEqual(sorted(accNums), accNums)
+        self.assertEqual([self.ctrl.getAccountByNum(n).user_id
+                          for n in accNums], [3, 1, 2])
+
+    def test_no_account_opened_on_error(self):
+        before = self.ctrl.getAccountsPage(0, 100000)
+        # The second one cannot be inserted
+        self.assertIsNone(self.ctrl.createAccountsForUserIds([1, {}, 2], 50))
+        self.assertEqual(self.ctrl.getAccountsPage(0, 100000), before)
+
+    def test_multi_get_in_order(self):
+        accNums = [self.ctrl.createAccountForUserId(i, 10 * i)
+                   for i in range(SHARDS)]
+        unknown = accNums[0] + SHARDS * 1000
+        # One of them cached, the others read from their shards
+        self.ctrl.getAccountByNum(accNums[1], json=True)
+        asked = [accNums[2], unknown, accNums[1], accNums[0], accNums[3]]
+        self.assertEqual(self.ctrl.getAccountsByNums(asked),
+                         [{'accNum': n, 'user_id': accNums.index(n),
+                           'balance': 10 * accNums.index(n)}
+                          for n in asked if n != unknown])
+
+
+
+class TestBatchInShard(unittest.TestCase):
+    ctrl = dbCtrl(logger, cacheTTL=60)
+
+    def setUp(self):
+        # Accounts of one shard, as new accounts go to the shards in turn
+        accNums = [self.ctrl.createAccountForUserId('user', 100)
+                   for i in range(2 * SHARDS)]
+        self.a, self.b = [n for n in accNums if shardOf(n) == 0]
+
+    def balances(self):
+        return [self.ctrl.getAccountByNum(n, json=True)['balance']
+                for n in (self.a, self.b)]
+
+    def test_batch_results(self):
+        a, b = self.a, self.b
+        unknown = a + SHARDS * 1000
+        res = self.ctrl.applyTransfers([(a, b, 30), (a, b, 80), (b, a, 120),
+                                        (a, unknown, 10), (unknown, a, 10)])
+        self.assertEqual(res, [(70, 130), 'Insufficient funds', (10, 190),
+                               'Unknown account', 'Unknown account'])
+        self.assertEqual(self.balances(), [190, 10])
+
+    def test_concurrent_updates_lose_none(self):
+        threads, rounds = 4, 25
+        def batches():
+            for i in range(rounds):
+                self.ctrl.applyTransfers([(self.a, self.b, 1),
+                                          (self.b, self.a, 2)])
+        def updates():
+            for i in range(rounds):
+                self.ctrl.updateAccount(self.a, 1)
+                self.ctrl.updateAccount(self.b, 10)
+        workers = [threading.Thread(target=run)
+                   for run in (batches, updates) * (threads / 2)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        n = threads / 2 * rounds
+        self.assertEqual(self.balances(), [100 + n + n, 100 - n + 10 * n])
+
+
+class TestBatchInShardGroupCommit(TestBatchInShard):
+    ctrl = dbCtrl(logger, cacheTTL=60, commitWindow=0.005)
+
+
+
+class TestCrossShardTransfers(unittest.TestCase):
+    ctrl = dbCtrl(logger, cacheTTL=60)
+
+    def setUp(self):
+        # One account in each shard, as new accounts go to the shards in turn
+        self.accNums = sorted((self.ctrl.createAccountForUserId('user', 100)
+                               for shard in range(SHARDS)), key=shardOf)
+        self.assertEqual([shardOf(n) for n in self.accNums], range(SHARDS))
+
+    def balances(self):
+        return [self.ctrl.getAccountByNum(n, json=True)['balance']
+                for n in self.accNums]
+
+    def test_batch_across_shards(self):
+        a, b, c, d = self.accNums
+        unknown = a + SHARDS * 1000
+        res = self.ctrl.applyTransfers([(a, b, 30),
+                                        (b, c, 500),
+                                        (c, unknown, 10),
+                                        (c, d, 20)])
+        self.assertEqual(res, [(70, 130),
+                               'Insufficient funds',
+                               'Unknown account',
+                               (70, 120)])
+        # The debit of the transfer to the unknown account is refunded
+        # after the batch
+        self.assertEqual(self.balances(), [70, 130, 80, 120])
+
+    def test_concurrent_batches_lose_no_update(self):
+        a, b, c, d = self.accNums
+        # Each batch moves 1 around the ring of shards and 1 from a to c
+        batch = [(a, b, 1), (b, c, 1), (c, d, 1), (d, a, 1), (a, c, 1)]
+        threads, batches = 4, 10
+        def run():
+            for i in range(batches):
+                self.ctrl.applyTransfers(batch)
+        workers = [threading.Thread(target=run) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        moved = threads * batches
+        self.assertEqual(self.balances(), [100 - moved, 100, 100 + moved, 100])
+
+
+class TestCrossShardTransfersGroupCommit(TestCrossShardTransfers):
+    ctrl = dbCtrl(logger, cacheTTL=60, commitWindow=0.005)
+
+
+
+class TestHotAccounts(unittest.TestCase):
+    def setUp(self):
+        # Two accounts in each shard
+        accNums = sorted((TestCrossShardTransfers.ctrl
+                          .createAccountForUserId('user', 100)
+                          for i in range(2 * SHARDS)), key=shardOf)
+        # The payer and the merchant in a shard, the other one in another
+        self.payer, self.merchant, self.other = accNums[:3]
+        self.assertEqual([shardOf(n) for n in accNums[:3]], [0, 0, 1])
+        self.ctrl = dbCtrl(logger, cacheTTL=60, hotAccounts=[self.merchant],
+                           stripes=SHARDS * 2)
+
+    def balance(self, accNum):
+        return self.ctrl.getAccountByNum(accNum, json=True)['balance']
+
+    def test_transfer_in_shard_credits_a_stripe(self):
+        self.assertEqual(self.ctrl.transfer(self.payer, self.merchant, 30),
+                         (70, 130))
+        self.assertEqual(self.balance(self.merchant), 130)
+        # The account row is left alone
+        self.assertEqual(self.ctrl.getAccountByNum(self.merchant).balance,
+                         100)
+
+    def test_debit_consolidates_stripes(self):
+        self.ctrl.transfer(self.other, self.merchant, 50)
+        self.ctrl.transfer(self.payer, self.merchant, 50)
+        self.assertEqual(self.ctrl.transfer(self.merchant, self.payer, 180),
+                         (20, 230))
+        self.assertEqual(self.balance(self.merchant), 20)
+        with self.assertRaises(TransferError):
+            self.ctrl.transfer(self.merchant, self.payer, 21)
+
+    def test_writes_return_whole_balance(self):
+        self.assertEqual(self.ctrl.transfer(self.other, self.merchant, 10),
+                         (90, 110))
+        self.assertEqual(self.ctrl.updateAccount(self.merchant, 5)['balance'],
+                         115)
+        self.assertEqual(self.ctrl.applyTransfers([(self.payer,
+                                                    self.merchant, 5)]),
+                         [(95, 120)])
+        self.assertEqual(self.ctrl.updateAccount(self.merchant, -20)
+                                  ['balance'], 100)
+
+    def test_concurrent_credits_lose_no_update(self):
+        threads, credits = 4, 20
+        def run(accNum):
+            for i in range(credits):
+                self.ctrl.transfer(accNum, self.merchant, 1)
+        workers = [threading.Thread(target=run, args=(accNum,))
+                   for accNum in (self.payer, self.other) * (threads / 2)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(self.balance(self.merchant),
+                         100 + threads * credits)
+        self.assertEqual(self.balance(self.payer) + self.balance(self.other),
+                         200 - threads * credits)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 import json
+import time
 import requests
 import unittest
 
@@ -11,16 +12,16 @@ test_users = [['user1', '1234'],
 
 class ApiGatewayClient(object):
 	def __init__(self, url):
-		self.baseUrl = url
+		self.baseUrl = url.rstrip('/')
 
 	def addUser(self, username, pwd):
-		url = '{}/users/enroll'.format(self.baseUrl)
+		url = '{}/users'.format(self.baseUrl)
 		payload = {'username':username, 'pwd':pwd}
 		return requests.post(url, json=payload)
 
 	def openAccount(self, userID):
-		url = '{}/users/{}/accounts/open'.format(self.baseUrl, userID)
-		return requests.get(url)
+		url = '{}/users/{}/accounts'.format(self.baseUrl, userID)
+		return requests.post(url, json={})
 
 	def showAccounts(self, userID):
 		url = '{}/users/{}/accounts'.format(self.baseUrl, userID)
@@ -31,13 +32,34 @@ class ApiGatewayClient(object):
 		return requests.get(url)
 
 	def showUser(self, username):
-		url = '{}/users/{}'.format(self.baseUrl, username)
-		return requests.get(url)
+		url = '{}/users'.format(self.baseUrl)
+		return requests.get(url, params={'username': username})
 
-	def pay(self, fromAccNum, toAccNum, amount):
-		url = '{}/pay'.format(self.baseUrl)
+	def pay(self, userID, fromAccNum, toAccNum, amount):
+		url = '{}/users/{}/pay'.format(self.baseUrl, userID)
 		payload = {'fromAccNum':fromAccNum, 'toAccNum':toAccNum, 'amount':amount}
 		return requests.post(url, json=payload)
+
+	def payAsync(self, userID, fromAccNum, toAccNum, amount):
+		url = '{}/users/{}/pay'.format(self.baseUrl, userID)
+		payload = {'fromAccNum':fromAccNum, 'toAccNum':toAccNum, 'amount':amount}
+		return requests.post(url, json=payload, params={'async': 'true'})
+
+	def showPayment(self, userID, paymentID):
+		url = '{}/users/{}/payments/{}'.format(self.baseUrl, userID, paymentID)
+		return requests.get(url)
+
+	def payBatch(self, userID, payments):
+		url = '{}/users/{}/pay/batch'.format(self.baseUrl, userID)
+		return requests.post(url, json={'payments': payments})
+
+	def showOverview(self, userID):
+		url = '{}/users/{}/overview'.format(self.baseUrl, userID)
+		return requests.get(url)
+
+	def stats(self):
+		url = '{}/stats'.format(self.baseUrl)
+		return requests.get(url)
 		
 
 
@@ -55,5 +77,150 @@ class TestUsersService(unittest.TestCase):
 			print resp_json
 			self.assertEqual(status_code, 200)
 
+	def test_cache_stats(self):
+		resp = self.client.stats()
+		self.assertEqual(resp.status_code, 200)
+		self.assertIn('cache', resp.json())
+		for counter in ['hits', 'misses', 'evictions', 'size']:
+			self.assertIn(counter, resp.json()['cache'])
+
+	def test_singleflight_stats(self):
+		resp = self.client.stats()
+		self.assertEqual(resp.status_code, 200)
+		self.assertIn('singleflight', resp.json())
+		self.assertIn('coalesced', resp.json()['singleflight'])
+
+	def test_rate_limit_stats(self):
+		before = self.client.stats().json()['ratelimit']
+		self.client.showUser('ratelimituser')
+		after = self.client.stats().json()['ratelimit']
+		for counter in ['limits', 'admitted', 'rejected', 'buckets']:
+			self.assertIn(counter, after)
+		if 'read' in after['limits']:
+			self.assertGreater(after['admitted']['read'] + after['rejected']['read'],
+							   before['admitted']['read'] + before['rejected']['read'])
+
+	def test_rate_limit_per_address(self):
+		limits = self.client.stats().json()['ratelimit']['limits']
+		if 'read' not in limits or limits['read']['rate'] > 50:
+			self.skipTest('needs RATE_LIMIT=True and RATE_LIMIT_READ <= 50')
+		rate, burst = limits['read']['rate'], limits['read']['burst']
+		# A userID of its own for every request does not escape the bucket
+		statuses = [self.client.showAccounts(1000000 + i).status_code
+			for i in range(int(2 * burst) + 5)]
+		self.assertIn(429, statuses)
+		time.sleep(burst / rate)
+
+	def test_user_overview(self):
+		self.client.addUser('overviewuser', '1234')
+		userID = self.client.showUser('overviewuser').json()['id']
+		self.client.openAccount(userID)
+		resp = self.client.showOverview(userID)
+		self.assertEqual(resp.status_code, 200)
+		self.assertIn('accounts', resp.json())
+		self.assertGreater(len(resp.json()['accounts']), 0)
+		for account in resp.json()['accounts']:
+			self.assertIn('accNum', account)
+			self.assertIn('transactions', account)
+
+	def test_pay_batch(self):
+		self.client.addUser('batchuser', '1234')
+		userID = self.client.showUser('batchuser').json()['id']
+		fromAccNum = self.client.openAccount(userID).json()['accNum']
+		toAccNum = self.client.openAccount(userID).json()['accNum']
+		payments = [{'fromAccNum': fromAccNum, 'toAccNum': toAccNum, 'amount': 10},
+			{'fromAccNum': toAccNum, 'toAccNum': fromAccNum, 'amount': 3},
+			{'fromAccNum': fromAccNum, 'toAccNum': -1, 'amount': 1}]
+		resp = self.client.payBatch(userID, payments)
+		self.assertEqual(resp.status_code, 200)
+		results = resp.json()['results']
+		self.assertEqual(len(results), len(payments))
+		self.assertEqual(results[0]['status'], 200)
+		self.assertEqual(results[1]['status'], 200)
+		self.assertEqual(results[2]['status'], 400)
+		balances = dict((a['accNum'], a['balance'])
+			for a in self.client.showAccounts(userID).json())
+		self.assertEqual(balances[fromAccNum] - balances[toAccNum], -14)
+
+	def test_fractional_amount_refused(self):
+		self.client.addUser('amountuser', '1234')
+		userID = self.client.showUser('amountuser').json()['id']
+		fromAccNum = self.client.openAccount(userID).json()['accNum']
+		toAccNum = self.client.openAccount(userID).json()['accNum']
+		before = dict((a['accNum'], a['balance'])
+			for a in self.client.showAccounts(userID).json())
+		for amount in [1.5, 0, -3, 'x']:
+			resp = self.client.pay(userID, fromAccNum, toAccNum, amount)
+			self.assertEqual(resp.status_code, 400)
+		payments = [{'fromAccNum': fromAccNum, 'toAccNum': toAccNum, 'amount': 2.5},
+			{'fromAccNum': fromAccNum, 'toAccNum': toAccNum, 'amount': '3'}]
+		results = self.client.payBatch(userID, payments).json()['results']
+		self.assertEqual(results[0]['status'], 400)
+		self.assertEqual(results[1]['status'], 200)
+		after = dict((a['accNum'], a['balance'])
+			for a in self.client.showAccounts(userID).json())
+		self.assertEqual(after[fromAccNum], before[fromAccNum] - 3)
+		self.assertEqual(after[toAccNum], before[toAccNum] + 3)
+
+	def test_failed_payment_is_compensated(self):
+		self.client.addUser('sagauser', '1234')
+		userID = self.client.showUser('sagauser').json()['id']
+		fromAccNum = self.client.openAccount(userID).json()['accNum']
+		toAccNum = self.client.openAccount(userID).json()['accNum']
+		resp = self.client.pay(userID, fromAccNum, toAccNum, 10)
+		self.assertEqual(resp.status_code, 200)
+		resp = self.client.pay(userID, fromAccNum, -1, 5)
+		self.assertEqual(resp.status_code, 400)
+		balances = dict((a['accNum'], a['balance'])
+			for a in self.client.showAccounts(userID).json())
+		self.assertEqual(balances[fromAccNum] - balances[toAccNum], -20)
+
+	def test_payment_insufficient_funds(self):
+		self.client.addUser('fundsuser', '1234')
+		userID = self.client.showUser('fundsuser').json()['id']
+		fromAccNum = self.client.openAccount(userID).json()['accNum']
+		toAccNum = self.client.openAccount(userID).json()['accNum']
+		before = dict((a['accNum'], a['balance'])
+			for a in self.client.showAccounts(userID).json())
+		resp = self.client.pay(userID, fromAccNum, toAccNum, before[fromAccNum] + 1)
+		self.assertEqual(resp.status_code, 400)
+		after = dict((a['accNum'], a['balance'])
+			for a in self.client.showAccounts(userID).json())
+		self.assertEqual(after[fromAccNum], before[fromAccNum])
+		self.assertEqual(after[toAccNum], before[toAccNum])
+
+	def test_async_payment(self):
+		self.client.addUser('asyncuser', '1234')
+		userID = self.client.showUser('asyncuser').json()['id']
+		fromAccNum = self.client.openAccount(userID).json()['accNum']
+		toAccNum = self.client.openAccount(userID).json()['accNum']
+		resp = self.client.payAsync(userID, fromAccNum, toAccNum, 10)
+		self.assertEqual(resp.status_code, 202)
+		paymentID = resp.json()['id']
+		for i in range(50):
+			payment = self.client.showPayment(userID, paymentID).json()
+			if payment['status'] not in ('queued', 'processing'):
+				break
+			time.sleep(0.1)
+		self.assertEqual(payment['status'], 'executed')
+		self.assertIsNotNone(payment['number'])
+		resp = self.client.payAsync(userID, fromAccNum, -1, 10)
+		paymentID = resp.json()['id']
+		for i in range(50):
+			payment = self.client.showPayment(userID, paymentID).json()
+			if payment['status'] not in ('queued', 'processing'):
+				break
+			time.sleep(0.1)
+		self.assertEqual(payment['status'], 'failed')
+		self.assertEqual(self.client.showPayment(userID, 0).status_code, 404)
+
+	def test_cached_read_hits(self):
+		self.client.addUser('cacheuser', '1234')
+		before = self.client.stats().json()['cache']['hits']
+		self.client.showUser('cacheuser')
+		self.client.showUser('cacheuser')
+		after = self.client.stats().json()['cache']['hits']
+		self.assertGreaterEqual(after, before + 1)
+
 if __name__ == '__main__':
 	unittest.main()
\ No newline at end of file
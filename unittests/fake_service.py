@@ -0,0 +1,59 @@
+"""A fake downstream service for the tests that run a service in process."""
+import json
+import time
+import threading
+import BaseHTTPServer
+from SocketServer import ThreadingMixIn
+
+
+class FakeServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Records (method, path, body) of every request it gets and answers
+    with answer(method, path), a (delay, status, body) tuple where body is
+    sent as it is if a string and as JSON otherwise. If answer returns None
+    the connection is closed without an answer."""
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # A client that timed out has closed the connection
+        pass
+
+
+class FakeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def handle_one(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or 'null')
+        self.server.received.append((self.command, self.path, body))
+        answer = self.server.answer(self.command, self.path)
+        if answer is None:
+            self.close_connection = 1
+            return
+        delay, status, answer = answer
+        time.sleep(delay)
+        data = answer if isinstance(answer, str) else json.dumps(answer)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_DELETE = handle_one
+
+    def log_message(self, *args):
+        pass
+
+
+def startFake(answer):
+    """Start a FakeServer on a free port; its url is set as server.url."""
+    server = FakeServer(('127.0.0.1', 0), FakeHandler)
+    server.received = []
+    server.answer = answer
+    server.url = 'http://127.0.0.1:%s/' % server.server_port
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def stopFake(server):
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,200 @@
+import os
+import sys
+import json
+import logging
+import unittest
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from fake_service import startFake, stopFake
+
+# Both gateway front ends run in this process against a fake downstream
+# service, which stands for all four services. The gateway modules and the
+# ones shared by the services (see services/common_files) are imported
+# from the tree.
+SERVICES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        '..', 'services')
+sys.path.insert(0, os.path.join(SERVICES, 'common_files', 'general'))
+sys.path.insert(0, os.path.join(SERVICES, 'apigateway', 'apigateway'))
+# Each service has an api module of its own;
+# those of a service imported before are set aside, as Python 2 clears
+# the globals of a module once it is garbage collected.
+otherModules = [sys.modules.pop(m) for m in list(sys.modules)
+                if m.split('.')[0] == 'api']
+
+import api
+import api_falcon
+import gateway
+
+# The gateway logs at INFO, the errors provoked here need not be shown
+logging.getLogger().setLevel(logging.CRITICAL)
+
+# As the accounts service answers, but with a layout of its own, which a
+# relayed body keeps
+ACCOUNTS = '[{"accNum": 5,"balance":  7, "user_id": 1}]'
+
+
+def answer(method, path):
+    if path.startswith('/accounts?userID='):
+        return (0, 200, ACCOUNTS)
+    if path.startswith('/transactions?accNum='):
+        return (0, 200, [])
+    if path == '/pay':
+        return (0, 200, '')
+    return (0, 404, {'msg': 'Unknown'})
+
+
+class GatewayTestCase(unittest.TestCase):
+    def setUp(self):
+        self.downstream = startFake(answer)
+        self.urls = {}
+        for name in ['USERS', 'ACCOUNTS', 'TRANSACTIONS', 'PAYMENT']:
+            var = name + '_SERVICE_URL'
+            self.urls[var] = getattr(gateway, var)
+            setattr(gateway, var, self.downstream.url)
+        # Every test starts from an empty cache
+        gateway.cache = gateway.TTLCache(gateway.CACHE_SIZE)
+        self.clients = [Client(api.app, BaseResponse),
+                        Client(api_falcon.app, BaseResponse)]
+
+    def tearDown(self):
+        for var, url in self.urls.items():
+            setattr(gateway, var, url)
+        stopFake(self.downstream)
+
+
+class TestPassthrough(GatewayTestCase):
+    def test_body_relayed_as_received(self):
+        for client in self.clients:
+            res = client.get('/users/1/accounts')
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.data, ACCOUNTS)
+            self.assertEqual(res.headers['Content-Type'], 'application/json')
+
+    def test_error_relayed_as_received(self):
+        for client in self.clients:
+            res = client.get('/users/1/payments/3')
+            self.assertEqual(res.status_code, 404)
+            self.assertEqual(json.loads(res.data), {'msg': 'Unknown'})
+
+    def test_body_reserialized_without_passthrough(self):
+        gateway.PASSTHROUGH = False
+        try:
+            for client in self.clients:
+                res = client.get('/users/1/accounts')
+                self.assertEqual(res.status_code, 200)
+                self.assertNotEqual(res.data, ACCOUNTS)
+                self.assertEqual(json.loads(res.data), json.loads(ACCOUNTS))
+        finally:
+            gateway.PASSTHROUGH = True
+
+
+
+class TestFrontEndsAgree(GatewayTestCase):
+    """The Falcon gateway is a drop-in for the Flask one: both answer a
+    request alike."""
+    def answers(self, method, path, **kwargs):
+        res = [getattr(client, method)(path, **kwargs)
+               for client in self.clients]
+        self.assertEqual(res[0].status_code, res[1].status_code)
+        return res
+
+    def test_documents(self):
+        for path in ['/users/1/accounts', '/users/1/accounts/5/transactions',
+                     '/users/1/overview']:
+            flask, falcon = self.answers('get', path)
+            self.assertEqual(flask.status_code, 200)
+            self.assertEqual(json.loads(flask.data), json.loads(falcon.data))
+
+    def test_payment(self):
+        payment = json.dumps({'fromAccNum': 5, 'toAccNum': 6, 'amount': 1})
+        flask, falcon = self.answers('post', '/users/1/pay', data=payment,
+                                     content_type='application/json')
+        self.assertEqual(flask.status_code, 200)
+        self.assertEqual([r[:2] for r in self.downstream.received],
+                         [('POST', '/pay')] * 2)
+
+    def test_bad_requests(self):
+        for path, doc in [('/users/1/pay', {'fromAccNum': 5}),
+                          ('/users/1/pay/batch', {'payments': []}),
+                          ('/users', {'username': 'u'})]:
+            flask, falcon = self.answers('post', path, data=json.dumps(doc),
+                                         content_type='application/json')
+            self.assertEqual(flask.status_code, 400)
+        self.assertEqual(self.downstream.received, [])
+
+    def test_downstream_unavailable(self):
+        stopFake(self.downstream)
+        flask, falcon = self.answers('post', '/users/1/accounts')
+        self.assertEqual(flask.status_code, 503)
+        self.downstream = startFake(answer)
+
+    def test_rate_limited(self):
+        limiter = gateway.limiter
+        gateway.limiter = gateway.RateLimiter({'read': (0.01, 1)})
+        try:
+            # A client address for each front end, as the buckets are kept
+            # per address
+            res = [[client.get('/users/1/accounts',
+                               environ_base={'REMOTE_ADDR': '10.0.0.%s' % i})
+                    for n in range(2)]
+                   for i, client in enumerate(self.clients)]
+            self.assertEqual([[r.status_code for r in rs] for rs in res],
+                             [[200, 429]] * 2)
+            flask, falcon = res[0][1], res[1][1]
+            self.assertEqual(flask.headers['Retry-After'],
+                             falcon.headers['Retry-After'])
+        finally:
+            gateway.limiter = limiter
+
+    def test_rate_limited_behind_proxy(self):
+        limiter = gateway.limiter
+        gateway.limiter = gateway.RateLimiter({'read': (0.01, 1)})
+        gateway.RATE_LIMIT_TRUSTED_PROXIES = frozenset(['10.0.0.9'])
+        try:
+            def get(client, forwardedFor):
+                return client.get('/users/1/accounts',
+                                  environ_base={'REMOTE_ADDR': '10.0.0.9'},
+                                  headers={'X-Forwarded-For': forwardedFor}
+                                  ).status_code
+            for i, client in enumerate(self.clients):
+                first, second = '192.0.2.%s' % i, '198.51.100.%s' % i
+                # Clients behind the proxy have buckets of their own
+                self.assertEqual([get(client, first), get(client, second),
+                                  get(client, first)], [200, 200, 429])
+                # Which an address of the client's choosing does not evade
+                self.assertEqual(get(client, '203.0.113.1, ' + second), 429)
+        finally:
+            gateway.limiter = limiter
+            gateway.RATE_LIMIT_TRUSTED_PROXIES = frozenset()
+
+
+
+class TestClientAddr(unittest.TestCase):
+    def setUp(self):
+        gateway.RATE_LIMIT_TRUSTED_PROXIES = frozenset(['10.0.0.8',
+                                                        '10.0.0.9'])
+
+    def tearDown(self):
+        gateway.RATE_LIMIT_TRUSTED_PROXIES = frozenset()
+
+    def test_forwarded_for_of_trusted_proxy(self):
+        self.assertEqual(gateway.clientAddr('10.0.0.9', '192.0.2.1'),
+                         '192.0.2.1')
+        # Through two proxies
+        self.assertEqual(gateway.clientAddr('10.0.0.9',
+                                            '192.0.2.1, 10.0.0.8'),
+                         '192.0.2.1')
+
+    def test_forwarded_for_of_others_ignored(self):
+        self.assertEqual(gateway.clientAddr('192.0.2.7', '192.0.2.1'),
+                         '192.0.2.7')
+        self.assertEqual(gateway.clientAddr('10.0.0.9', None), '10.0.0.9')
+        gateway.RATE_LIMIT_TRUSTED_PROXIES = frozenset()
+        self.assertEqual(gateway.clientAddr('10.0.0.9', '192.0.2.1'),
+                         '10.0.0.9')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,361 @@
+import os
+import sys
+import time
+import threading
+import unittest
+import BaseHTTPServer
+from SocketServer import ThreadingMixIn
+
+# The modules shared by the services, see services/common_files
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'services', 'common_files', 'general'))
+
+from requests.exceptions import ConnectionError, Timeout
+
+from flask import Flask, request, jsonify
+
+from general import Requests, ServiceClient, ServiceTimeoutError, \
+                    serviceClient, serviceRequests, LocalRequests, \
+                    registerLocalApp, localApps, sqlitePragmas
+from breaker import CircuitBreaker, CircuitOpenError
+from ratelimit import RateLimiter, TokenBucket
+from batching import GroupCommit
+
+
+class SlowServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Records the method of every request it gets and answers each after
+    delay seconds."""
+    daemon_threads = True
+    delay = 0.5
+
+    def handle_error(self, request, client_address):
+        # A client that timed out has closed the connection
+        pass
+
+
+class SlowHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def answer(self):
+        self.server.received.append(self.command)
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self.rfile.read(length)
+        time.sleep(self.server.delay)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_GET = do_POST = answer
+
+    def log_message(self, *args):
+        pass
+
+
+class SlowServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = SlowServer(('127.0.0.1', 0), SlowHandler)
+        self.server.received = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%s/' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestRetries(SlowServerTestCase):
+    def test_timed_out_post_is_sent_once(self):
+        client = Requests(maxRetries=3)
+        with self.assertRaises((Timeout, ConnectionError)):
+            client.post(self.url, json={'amount': 10}, timeout=0.1)
+        # Give any retry time to arrive
+        time.sleep(0.3)
+        self.assertEqual(self.server.received, ['POST'])
+
+    def test_timed_out_get_is_retried(self):
+        client = Requests(maxRetries=2)
+        with self.assertRaises((Timeout, ConnectionError)):
+            client.get(self.url, timeout=0.1)
+        time.sleep(0.3)
+        self.assertEqual(self.server.received, ['GET'] * 3)
+
+
+
+class TestPool(SlowServerTestCase):
+    def setUp(self):
+        super(TestPool, self).setUp()
+        self.server.delay = 0
+
+    def test_connection_reused(self):
+        client = Requests()
+        for i in range(5):
+            self.assertEqual(client.get(self.url).status_code, 200)
+        self.assertEqual(client.stats(), {'hosts': 1, 'requests': 5,
+                                          'newConnections': 1,
+                                          'reusedConnections': 4})
+
+    def test_blocking_pool_bounds_connections(self):
+        self.server.delay = 0.05
+        client = Requests(poolMaxSize=2, poolBlock=True)
+        def run():
+            for i in range(3):
+                client.get(self.url)
+        workers = [threading.Thread(target=run) for i in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        stats = client.stats()
+        self.assertEqual(stats['requests'], 12)
+        self.assertEqual(stats['newConnections'], 2)
+        self.assertEqual(stats['reusedConnections'], 10)
+
+
+
+class TestServiceClient(SlowServerTestCase):
+    def client(self, failures=2, resetTimeout=0.5):
+        return ServiceClient(Requests(), 'slow', (1, 0.1),
+                             CircuitBreaker('slow', failures, resetTimeout))
+
+    def test_timeout_is_a_connection_error(self):
+        client = self.client()
+        with self.assertRaises(ServiceTimeoutError) as raised:
+            client.get(self.url)
+        self.assertIsInstance(raised.exception, ConnectionError)
+        self.assertIsInstance(raised.exception, Timeout)
+
+    def test_circuit_opens_after_failures(self):
+        client = self.client()
+        for i in range(2):
+            with self.assertRaises(ServiceTimeoutError):
+                client.get(self.url)
+        # Refused without calling the service
+        with self.assertRaises(CircuitOpenError):
+            client.get(self.url)
+        time.sleep(0.3)
+        self.assertEqual(self.server.received, ['GET'] * 2)
+        self.assertEqual(client.breaker.stats()['state'], 'open')
+        self.assertEqual(client.breaker.stats()['rejected'], 1)
+
+    def test_circuit_closes_after_successful_probe(self):
+        client = self.client(failures=1, resetTimeout=0.2)
+        with self.assertRaises(ServiceTimeoutError):
+            client.get(self.url)
+        time.sleep(0.3)
+        self.server.delay = 0
+        self.assertEqual(client.get(self.url).status_code, 200)
+        self.assertEqual(client.breaker.stats()['state'], 'closed')
+
+    def test_service_timeout_overrides_global_one(self):
+        os.environ['READ_TIMEOUT'] = '7'
+        os.environ['SLOW_READ_TIMEOUT'] = '0.1'
+        try:
+            self.assertEqual(serviceClient(Requests(), 'slow').timeout,
+                             (3.05, 0.1))
+            self.assertEqual(serviceClient(Requests(), 'other').timeout,
+                             (3.05, 7))
+        finally:
+            del os.environ['READ_TIMEOUT']
+            del os.environ['SLOW_READ_TIMEOUT']
+
+
+
+class TestLocalRequests(unittest.TestCase):
+    """A service called in process answers as it would over HTTP."""
+    url = 'http://local-echo:9081'
+
+    def setUp(self):
+        app = Flask('echo')
+        @app.route('/echo', methods=['GET', 'POST', 'DELETE'])
+        def echo():
+            return jsonify(method=request.method, args=request.args,
+                           body=request.get_json(silent=True)), 201
+        registerLocalApp(self.url, app)
+        self.client = LocalRequests()
+
+    def tearDown(self):
+        localApps.clear()
+
+    def test_request_handed_to_app(self):
+        res = self.client.post(self.url + '/echo?a=1', params={'b': 2},
+                               json={'amount': 10})
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(res.headers['content-type'], 'application/json')
+        self.assertEqual(res.json(), {'method': 'POST',
+                                      'args': {'a': '1', 'b': '2'},
+                                      'body': {'amount': 10}})
+        self.assertEqual(self.client.delete(self.url + '/echo').json()
+                         ['method'], 'DELETE')
+
+    def test_not_found_relayed(self):
+        self.assertEqual(self.client.get(self.url + '/other').status_code,
+                         404)
+
+    def test_unknown_service_is_a_connection_error(self):
+        with self.assertRaises(ConnectionError):
+            self.client.get('http://elsewhere:9081/echo')
+
+    def test_used_in_monolith(self):
+        os.environ['MONOLITH'] = 'True'
+        try:
+            self.assertIsInstance(serviceRequests('accounts'), LocalRequests)
+        finally:
+            del os.environ['MONOLITH']
+        self.assertIsInstance(serviceRequests('accounts'), Requests)
+
+
+
+class TestSqlitePragmas(unittest.TestCase):
+    def tearDown(self):
+        for var in ['SQLITE_PROFILE', 'ACCOUNTS_SQLITE_PROFILE',
+                    'SQLITE_CACHE_SIZE']:
+            os.environ.pop(var, None)
+
+    def test_default_profile(self):
+        self.assertEqual(sqlitePragmas('accounts'),
+                         ['PRAGMA journal_mode = MEMORY',
+                          'PRAGMA synchronous = OFF'])
+
+    def test_profile_of_service_first(self):
+        os.environ['SQLITE_PROFILE'] = 'balanced'
+        os.environ['ACCOUNTS_SQLITE_PROFILE'] = 'durable'
+        self.assertEqual(sqlitePragmas('accounts'),
+                         ['PRAGMA journal_mode = WAL',
+                          'PRAGMA synchronous = FULL'])
+        self.assertEqual(sqlitePragmas('payment'),
+                         ['PRAGMA journal_mode = WAL',
+                          'PRAGMA synchronous = NORMAL'])
+
+    def test_pragma_overrides_profile(self):
+        os.environ['SQLITE_CACHE_SIZE'] = '-2000'
+        self.assertEqual(sqlitePragmas('accounts', 'balanced'),
+                         ['PRAGMA journal_mode = WAL',
+                          'PRAGMA synchronous = NORMAL',
+                          'PRAGMA cache_size = -2000'])
+
+    def test_unknown_profile(self):
+        os.environ['ACCOUNTS_SQLITE_PROFILE'] = 'safe'
+        with self.assertRaises(ValueError):
+            sqlitePragmas('accounts')
+
+
+
+class FakeSession():
+    """Counts the commits and rollbacks and keeps the changes committed;
+    commit fails while failing."""
+    def __init__(self):
+        self.commits = self.rollbacks = 0
+        self.failing = False
+        self.changes = []
+        self.saved = []
+
+    def commit(self):
+        if self.failing:
+            raise IOError('disk full')
+        self.commits += 1
+        self.saved += self.changes
+        self.changes = []
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.changes = []
+
+
+class TestGroupCommit(unittest.TestCase):
+    def setUp(self):
+        self.session = FakeSession()
+        self.group = GroupCommit(self.session, window=0.05, maxSize=100)
+        self.committed = []
+
+    def runConcurrently(self, writes):
+        results = [None] * len(writes)
+        def run(i):
+            try:
+                results[i] = self.group.run(writes[i], self.committed.append)
+            except Exception as error:
+                results[i] = error
+        workers = [threading.Thread(target=run, args=(i,))
+                   for i in range(len(writes))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return results
+
+    def test_concurrent_writes_share_commit(self):
+        results = self.runConcurrently([lambda i=i: i for i in range(10)])
+        self.assertEqual(results, range(10))
+        self.assertEqual(sorted(self.committed), range(10))
+        self.assertLess(self.session.commits, 10)
+        stats = self.group.stats()
+        self.assertEqual((stats['batches'], stats['items']),
+                         (self.session.commits, 10))
+
+    def test_failed_write_fails_alone(self):
+        def fail():
+            raise ValueError('refused')
+        results = self.runConcurrently([lambda: 1, fail, lambda: 3])
+        self.assertEqual(results[0::2], [1, 3])
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(sorted(self.committed), [1, 3])
+
+    def test_nothing_of_failed_write_committed(self):
+        runs = []
+        def write(change, fail=False):
+            def run():
+                runs.append(change)
+                self.session.changes.append(change)
+                if fail:
+                    raise ValueError('refused')
+                return change
+            return run
+        self.group = GroupCommit(self.session, window=0.05, maxSize=3)
+        results = self.runConcurrently([write('a'), write('b', True),
+                                        write('c')])
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(sorted(self.session.saved), ['a', 'c'])
+        self.assertEqual(self.session.rollbacks, 1)
+        # The write run before the failed one is run again
+        self.assertEqual(sorted(runs), ['a', 'a', 'b', 'c'])
+
+    def test_failed_commit_fails_every_write(self):
+        self.session.failing = True
+        results = self.runConcurrently([lambda i=i: i for i in range(3)])
+        self.assertTrue(all(isinstance(r, IOError) for r in results))
+        self.assertEqual(self.committed, [])
+        self.assertEqual(self.session.rollbacks, self.group.stats()['batches'])
+
+    def test_batch_bounded(self):
+        self.group = GroupCommit(self.session, window=1, maxSize=2)
+        start = time.time()
+        self.runConcurrently([lambda i=i: i for i in range(4)])
+        # Full batches are committed without waiting for the window
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(self.group.stats()['largestBatch'], 2)
+
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_new_client_gets_whole_burst(self):
+        limiter = RateLimiter({'read': (0.01, 3)})
+        self.assertEqual([limiter.admit('10.0.0.1', 'read')
+                          for i in range(4)][:3], [0, 0, 0])
+        self.assertGreater(limiter.admit('10.0.0.1', 'read'), 0)
+        # Another address has a bucket of its own
+        self.assertEqual(limiter.admit('10.0.0.2', 'read'), 0)
+
+    def test_bucket_created_after_now_is_full(self):
+        # As in admit, which reads the time before creating the bucket
+        now = time.time() - 1
+        bucket = TokenBucket(0.01, 1)
+        self.assertEqual(bucket.take(now), 0)
+        self.assertGreater(bucket.take(now), 0)
+
+    def test_unlimited_class(self):
+        limiter = RateLimiter({'read': (0.01, 1), 'write': (0, 1)})
+        self.assertEqual([limiter.admit('10.0.0.1', 'write')
+                          for i in range(5)], [0] * 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
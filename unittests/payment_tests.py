@@ -0,0 +1,165 @@
+import os
+import sys
+import json
+import logging
+import time
+import shutil
+import tempfile
+import unittest
+
+from fake_service import startFake, stopFake
+
+# The payment service runs in this process against fake accounts and
+# transactions services. Its modules and the ones shared by the services
+# (see services/common_files) are imported from the tree.
+SERVICES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        '..', 'services')
+sys.path.insert(0, os.path.join(SERVICES, 'common_files', 'general'))
+sys.path.insert(0, os.path.join(SERVICES, 'payment', 'payment'))
+# Each service has db_controller and api modules of its own;
+# those of a service imported before are set aside, as Python 2 clears
+# the globals of a module once it is garbage collected.
+otherModules = [sys.modules.pop(m) for m in list(sys.modules)
+                if m.split('.')[0] in ('db_controller', 'api')]
+
+DATAVOL = tempfile.mkdtemp()
+os.environ['PAYMENT_DATAVOL'] = DATAVOL
+os.environ['ACCOUNTS_READ_TIMEOUT'] = '0.2'
+os.environ['QUEUE_RETRY_DELAY'] = '0'
+
+import api
+
+# The service logs at INFO, the errors provoked here need not be shown
+logging.getLogger().setLevel(logging.CRITICAL)
+
+
+class TestPaymentSaga(unittest.TestCase):
+    # Seconds the fake accounts service takes to transfer, longer than
+    # ACCOUNTS_READ_TIMEOUT when the transfer should time out
+    transferDelay = 0
+    transferStatus = 200
+
+    def setUp(self):
+        self.accounts = startFake(
+            lambda method, path: (self.transferDelay, self.transferStatus,
+                                  {}))
+        self.transactions = startFake(
+            lambda method, path: (0, 200, {'number': 7}))
+        self.urls = (api.ACCOUNTS_SERVICE_URL, api.TRANSACTIONS_SERVICE_URL)
+        api.ACCOUNTS_SERVICE_URL = self.accounts.url
+        api.TRANSACTIONS_SERVICE_URL = self.transactions.url
+        self.client = api.app.test_client()
+
+    def tearDown(self):
+        api.ACCOUNTS_SERVICE_URL, api.TRANSACTIONS_SERVICE_URL = self.urls
+        stopFake(self.accounts)
+        stopFake(self.transactions)
+
+    def pay(self):
+        return self.client.post('/pay', data=json.dumps(
+                                    {'fromAccNum': 1, 'toAccNum': 2,
+                                     'amount': 10}),
+                                content_type='application/json')
+
+    def test_timed_out_transfer_is_not_compensated(self):
+        self.transferDelay = 0.5
+        res = self.pay()
+        # Let the fake accounts service finish the transfer
+        time.sleep(self.transferDelay)
+        self.assertEqual(res.status_code, 202)
+        payment = json.loads(self.client.get(res.headers['Location']).data)
+        self.assertEqual(payment['status'], 'unknown')
+        self.assertEqual(payment['number'], 7)
+        # Neither the transaction is canceled nor the transfer reversed
+        self.assertEqual([r[0] for r in self.transactions.received],
+                         ['POST'])
+        self.assertEqual(self.accounts.received,
+                         [('POST', '/transfers',
+                           {'fromAccNum': 1, 'toAccNum': 2, 'amount': 10,
+                            'checkFunds': True})])
+
+    def test_failed_transfer_is_compensated(self):
+        self.transferStatus = 400
+        res = self.pay()
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual([r[:2] for r in self.transactions.received],
+                         [('POST', '/transactions'),
+                          ('DELETE', '/transactions/7')])
+
+
+class TestPaymentQueue(unittest.TestCase):
+    def setUp(self):
+        self.accountsUp = False
+        self.cancelWorks = False
+        self.accounts = startFake(self.answerAccounts)
+        self.transactions = startFake(self.answerTransactions)
+        self.posted = 0
+        self.urls = (api.ACCOUNTS_SERVICE_URL, api.TRANSACTIONS_SERVICE_URL)
+        api.ACCOUNTS_SERVICE_URL = self.accounts.url
+        api.TRANSACTIONS_SERVICE_URL = self.transactions.url
+        self.client = api.app.test_client()
+
+    def tearDown(self):
+        api.ACCOUNTS_SERVICE_URL, api.TRANSACTIONS_SERVICE_URL = self.urls
+        stopFake(self.accounts)
+        stopFake(self.transactions)
+
+    def answerAccounts(self, method, path):
+        if not self.accountsUp:
+            return None
+        return (0, 200, {'results': [{'balance': 0}]})
+
+    def answerTransactions(self, method, path):
+        if path == '/transactions/batch':
+            self.posted += 1
+            return (0, 200, {'numbers': [self.posted]})
+        if not self.cancelWorks:
+            return None
+        return (0, 200, {'numbers': []})
+
+    def process(self):
+        api.processPayments(api.db.claimPayments(10))
+        api.db.removeSession()
+
+    def payment(self, paymentID):
+        return json.loads(self.client.get('/payments/%s' % paymentID).data)
+
+    def test_retry_cancels_previous_transaction(self):
+        res = self.client.post('/pay?async=true', data=json.dumps(
+                                   {'fromAccNum': 1, 'toAccNum': 2,
+                                    'amount': 10}),
+                               content_type='application/json')
+        self.assertEqual(res.status_code, 202)
+        paymentID = json.loads(res.data)['id']
+
+        # Neither the accounts nor the cancel go through: the payment is
+        # queued again with its transaction
+        self.process()
+        payment = self.payment(paymentID)
+        self.assertEqual((payment['status'], payment['number']),
+                         ('queued', 1))
+
+        # Its transaction cannot be canceled yet, so it is not run again
+        self.process()
+        self.assertEqual(self.posted, 1)
+        self.assertEqual(self.payment(paymentID)['status'], 'queued')
+
+        self.accountsUp = self.cancelWorks = True
+        self.process()
+        payment = self.payment(paymentID)
+        self.assertEqual((payment['status'], payment['number']),
+                         ('executed', 2))
+        cancels = [body['numbers'] for method, path, body
+                   in self.transactions.received
+                   if path == '/transactions/batch/cancel']
+        # Canceled after the accounts failed, before the retry that could
+        # not cancel and before the retry that ran
+        self.assertEqual(cancels, [[1], [1], [1]])
+
+
+def tearDownModule():
+    shutil.rmtree(DATAVOL, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
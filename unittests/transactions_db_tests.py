@@ -0,0 +1,176 @@
+import os
+import sys
+import json
+import shutil
+import logging
+import tempfile
+import threading
+import unittest
+
+# The transactions service runs in this process on a scratch volume. Its
+# modules and the ones shared by the services (see services/common_files)
+# are imported from the tree.
+SERVICES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        '..', 'services')
+sys.path.insert(0, os.path.join(SERVICES, 'common_files', 'general'))
+sys.path.insert(0, os.path.join(SERVICES, 'transactions', 'transactions'))
+# Each service has db_controller and api modules of its own;
+# those of a service imported before are set aside, as Python 2 clears
+# the globals of a module once it is garbage collected.
+otherModules = [sys.modules.pop(m) for m in list(sys.modules)
+                if m.split('.')[0] in ('db_controller', 'api')]
+
+DATAVOL = tempfile.mkdtemp()
+os.environ['TRANSACTIONS_DATAVOL'] = DATAVOL
+os.environ['MAX_PAGE_SIZE'] = '5'
+os.environ['STREAM_CHUNK_SIZE'] = '3'
+
+import api
+from db_controller import dbCtrl
+
+# The service logs at INFO, the errors provoked here need not be shown
+logging.getLogger().setLevel(logging.CRITICAL)
+
+
+def tearDownModule():
+    shutil.rmtree(DATAVOL, ignore_errors=True)
+
+
+class TransactionsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = api.app.test_client()
+
+    def post(self, fromAccNum, toAccNum, amount=1):
+        res = self.client.post('/transactions', data=json.dumps(
+                                   {'fromAccNum': fromAccNum,
+                                    'toAccNum': toAccNum,
+                                    'amount': amount}),
+                               content_type='application/json')
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)['number']
+
+    def get(self, path, **kwargs):
+        res = self.client.get(path, **kwargs)
+        self.assertEqual(res.status_code, 200)
+        return res
+
+
+class TestAccountTransactions(TransactionsTestCase):
+    def test_exact_account_match(self):
+        # Accounts whose numbers contain, start or end with another's
+        numbers = [self.post(*accNums) for accNums in
+                   [(1, 11), (11, 12), (1, 12), (21, 1), (10, 211),
+                    (13, 14)]]
+        res = json.loads(self.get('/transactions?accNum=1').data)
+        self.assertEqual([t['number'] for t in res],
+                         [numbers[0], numbers[2], numbers[3]])
+        res = json.loads(self.get('/transactions?accNum=11').data)
+        self.assertEqual([(t['fromAccNum'], t['toAccNum']) for t in res],
+                         [('1', '11'), ('11', '12')])
+
+    def test_transfer_to_self_listed_once(self):
+        number = self.post(105, 105)
+        res = json.loads(self.get('/transactions?accNum=105').data)
+        self.assertEqual([t['number'] for t in res], [number])
+
+
+
+class TestListing(TransactionsTestCase):
+    def setUp(self):
+        super(TestListing, self).setUp()
+        self.numbers = [self.post(301, 302, amount) for amount in range(10)]
+        self.after = self.numbers[0] - 1
+
+    def listing(self, after):
+        return api.db.getTransactionsPage(after, 100000)
+
+    def test_page_boundary(self):
+        res = self.get('/transactions?after=%s&limit=4' % self.after)
+        page = json.loads(res.data)
+        self.assertEqual([t['number'] for t in page], self.numbers[:4])
+        self.assertEqual(res.headers['Link'],
+                         '</transactions?after=%s&limit=4>; rel="next"'
+                         % self.numbers[3])
+        # The next page starts right after the last number seen
+        res = self.get('/transactions?after=%s&limit=4' % self.numbers[3])
+        self.assertEqual([t['number'] for t in json.loads(res.data)],
+                         self.numbers[4:8])
+
+    def test_pages_follow_links(self):
+        numbers = []
+        path = '/transactions?after=%s&limit=4' % self.after
+        while path:
+            res = self.get(path)
+            numbers += [t['number'] for t in json.loads(res.data)]
+            link = res.headers.get('Link')
+            path = link and link[1:link.index('>')]
+        self.assertEqual(numbers, [t['number']
+                                   for t in self.listing(self.after)])
+        self.assertNotIn('Link', self.get('/transactions?after=%s'
+                                          % numbers[-1]).headers)
+
+    def test_page_size_bounded(self):
+        res = self.get('/transactions?after=%s&limit=100' % self.after)
+        self.assertEqual(len(json.loads(res.data)), api.MAX_PAGE_SIZE)
+
+    def test_bad_page(self):
+        for query in ['limit=-1', 'after=x']:
+            self.assertEqual(self.client.get('/transactions?' + query)
+                                 .status_code, 400)
+
+    def stream(self, after):
+        res = self.get('/transactions?after=%s' % after,
+                       headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertTrue(res.is_streamed)
+        return [json.loads(line) for line in res.data.splitlines()]
+
+    def test_stream_spans_chunks(self):
+        self.assertEqual(api.STREAM_CHUNK_SIZE, 3)
+        # 10 transactions, over 4 chunks
+        streamed = self.stream(self.after)
+        self.assertEqual([t['number'] for t in streamed], self.numbers)
+        self.assertEqual([t['amount'] for t in streamed], range(10))
+        # As listed by the pages
+        pages = [json.loads(self.get('/transactions?after=%s&limit=5'
+                                     % after).data)
+                 for after in (self.after, self.numbers[4])]
+        self.assertEqual(streamed, pages[0] + pages[1])
+        # Ending on a full chunk, 9 transactions over 3
+        self.assertEqual([t['number'] for t in self.stream(self.numbers[0])],
+                         self.numbers[1:])
+
+    def test_stream_after_last(self):
+        self.assertEqual(self.stream(self.listing(0)[-1]['number']), [])
+
+    def test_json_without_ndjson_accept(self):
+        res = self.get('/transactions?after=%s&limit=2' % self.after,
+                       headers={'Accept': 'application/json'})
+        self.assertEqual(res.mimetype, 'application/json')
+        self.assertEqual(len(json.loads(res.data)), 2)
+
+
+
+class TestGroupCommit(unittest.TestCase):
+    def test_concurrent_transactions_share_commits(self):
+        ctrl = dbCtrl(api.logger, commitWindow=0.005)
+        threads, adds = 4, 25
+        numbers = []
+        def run():
+            for i in range(adds):
+                numbers.append(ctrl.addTransactionBetweenAccs(201, 202, 1))
+        workers = [threading.Thread(target=run) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(len(set(numbers)), threads * adds)
+        self.assertTrue(all(api.db.getTransactionByNum(n) is not None
+                            for n in numbers))
+        stats = ctrl.commits.stats()
+        self.assertEqual(stats['items'], threads * adds)
+        self.assertLess(stats['batches'], threads * adds)
+
+
+if __name__ == '__main__':
+    unittest.main()